@@ -1,5 +1,5 @@
 import streamlit as st
-from utils import DataLoader, SidebarFilter, Dashboard
+from utils import DATA_PATH, DataLoader, SidebarFilter, Dashboard
 
 T_ICON="ℹ️"
 H_ICON="📍"
@@ -15,22 +15,20 @@ HIDE_STREAMLIT_STYLE = """
 def app():
     st.title(f"{T_ICON} About")
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     df_selection, selected_filters = sidebar_filter.filter_data()
 
     st.header(f"{H_ICON} City and Branch Information:")
 
-    dashboard = Dashboard(df_selection)
+    dashboard = Dashboard(df_selection, sidebar_filter.aggregates())
+    dashboard.plan("display_city_and_branch_info")
 
     dashboard.display_city_and_branch_info(selected_filters)
 
@@ -0,0 +1,713 @@
+import concurrent.futures
+import copy
+import logging
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import span
+from selection import filter_signature
+from sketches import CellSketches, distinct_count_mode, distinct_error, hash_values, precision_for_error
+
+
+logger = logging.getLogger(__name__)
+
+# Dimensions the dashboard groups or filters by. Branch determines City, so
+# keeping both does not add cells.
+CUBE_DIMENSIONS = [
+    "City",
+    "Branch",
+    "Customer_type",
+    "Gender",
+    "Product line",
+    "Payment",
+    "DayOfWeek",
+    "hour",
+]
+
+# Additive measures kept per cell: column -> (sum column, count column)
+CUBE_MEASURES = {
+    "Total": ("total_sum", "count"),
+    "gross income": ("income_sum", "count"),
+    "Rating": ("rating_sum", "rating_count"),
+}
+DISTINCT_COLUMN = "Invoice ID"
+
+# Cubes of frames with at least this many rows are built by a pool of worker
+# processes, each grouping the rows of some partitions
+PARALLEL_MIN_ROWS_ENV = "SUPERMARKET_PARALLEL_MIN_ROWS"
+PARALLEL_MIN_ROWS = 1_000_000
+# Number of worker processes; defaults to the CPUs available to the app
+PARALLEL_WORKERS_ENV = "SUPERMARKET_WORKERS"
+# Cube dimensions the rows are partitioned by. Partitioning by dimensions keeps
+# every cell within one partition, so no sum is split between workers.
+PARALLEL_PARTITION_DIMENSIONS = ["Branch", "Product line"]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parallel_workers():
+    """Returns the number of worker processes to use for parallel builds."""
+    value = os.environ.get(PARALLEL_WORKERS_ENV)
+    if value:
+        return max(int(value), 1)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def parallel_min_rows():
+    value = os.environ.get(PARALLEL_MIN_ROWS_ENV)
+    return int(value) if value else PARALLEL_MIN_ROWS
+
+
+def process_context():
+    """Returns the multiprocessing context of every worker process of the app and its reports.
+
+    Workers are spawned rather than forked: the server process runs threads
+    (sessions, the dataset watcher, background builds), and a fork copies
+    the locks they hold. Workers get what they need pickled instead.
+    """
+    return multiprocessing.get_context("spawn")
+
+
+def worker_pool(workers):
+    """Returns the process pool shared by parallel builds, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=process_context())
+        return _pool
+
+
+def reset_worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _cube_partial(chunk, dimensions, positions, invoice_codes, num_invoices):
+    """Map step of AggregateCube.build: the cells of some partitions and their
+    (cell, invoice code) pairs."""
+    cells, cell_ids = AggregateCube._group(chunk, dimensions, positions)
+    pairs = np.unique(cell_ids.astype("int64") * num_invoices + invoice_codes)
+    return cells, pairs // num_invoices, (pairs % num_invoices).astype("int64")
+
+
+class FrameAggregator:
+    """Class to answer aggregations directly from the rows of a dataframe."""
+
+    # Rows are not tied to a dataset version, so results are never cached
+    key = None
+    results = None
+
+    def __init__(self, df):
+        self.df = df
+
+    def aggregate(self, by, column, how, sort=True):
+        """Aggregates `column` with `how` ("sum", "mean", "count" or "nunique") grouped by
+        the columns in `by`.
+
+        Returns a scalar when `by` is empty, else a Series indexed by the groups,
+        sorted by group or, with `sort=False`, in order of first appearance.
+        """
+        if not by:
+            return self.df[column].agg(how)
+        return self.df.groupby(by, observed=True, sort=sort)[column].agg(how)
+
+    def plan_table(self):
+        return PlanTable.from_rows(self.df)
+
+    def execute(self, plan):
+        return plan.execute(self.plan_table())
+
+
+class AggregateCube:
+    """Class holding the sales frame pre-aggregated over the dashboard dimensions.
+
+    Every distinct combination of the dimensions present in the data is a cell
+    with additive measures: row count, sums of Total, gross income and Rating,
+    the position of its first row, and the sorted invoice codes seen in it
+    (stored back to back, cell `i` owning `invoice_codes[invoice_offsets[i]:
+    invoice_offsets[i + 1]]`). Any filter on the dimensions is a selection of
+    cells, and any grouping is a groupby over those cells, so the cost of a
+    query depends on the number of cells instead of the number of rows.
+
+    In the "approx" distinct count mode, the hash of every invoice is kept
+    too, and `sketches` summarizes the invoices of each cell in a HyperLogLog
+    sketch for the groupings that cannot add up exact counts.
+
+    When rows are appended to the frame, `append` derives the cube of the
+    merged frame from this one and the new rows only.
+    """
+
+    def __init__(self, df, dimensions=CUBE_DIMENSIONS):
+        self.dimensions = [d for d in dimensions if d in df.columns]
+        self.dataset_version = df.attrs.get("dataset_version")
+
+        self.cells, cell_ids = self._group(df, self.dimensions, np.arange(len(df)))
+        self.invoice_codes, self.invoice_offsets, uniques, self.invoices_disjoint = (
+            self._build_invoices(cell_ids, len(self.cells), df[DISTINCT_COLUMN])
+        )
+        self.num_invoices = len(uniques)
+        self.invoice_hashes = self._hash_invoices(uniques)
+        self._sketches = {}
+        self.cells["invoice_count"] = np.diff(self.invoice_offsets)
+
+    @classmethod
+    def build(cls, df, dimensions=CUBE_DIMENSIONS, workers=None, min_rows=None):
+        """Returns the cube of `df`, built by worker processes from `min_rows` rows
+        (parallel_min_rows() by default).
+
+        The rows are split by PARALLEL_PARTITION_DIMENSIONS into one task per
+        worker, each task groups its rows into cells, and the cells are then
+        put in the order a single groupby gives. Each cell is summed by one
+        worker over its rows in frame order, so the cube is identical to the
+        one built serially.
+        """
+        workers = parallel_workers() if workers is None else workers
+        min_rows = parallel_min_rows() if min_rows is None else min_rows
+        partition_dimensions = [d for d in PARALLEL_PARTITION_DIMENSIONS if d in df.columns and d in dimensions]
+        if workers < 2 or len(df) < min_rows or not partition_dimensions:
+            return cls(df, dimensions)
+
+        cube = cls.__new__(cls)
+        cube.dimensions = [d for d in dimensions if d in df.columns]
+        cube.dataset_version = df.attrs.get("dataset_version")
+        invoice_codes, uniques = pd.factorize(df[DISTINCT_COLUMN])
+        num_invoices = max(len(uniques), 1)
+
+        # Partitions are dealt to the tasks largest first, each to the smallest task so far
+        partition_ids = df.groupby(partition_dimensions, observed=True, sort=False).ngroup().to_numpy()
+        sizes = np.bincount(partition_ids)
+        task_of_partition = np.empty(len(sizes), dtype="int64")
+        task_rows = np.zeros(workers, dtype="int64")
+        for partition in np.argsort(-sizes, kind="stable"):
+            task = int(np.argmin(task_rows))
+            task_of_partition[partition] = task
+            task_rows[task] += sizes[partition]
+        row_tasks = task_of_partition[partition_ids]
+
+        # Each task pickles its rows' dimension codes (categories are sent once per
+        # task), its measures, positions and invoice codes, about 45 bytes per row
+        columns = [*cube.dimensions, "Total", "gross income", "Rating"]
+        try:
+            futures = []
+            pool = worker_pool(workers)
+            for task in range(workers):
+                positions = np.flatnonzero(row_tasks == task)
+                if len(positions):
+                    futures.append(pool.submit(
+                        _cube_partial, df[columns].take(positions), cube.dimensions, positions,
+                        invoice_codes[positions].astype("int64"), num_invoices,
+                    ))
+            partials = [future.result() for future in futures]
+        except (concurrent.futures.process.BrokenProcessPool, OSError):
+            logger.warning("The worker pool stopped, building the cube in the app process", exc_info=True)
+            reset_worker_pool()
+            return cls(df, dimensions)
+
+        # Reduce: every cell comes from one task, so grouping the concatenated cells
+        # only sorts them; the sums are carried over unchanged
+        grouped = pd.concat([cells for cells, _, _ in partials], ignore_index=True).groupby(
+            cube.dimensions, observed=True, sort=True
+        )
+        cube.cells = grouped.agg(
+            count=("count", "sum"),
+            first_row=("first_row", "min"),
+            total_sum=("total_sum", "sum"),
+            income_sum=("income_sum", "sum"),
+            rating_sum=("rating_sum", "sum"),
+            rating_count=("rating_count", "sum"),
+        ).reset_index()
+        merged_ids = grouped.ngroup().to_numpy()
+
+        offsets = np.cumsum([0] + [len(cells) for cells, _, _ in partials])
+        pair_cells = np.concatenate([
+            merged_ids[offset:][pair_cells] for offset, (_, pair_cells, _) in zip(offsets, partials)
+        ])
+        codes = np.concatenate([codes for _, _, codes in partials])
+        order = np.argsort(pair_cells, kind="stable")
+        cube.invoice_codes = codes[order]
+        cube.invoice_offsets = np.searchsorted(pair_cells[order], np.arange(len(cube.cells) + 1))
+        cube.num_invoices = len(uniques)
+        cube.invoice_hashes = cls._hash_invoices(uniques)
+        cube._sketches = {}
+        cube.invoices_disjoint = len(codes) == len(uniques)
+        cube.cells["invoice_count"] = np.diff(cube.invoice_offsets)
+        return cube
+
+    @staticmethod
+    def _group(df, dimensions, row_positions):
+        """Returns the cells of `df` and the cell of every row."""
+        work = df[dimensions].copy()
+        work["_row"] = row_positions
+        work["_total"] = df["Total"].astype("float64")
+        work["_income"] = df["gross income"].astype("float64")
+        work["_rating"] = df["Rating"].astype("float64")
+
+        grouped = work.groupby(dimensions, observed=True, sort=True)
+        cells = grouped.agg(
+            count=("_row", "size"),
+            first_row=("_row", "min"),
+            total_sum=("_total", "sum"),
+            income_sum=("_income", "sum"),
+            rating_sum=("_rating", "sum"),
+            rating_count=("_rating", "count"),
+        ).reset_index()
+        return cells, grouped.ngroup().to_numpy()
+
+    @staticmethod
+    def _build_invoices(cell_ids, num_cells, invoices):
+        """Returns the invoice codes per cell, their offsets, the distinct invoices
+        and whether every invoice belongs to a single cell."""
+        invoice_codes, uniques = pd.factorize(invoices)
+        num_invoices = max(len(uniques), 1)
+
+        pairs = np.unique(cell_ids.astype("int64") * num_invoices + invoice_codes)
+        pair_cells = pairs // num_invoices
+        codes = (pairs % num_invoices).astype("int64")
+        offsets = np.searchsorted(pair_cells, np.arange(num_cells + 1))
+
+        # When no invoice spans several cells, distinct counts are additive.
+        return codes, offsets, uniques, len(pairs) == len(uniques)
+
+    @staticmethod
+    def _hash_invoices(uniques):
+        """Returns the hash of every invoice code, only kept for approximate distinct counts."""
+        if distinct_count_mode() != "approx":
+            return None
+        return hash_values(uniques)
+
+    def sketches(self, precision=None):
+        """Returns the CellSketches of the cube for `precision` (from the configured error
+        by default), or None when no invoice hashes were kept."""
+        if self.invoice_hashes is None:
+            return None
+        precision = precision_for_error(distinct_error()) if precision is None else precision
+        if precision not in self._sketches:
+            self._sketches[precision] = CellSketches(
+                self.invoice_codes, self.invoice_offsets, self.invoice_hashes, precision
+            )
+        return self._sketches[precision]
+
+    def append(self, rows, positions, dataset_version=None):
+        """Returns the cube of the frame with `rows` added; this cube is left untouched.
+
+        `rows` must have the dtypes of the merged frame and only invoices that
+        are new to the cube, as returned by ingest.append_sorted, and
+        `positions` are their ascending positions in the merged frame. Only the
+        new rows are grouped; their cells are then combined with the existing
+        ones.
+        """
+        positions = np.asarray(positions, dtype="int64")
+        cube = copy.copy(self)
+        cube.dataset_version = dataset_version
+
+        new_cells, new_cell_ids = self._group(rows, self.dimensions, positions)
+        new_codes, new_offsets, new_uniques, new_disjoint = self._build_invoices(
+            new_cell_ids, len(new_cells), rows[DISTINCT_COLUMN]
+        )
+
+        # Rows inserted before an existing row move it down by one position each
+        old_cells = self.cells.drop(columns="invoice_count")
+        inserted_before = positions - np.arange(len(positions))
+        first_rows = old_cells["first_row"].to_numpy()
+        old_cells["first_row"] = first_rows + np.searchsorted(inserted_before, first_rows, side="right")
+        for dimension in self.dimensions:
+            if isinstance(new_cells[dimension].dtype, pd.CategoricalDtype):
+                old_cells[dimension] = old_cells[dimension].cat.set_categories(
+                    new_cells[dimension].cat.categories
+                )
+
+        grouped = pd.concat([old_cells, new_cells], ignore_index=True).groupby(
+            self.dimensions, observed=True, sort=True
+        )
+        cube.cells = grouped.agg(
+            count=("count", "sum"),
+            first_row=("first_row", "min"),
+            total_sum=("total_sum", "sum"),
+            income_sum=("income_sum", "sum"),
+            rating_sum=("rating_sum", "sum"),
+            rating_count=("rating_count", "sum"),
+        ).reset_index()
+        merged_ids = grouped.ngroup().to_numpy()
+
+        # New invoices get codes after the existing ones, so each cell's codes stay sorted
+        pair_cells = np.concatenate([
+            np.repeat(merged_ids[:len(old_cells)], np.diff(self.invoice_offsets)),
+            np.repeat(merged_ids[len(old_cells):], np.diff(new_offsets)),
+        ])
+        codes = np.concatenate([self.invoice_codes, new_codes + self.num_invoices])
+        order = np.argsort(pair_cells, kind="stable")
+        cube.invoice_codes = codes[order]
+        cube.invoice_offsets = np.searchsorted(pair_cells[order], np.arange(len(cube.cells) + 1))
+        cube.num_invoices = self.num_invoices + len(new_uniques)
+        new_hashes = self._hash_invoices(new_uniques)
+        if self.invoice_hashes is None or new_hashes is None:
+            cube.invoice_hashes = None
+        else:
+            cube.invoice_hashes = np.concatenate([self.invoice_hashes, new_hashes])
+        cube._sketches = {}
+        cube.invoices_disjoint = self.invoices_disjoint and new_disjoint
+        cube.cells["invoice_count"] = np.diff(cube.invoice_offsets)
+        return cube
+
+    @property
+    def num_cells(self):
+        return len(self.cells)
+
+    def slice(self, selections, results=None):
+        """Returns a view of the cube restricted to `selections` (column -> accepted values).
+
+        `results` is an optional dict in which planned results for this slice
+        are kept, e.g. an entry of the session's SelectionCache.
+        """
+        mask = np.ones(len(self.cells), dtype=bool)
+        for column, selected in selections.items():
+            mask &= self.cells[column].isin(selected).to_numpy()
+        key = None
+        if self.dataset_version is not None:
+            key = (self.dataset_version, filter_signature(selections))
+        return CubeSlice(self, mask, key, results)
+
+
+class CubeSlice:
+    """Class to answer dashboard aggregations from the selected cells of a cube.
+
+    `key` identifies the slice (dataset version, filter signature) for caches
+    of results derived from it, and `results` holds planned results that
+    outlive the slice.
+    """
+
+    def __init__(self, cube, mask, key=None, results=None):
+        self.cube = cube
+        self.mask = mask
+        self.key = key
+        self.results = results
+        self.cells = cube.cells[mask]
+
+    def aggregate(self, by, column, how, sort=True):
+        """Same contract as FrameAggregator.aggregate."""
+        if how == "nunique":
+            if column != DISTINCT_COLUMN:
+                raise ValueError(f"Distinct counts are only kept for {DISTINCT_COLUMN!r}")
+            result = self._distinct_invoices(by)
+        else:
+            result = self._additive(by, column, how)
+
+        if not by:
+            return result
+        if not sort:
+            first_rows = self._grouped(by)["first_row"].min()
+            result = result.loc[first_rows.sort_values(kind="stable").index]
+        result.name = column
+        return result
+
+    def _grouped(self, by):
+        return self.cells.groupby(by, observed=True, sort=True)
+
+    def plan_table(self):
+        return PlanTable.from_cells(self.cube, self.mask)
+
+    def execute(self, plan):
+        return plan.execute(self.plan_table())
+
+    def _additive(self, by, column, how):
+        sum_column, count_column = CUBE_MEASURES.get(column, (None, "count"))
+        if how == "sum":
+            columns = [sum_column]
+        elif how == "count":
+            columns = [count_column]
+        elif how == "mean":
+            columns = [sum_column, count_column]
+        else:
+            raise ValueError(f"Unsupported aggregation {how!r}")
+        if None in columns:
+            raise ValueError(f"No additive measure is kept for {column!r}")
+
+        if by:
+            sums = self._grouped(by)[columns].sum()
+        else:
+            sums = self.cells[columns].sum()
+
+        if how == "mean":
+            return sums[sum_column] / sums[count_column]
+        return sums[columns[0]]
+
+    def _distinct_invoices(self, by):
+        cube = self.cube
+        if cube.invoices_disjoint:
+            if by:
+                return self._grouped(by)["invoice_count"].sum()
+            return self.cells["invoice_count"].sum()
+
+        # Invoices spread over several cells: merge the sketches or union the invoice codes per group.
+        cell_positions = np.flatnonzero(self.mask)
+        if by:
+            grouped = self._grouped(by)
+            group_ids = grouped.ngroup().to_numpy()
+            index = grouped.size().index
+        else:
+            group_ids = np.zeros(len(cell_positions), dtype="int64")
+            index = None
+
+        sketches = cube.sketches()
+        if sketches is not None:
+            counts = sketches.count(cell_positions, group_ids, len(index) if index is not None else 1)
+            if index is None:
+                return int(counts[0])
+            return pd.Series(counts, index=index)
+
+        starts = cube.invoice_offsets[cell_positions]
+        lengths = cube.invoice_offsets[cell_positions + 1] - starts
+        row_groups = np.repeat(group_ids, lengths)
+        row_positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        codes = cube.invoice_codes[row_positions]
+
+        num_invoices = int(codes.max()) + 1 if len(codes) else 1
+        unique_pairs = np.unique(row_groups * num_invoices + codes)
+        counts = np.bincount(unique_pairs // num_invoices, minlength=len(index) if index is not None else 1)
+        if index is None:
+            return int(counts[0])
+        return pd.Series(counts, index=index)
+
+
+class PlanTable:
+    """Class exposing rows or cube cells as flat arrays for AggregationPlan.
+
+    Every entry (a row, or a cube cell) carries additive measures, the position
+    of its first row, and its invoices. Cube cells can also carry their
+    sketches (CellSketches, `sketch_cells` giving the cell of every entry) for
+    approximate distinct counts. Dimensions are factorized on first use and
+    the codes are shared by every grouping that needs them.
+    """
+
+    def __init__(self, frame, measures, first_row, invoice_counts, invoices_disjoint,
+                 invoice_starts=None, invoice_lengths=None, invoice_codes=None, sketches=None, sketch_cells=None):
+        self.frame = frame
+        self.measures = measures
+        self.first_row = first_row
+        self.invoice_counts = invoice_counts
+        self.invoices_disjoint = invoices_disjoint
+        self.invoice_starts = invoice_starts
+        self.invoice_lengths = invoice_lengths
+        self.invoice_codes = invoice_codes
+        self.sketches = sketches
+        self.sketch_cells = sketch_cells
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.frame)
+
+    @classmethod
+    def from_rows(cls, df):
+        rating = df["Rating"].to_numpy(dtype="float64")
+        invoice_codes, uniques = pd.factorize(df[DISTINCT_COLUMN])
+        n = len(df)
+        return cls(
+            frame=df,
+            measures={
+                "count": np.ones(n),
+                "total_sum": df["Total"].to_numpy(dtype="float64"),
+                "income_sum": df["gross income"].to_numpy(dtype="float64"),
+                "rating_sum": np.nan_to_num(rating),
+                "rating_count": (~np.isnan(rating)).astype("float64"),
+            },
+            first_row=np.arange(n),
+            invoice_counts=np.ones(n),
+            invoices_disjoint=len(uniques) == n,
+            invoice_starts=np.arange(n),
+            invoice_lengths=np.ones(n, dtype="int64"),
+            invoice_codes=invoice_codes.astype("int64"),
+        )
+
+    @classmethod
+    def from_cells(cls, cube, mask):
+        cells = cube.cells[mask]
+        positions = np.flatnonzero(mask)
+        starts = cube.invoice_offsets[positions]
+        return cls(
+            frame=cells,
+            measures={
+                name: cells[name].to_numpy(dtype="float64")
+                for name in ["count", "total_sum", "income_sum", "rating_sum", "rating_count"]
+            },
+            first_row=cells["first_row"].to_numpy(),
+            invoice_counts=cells["invoice_count"].to_numpy(dtype="float64"),
+            invoices_disjoint=cube.invoices_disjoint,
+            invoice_starts=starts,
+            invoice_lengths=cube.invoice_offsets[positions + 1] - starts,
+            invoice_codes=cube.invoice_codes,
+            sketches=None if cube.invoices_disjoint else cube.sketches(),
+            sketch_cells=positions,
+        )
+
+    def codes(self, dimension):
+        """Returns (codes, categories) of a dimension, sorted like a groupby would."""
+        if dimension not in self._codes:
+            values = self.frame[dimension]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                self._codes[dimension] = (values.cat.codes.to_numpy(), values.cat.categories)
+            else:
+                codes, categories = pd.factorize(values, sort=True)
+                self._codes[dimension] = (codes, categories)
+        return self._codes[dimension]
+
+
+class AggregationPlan:
+    """Class collecting the aggregations a page needs and computing them together.
+
+    All requests are answered from one PlanTable: each dimension is factorized
+    once, each distinct grouping gets one array of dense group keys, and every
+    measure is then a `np.bincount` over those keys. A page with many charts
+    therefore costs roughly one pass over the selection instead of one pandas
+    groupby per chart.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    @staticmethod
+    def request_key(by, column, how, sort=True):
+        by = tuple(by)
+        return (by, column, how, sort if by else True)
+
+    def add(self, by, column, how, sort=True):
+        key = self.request_key(by, column, how, sort)
+        if key not in self.requests:
+            self.requests.append(key)
+        return self
+
+    def execute(self, table):
+        """Returns {request key: result} with the same results as FrameAggregator.aggregate."""
+        groupings = {}
+        results = {}
+        for by, column, how, sort in self.requests:
+            if by not in groupings:
+                groupings[by] = self._group_keys(table, by)
+            keys, size, index = groupings[by]
+
+            values = self._measure(table, keys, size, column, how)
+            if not by:
+                results[(by, column, how, sort)] = values[0].item()
+                continue
+
+            observed = np.flatnonzero(np.bincount(keys, minlength=size) > 0)
+            if not sort:
+                observed = observed[np.argsort(self._first_rows(table, keys, size)[observed], kind="stable")]
+            results[(by, column, how, sort)] = pd.Series(
+                values[observed], index=index[observed], name=column
+            )
+        return results
+
+    @staticmethod
+    def _group_keys(table, by):
+        if not by:
+            return np.zeros(len(table), dtype="int64"), 1, None
+
+        keys = np.zeros(len(table), dtype="int64")
+        levels = []
+        size = 1
+        for dimension in by:
+            codes, categories = table.codes(dimension)
+            keys = keys * len(categories) + codes
+            size *= len(categories)
+            levels.append(categories)
+
+        if len(by) == 1:
+            index = levels[0]
+            if isinstance(table.frame[by[0]].dtype, pd.CategoricalDtype):
+                index = pd.CategoricalIndex(index, dtype=table.frame[by[0]].dtype)
+            index = index.rename(by[0])
+        else:
+            index = pd.MultiIndex.from_product(levels, names=list(by))
+        return keys, size, index
+
+    @staticmethod
+    def _first_rows(table, keys, size):
+        first_rows = np.full(size, np.iinfo("int64").max)
+        np.minimum.at(first_rows, keys, table.first_row)
+        return first_rows
+
+    @staticmethod
+    def _measure(table, keys, size, column, how):
+        if how == "nunique":
+            if column != DISTINCT_COLUMN:
+                raise ValueError(f"Distinct counts are only kept for {DISTINCT_COLUMN!r}")
+            if table.invoices_disjoint:
+                return np.bincount(keys, weights=table.invoice_counts, minlength=size).astype("int64")
+            if table.sketches is not None:
+                return table.sketches.count(table.sketch_cells, keys, size)
+            lengths = table.invoice_lengths
+            entry_keys = np.repeat(keys, lengths)
+            positions = np.repeat(table.invoice_starts - np.cumsum(lengths) + lengths, lengths)
+            codes = table.invoice_codes[positions + np.arange(lengths.sum())]
+            num_invoices = int(codes.max()) + 1 if len(codes) else 1
+            unique_pairs = np.unique(entry_keys * num_invoices + codes)
+            return np.bincount(unique_pairs // num_invoices, minlength=size)
+
+        sum_column, count_column = CUBE_MEASURES.get(column, (None, "count"))
+        counts = np.bincount(keys, weights=table.measures[count_column], minlength=size)
+        if how == "count":
+            return counts.astype("int64")
+        if sum_column is None:
+            raise ValueError(f"No additive measure is kept for {column!r}")
+        sums = np.bincount(keys, weights=table.measures[sum_column], minlength=size)
+        if how == "sum":
+            return sums
+        if how == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return sums / counts
+        raise ValueError(f"Unsupported aggregation {how!r}")
+
+
+class PlannedAggregates:
+    """Class answering planned aggregations from one AggregationPlan run.
+
+    The plan runs on the first call, so a page whose figures all come from the
+    figure cache never pays for it. Results already present in the source's
+    `results` dict (filled by another page for the same selection) are reused
+    and only the missing requests are computed. Requests outside the plan are
+    passed on to the wrapped source.
+    """
+
+    def __init__(self, source, plan):
+        self.source = source
+        self.plan = plan
+        self.key = source.key
+        self.results = source.results if source.results is not None else {}
+        self._executed = False
+
+    def _execute(self):
+        missing = AggregationPlan()
+        missing.requests = [request for request in self.plan.requests if request not in self.results]
+        if missing.requests:
+            with span("aggregate.plan"):
+                self.results.update(self.source.execute(missing))
+        self._executed = True
+
+    def aggregate(self, by, column, how, sort=True):
+        """Same contract as FrameAggregator.aggregate."""
+        if not self._executed:
+            self._execute()
+        result = self.results.get(AggregationPlan.request_key(by, column, how, sort))
+        if result is None:
+            with span("aggregate"):
+                return self.source.aggregate(by, column, how, sort)
+        return result
+
+    def interval(self, by, column, how, sort=True):
+        """Returns the confidence interval half-width of an estimated result, or None when
+        the source gives exact results."""
+        interval = getattr(self.source, "interval", None)
+        return interval(by, column, how, sort) if interval is not None else None
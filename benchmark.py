@@ -0,0 +1,316 @@
+"""Times the analytics path headless on synthetic data of increasing size.
+
+Covers ingest (workbook parsing while it fits in a sheet, then each stage
+of the transform pipeline), the snapshot and its partitioned copy,
+filtering, building the index, the cube and the time rollups, every
+Dashboard aggregation on each backend and from a sample, exact and
+approximate distinct counts, date range aggregations, and figure
+construction with the bytes each figure sends. Nothing is rendered.
+
+Usage:
+    python benchmark.py --rows 1000 100000 1000000 --output bench_results.json
+    python benchmark.py --rows 100000 --compare bench_results.json
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from aggregates import DISTINCT_COLUMN, AggregateCube, AggregationPlan, FrameAggregator, parallel_workers
+from data_store import PartitionedStore, SnapshotCache
+from figures import compact_figure, figure_bytes
+from ingest import append_sorted
+from rollups import DateRangeSlice, TimeRollups
+from sampling import StratifiedSample
+from selection import FilterIndex, SelectedRows, date_bounds
+from sketches import DISTINCT_COUNT_ENV, DISTINCT_COUNT_MODES
+from sql_backend import DuckDBStore, duckdb_available
+from synthetic_data import EXCEL_MAX_ROWS, generate_sales, write_workbook
+from utils import Dashboard, DataLoader
+
+
+# Parsing a workbook is by far the slowest step; keep it for the smaller sizes
+EXCEL_BENCH_MAX_ROWS = 100_000
+REGRESSION_THRESHOLD = 1.25
+
+
+def measure(function, repeat):
+    """Returns the result of the last call and the timings of `repeat` calls."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def aggregate_all(source, requests):
+    return [source.aggregate(*request) for request in requests]
+
+
+def query_filter(df, selections):
+    """The df.query filter SidebarFilter used before the bitmap index, as a baseline."""
+    selected_cities = selections["City"]
+    selected_customer_types = selections["Customer_type"]
+    selected_genders = selections["Gender"]
+    return df.query(
+        "City == @selected_cities & Customer_type == @selected_customer_types & Gender == @selected_genders"
+    )
+
+
+class BenchmarkRun:
+    """Class collecting timing records for one benchmark run."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.records = []
+
+    def time(self, rows, stage, name, function, backend=None, repeat=None):
+        result, timings = measure(function, repeat or self.repeat)
+        record = {
+            "rows": rows,
+            "stage": stage,
+            "name": name,
+            "backend": backend,
+            "min_seconds": min(timings),
+            "median_seconds": statistics.median(timings),
+        }
+        self.records.append(record)
+        self._print(record)
+        return result
+
+    def record(self, rows, stage, name, seconds, backend=None):
+        """Records a duration measured elsewhere, e.g. one stage of the ingest pipeline."""
+        record = {
+            "rows": rows,
+            "stage": stage,
+            "name": name,
+            "backend": backend,
+            "min_seconds": seconds,
+            "median_seconds": seconds,
+        }
+        self.records.append(record)
+        self._print(record)
+
+    @staticmethod
+    def _print(record):
+        label = f"{record['stage']}/{record['name']}" + (f" [{record['backend']}]" if record["backend"] else "")
+        print(f"{record['rows']:>10,} rows  {label:<60} {record['median_seconds'] * 1000:10.2f} ms")
+
+    def bench_size(self, rows, cities, branches_per_city, workdir):
+        raw = generate_sales(rows, cities=cities, branches_per_city=branches_per_city)
+
+        # Ingest
+        if rows <= min(EXCEL_BENCH_MAX_ROWS, EXCEL_MAX_ROWS - 4):
+            path = os.path.join(workdir, f"sales_{rows}.xlsx")
+            write_workbook(raw, path)
+            self.time(rows, "ingest", "read_excel_streaming",
+                      lambda: DataLoader.read_excel(path, "Sales", "B:R", streaming=True), repeat=1)
+            self.time(rows, "ingest", "read_excel_pandas",
+                      lambda: DataLoader.read_excel(path, "Sales", "B:R", streaming=False), repeat=1)
+        df = self.time(rows, "ingest", "pipeline", lambda: DataLoader.process_frame(raw.copy()))
+        for stage in DataLoader.last_pipeline_report["stages"]:
+            self.record(rows, "ingest", f"pipeline_{stage['stage']}", stage["seconds"])
+        df.attrs["dataset_version"] = f"bench-{rows}"
+
+        # Snapshot round trip
+        source = os.path.join(workdir, f"snapshot_{rows}.bin")
+        with open(source, "wb") as f:
+            f.write(str(rows).encode())
+        snapshot = SnapshotCache(source, "Sales", "B:R", None)
+        if snapshot.enabled:
+            self.time(rows, "snapshot", "save", lambda: snapshot.save(df), repeat=1)
+            self.time(rows, "snapshot", "load", snapshot.load)
+            self.time(rows, "snapshot", "read", lambda: pd.read_parquet(snapshot.snapshot_path), backend="parquet")
+            self.time(rows, "snapshot", "read", lambda: snapshot.mapped.read(snapshot.version), backend="mmap")
+            for by_month in (False, True):
+                store = PartitionedStore(os.path.join(workdir, f"partitions_{rows}_{by_month}"), by_month)
+                layout = "branch_month" if by_month else "branch"
+                self.time(rows, "partitions", "write", lambda: store.write(df, snapshot.version),
+                          backend=layout, repeat=1)
+                catalog = store.catalog(snapshot.version)
+                one_city = PartitionedStore.matching(catalog, {"City": PartitionedStore.values(catalog, "City")[:1]})
+                self.time(rows, "partitions", "read_one_city", lambda: store.read(snapshot.version, one_city),
+                          backend=layout)
+
+        # Filtering
+        index = self.time(rows, "filter", "build_index", lambda: FilterIndex(df), repeat=1)
+        everything = {column: index.values(column) for column in ["City", "Customer_type", "Gender"]}
+        narrow = {
+            "City": index.values("City")[:1],
+            "Customer_type": index.values("Customer_type")[:1],
+            "Gender": index.values("Gender"),
+        }
+        for label, selections in [("all", everything), ("one_city_one_type", narrow)]:
+            self.time(rows, "filter", label, lambda: df.take(index.select(selections)), backend="bitmap")
+            self.time(rows, "filter", label, lambda: SelectedRows(df, index.select(selections)), backend="positions")
+            self.time(rows, "filter", label, lambda: query_filter(df, selections), backend="query")
+        df_selection = df.take(index.select(everything))
+
+        # Aggregations
+        cube = self.time(rows, "aggregate", "build_cube", lambda: AggregateCube(df), repeat=1)
+        workers = parallel_workers()
+        if workers > 1:
+            # Starts the worker pool outside of the timing
+            AggregateCube.build(df.iloc[:1000], workers=workers, min_rows=0)
+            self.time(rows, "aggregate", "build_cube",
+                      lambda: AggregateCube.build(df, workers=workers, min_rows=0), backend=f"parallel_{workers}")
+        # Appending the last 1% of the rows, to compare with building from scratch
+        split = rows - max(rows // 100, 1)
+        head_cube = AggregateCube(df.iloc[:split])
+        merged, positions = self.time(rows, "ingest", "append_sorted",
+                                      lambda: append_sorted(df.iloc[:split], df.iloc[split:]))
+        self.time(rows, "aggregate", "append_cube", lambda: head_cube.append(merged.take(positions), positions))
+
+        sources = {
+            "frame": lambda: FrameAggregator(df_selection),
+            "cube": lambda: cube.slice(everything),
+        }
+        if duckdb_available():
+            parquet_path = snapshot.snapshot_path if snapshot.fresh else None
+            store = self.time(rows, "aggregate", "open_duckdb", lambda: DuckDBStore(df, parquet_path), repeat=1)
+            sources["duckdb"] = lambda: store.slice(everything)
+        sample = self.time(rows, "aggregate", "draw_sample", lambda: StratifiedSample(df_selection), repeat=1)
+        sources["sample"] = lambda: sample
+        for method, requests in Dashboard.CHART_AGGREGATIONS.items():
+            if not requests:
+                continue
+            for backend, make_source in sources.items():
+                self.time(rows, "aggregate", method,
+                          lambda: aggregate_all(make_source(), requests),
+                          backend=backend)
+
+        plan = AggregationPlan()
+        for requests in Dashboard.CHART_AGGREGATIONS.values():
+            for request in requests:
+                plan.add(*request)
+        for backend, make_source in sources.items():
+            self.time(rows, "aggregate", "all_planned",
+                      lambda: make_source().execute(plan), backend=backend)
+
+        # Distinct invoices when every invoice has four lines, so counts do not add up across cells
+        multi_line = df.assign(**{DISTINCT_COLUMN: df[DISTINCT_COLUMN].to_numpy()[np.arange(rows) // 4 * 4]})
+        distinct_plan = AggregationPlan()
+        distinct_plan.requests = [request for request in plan.requests if request[2] == "nunique"]
+        mode = os.environ.get(DISTINCT_COUNT_ENV)
+        for distinct_mode in DISTINCT_COUNT_MODES:
+            os.environ[DISTINCT_COUNT_ENV] = distinct_mode
+            multi_line_cube = self.time(rows, "aggregate", "build_cube_multi_line",
+                                        lambda: AggregateCube(multi_line), backend=distinct_mode, repeat=1)
+            if distinct_mode == "approx":
+                self.time(rows, "aggregate", "build_sketches", multi_line_cube.sketches, repeat=1)
+            self.time(rows, "aggregate", "distinct_planned",
+                      lambda: multi_line_cube.slice(everything).execute(distinct_plan), backend=distinct_mode)
+        if mode is None:
+            os.environ.pop(DISTINCT_COUNT_ENV)
+        else:
+            os.environ[DISTINCT_COUNT_ENV] = mode
+
+        # Date ranges: the middle half of the period, from the rows or from the rollups
+        rollups = self.time(rows, "rollups", "build", lambda: TimeRollups(df), repeat=1)
+        first_day, last_day = df["Date"].iloc[0].date(), df["Date"].iloc[-1].date()
+        quarter = (last_day - first_day) / 4
+        date_range = (first_day + quarter, last_day - quarter)
+        dates = df["Date"].to_numpy()
+        self.time(rows, "filter", "date_range",
+                  lambda: df.take(index.select(everything, date_bounds(dates, *date_range))), backend="bitmap")
+        self.time(rows, "filter", "date_range",
+                  lambda: df[(df["Date"].dt.date >= date_range[0]) & (df["Date"].dt.date <= date_range[1])],
+                  backend="query")
+        range_rows = df.take(index.select(everything, date_bounds(dates, *date_range)))
+        self.time(rows, "rollups", "range_table", lambda: rollups.range_table(*date_range))
+        range_sources = {
+            "frame": lambda: FrameAggregator(range_rows),
+            "rollups": lambda: DateRangeSlice(rollups, range_rows, everything, *date_range),
+        }
+        for backend, make_source in range_sources.items():
+            self.time(rows, "aggregate", "date_range_planned",
+                      lambda: make_source().execute(plan), backend=backend)
+
+        # Figure construction and compaction, from the cube as the pages do, with the bytes sent
+        for name in sorted(attr[:-len("_figure")] for attr in dir(Dashboard)
+                           if attr.endswith("_figure") and attr not in ("show_figure", "sales_trend_figure")):
+            figure = self.time(rows, "figure", name, lambda: compact_figure(
+                getattr(Dashboard(df_selection, cube.slice(everything)), f"{name}_figure")()
+            ))
+            self.records[-1]["bytes"] = figure_bytes(figure)
+        trends = functools.partial(rollups.trend, selections=everything)
+        for grain in Dashboard.TREND_LABELS:
+            figure = self.time(rows, "figure", f"sales_trend_{grain}", lambda: compact_figure(
+                Dashboard(df_selection, cube.slice(everything), trends).sales_trend_figure(grain)
+            ))
+            self.records[-1]["bytes"] = figure_bytes(figure)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(records, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """Prints the records that got slower than the baseline by more than `threshold`."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {
+        (r["rows"], r["stage"], r["name"], r["backend"]): r["median_seconds"] for r in baseline["records"]
+    }
+    regressions = []
+    for record in records:
+        before = previous.get((record["rows"], record["stage"], record["name"], record["backend"]))
+        if before and record["median_seconds"] > before * threshold:
+            regressions.append((record, before))
+
+    for record, before in regressions:
+        print(f"REGRESSION {record['rows']:,} rows {record['stage']}/{record['name']} "
+              f"[{record['backend']}]: {before * 1000:.2f} ms -> {record['median_seconds'] * 1000:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--cities", type=int, default=6)
+    parser.add_argument("--branches-per-city", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Earlier results file to check for regressions")
+    args = parser.parse_args()
+
+    run = BenchmarkRun(args.repeat)
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in args.rows:
+            run.bench_size(rows, args.cities, args.branches_per_city, workdir)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "cities": args.cities,
+        "branches_per_city": args.branches_per_city,
+        "records": run.records,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {len(run.records)} records to {args.output}")
+
+    if args.compare:
+        regressions = compare(run.records, args.compare)
+        raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
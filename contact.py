@@ -1,5 +1,5 @@
 import streamlit as st
-from utils import DataLoader, SidebarFilter, ContactInfo, ContactForm
+from utils import DATA_PATH, DataLoader, SidebarFilter, ContactInfo, ContactForm
 
 
 T_ICON="📬"
@@ -14,17 +14,14 @@ HIDE_STREAMLIT_STYLE = """
 def app():
     st.title(f"{T_ICON} Contact Us")
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     _, selected_filters = sidebar_filter.filter_data()
 
     contactinfo=ContactInfo(selected_filters)
@@ -0,0 +1,567 @@
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the processing in DataLoader changes, so that snapshots written
+# by an older version of the app are rebuilt instead of being served stale.
+SNAPSHOT_FORMAT_VERSION = 5
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Daily or weekly sales files dropped next to the workbook, merged in name order
+INCREMENT_PATTERNS = ["sales_*.xlsx", "sales_*.csv"]
+
+# Columns the partitioned copy of the snapshot is split by, and optionally by month of Date
+PARTITION_COLUMNS = ["City", "Branch"]
+# Partitioned versions kept on disk: the current one and the one sessions may still be reading
+PARTITION_VERSIONS_KEPT = 2
+# Categorical columns with more categories than this only keep the
+# categories used in each partition file, otherwise every file would repeat all of them
+PARTITION_SHARED_CATEGORIES_MAX = 256
+# Set SUPERMARKET_SNAPSHOT_MMAP=0 to read the Parquet snapshot instead of
+# mapping its column files
+SNAPSHOT_MMAP_ENV = "SUPERMARKET_SNAPSHOT_MMAP"
+# Mapped versions kept on disk; files still mapped by a process stay readable after removal
+MAPPED_VERSIONS_KEPT = 2
+
+
+def file_sha256(path):
+    """Returns the hex sha256 digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_increments(directory):
+    """Returns the paths of the increment files in `directory`, sorted by name."""
+    paths = set()
+    for pattern in INCREMENT_PATTERNS:
+        paths.update(glob.glob(os.path.join(directory, pattern)))
+    return sorted(paths)
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def mmap_enabled():
+    return os.environ.get(SNAPSHOT_MMAP_ENV, "1").strip().lower() not in ("0", "false", "off")
+
+
+def _parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SnapshotCache:
+    """Class to keep a processed, columnar copy of a workbook sheet on disk.
+
+    The snapshot is written as Parquet next to the source workbook together with
+    a small JSON manifest describing the source file it was built from. A snapshot
+    is considered fresh when the source mtime and size are unchanged; when they
+    differ the source is hashed, so a file that was only touched or copied keeps
+    its snapshot.
+
+    The manifest also lists the increment files merged into the snapshot, and
+    every merge gives the snapshot a new version. Each version is also kept as
+    memory-mapped column files (see MappedColumns), which are loaded instead of
+    the Parquet file unless SUPERMARKET_SNAPSHOT_MMAP=0.
+    """
+
+    def __init__(self, path, sheet_name, usecols, nrows):
+        self.path = path
+        self.sheet_name = sheet_name
+        self.load_args = {"usecols": usecols, "nrows": nrows}
+
+        base, _ = os.path.splitext(path)
+        self.snapshot_path = f"{base}.{sheet_name}.snapshot.parquet"
+        self.manifest_path = f"{base}.{sheet_name}.snapshot.json"
+        self.partitions = PartitionedStore(f"{base}.{sheet_name}.partitions")
+        self.mapped = MappedColumns(f"{base}.{sheet_name}.columns")
+        self.version = None
+        self.sha256 = None
+        self.increments = []
+        # Whether the snapshot file holds the frame of `version`
+        self.fresh = False
+
+    @property
+    def enabled(self):
+        return _parquet_available()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _source_stat(self):
+        return file_stat(self.path)
+
+    def _make_version(self, sha256):
+        parts = [sha256, self.sheet_name, self.load_args, SNAPSHOT_FORMAT_VERSION]
+        if self.increments:
+            parts.append([entry["sha256"] for entry in self.increments])
+        key = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+    @staticmethod
+    def _file_unchanged(path, entry):
+        """Tells whether `path` still has the content recorded in a manifest `entry`."""
+        stat = file_stat(path)
+        if stat == entry["source"]:
+            return True
+        # The file was modified or copied; only its content decides.
+        if file_sha256(path) != entry["sha256"]:
+            return False
+        entry["source"] = stat
+        return True
+
+    def _write_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _valid_manifest(self):
+        """Returns the manifest if the snapshot is still valid for the source, else None."""
+        manifest = self._read_manifest()
+        if (
+            manifest is None
+            or not os.path.exists(self.snapshot_path)
+            or manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION
+            or manifest.get("sheet_name") != self.sheet_name
+            or manifest.get("load_args") != self.load_args
+        ):
+            return None
+
+        source_stat = manifest["source"]
+        if not self._file_unchanged(self.path, manifest):
+            return None
+        if manifest["source"] != source_stat:
+            try:
+                self._write_manifest(manifest)
+            except OSError:
+                pass
+        return manifest
+
+    def load(self):
+        """Returns the snapshot frame if it is still valid for the source, else None."""
+        if not self.enabled:
+            return None
+        manifest = self._valid_manifest()
+        if manifest is None:
+            return None
+
+        df = self._map(manifest["version"]) if mmap_enabled() else None
+        if df is None:
+            try:
+                # String columns come back Arrow-backed, as ingest.string_dtype makes them
+                with pd.option_context("mode.string_storage", "pyarrow"):
+                    df = pd.read_parquet(self.snapshot_path)
+            except Exception:
+                logger.warning("Unreadable snapshot %s, rebuilding it", self.snapshot_path, exc_info=True)
+                return None
+            if mmap_enabled():
+                self._write_mapped(df, manifest["version"])
+
+        self.version = manifest["version"]
+        self.fresh = True
+        self.sha256 = manifest["sha256"]
+        self.increments = manifest.get("increments", [])
+        return df
+
+    def catalog(self, increment_paths=()):
+        """Returns the partition catalog of the snapshot without loading its frame.
+
+        Returns None when the snapshot is not valid anymore, when some of
+        `increment_paths` are not merged into it yet, or when it has no
+        partitioned copy: the data has to be loaded then.
+        """
+        if not self.enabled:
+            return None
+        manifest = self._valid_manifest()
+        if manifest is None:
+            return None
+        self.increments = manifest.get("increments", [])
+        if self.pending_increments(increment_paths) != []:
+            return None
+        catalog = self.partitions.catalog(manifest["version"])
+        if catalog is None:
+            return None
+        return {"root": self.partitions.root, **catalog}
+
+    def pending_increments(self, paths):
+        """Returns the increment files among `paths` that are not merged into the snapshot yet.
+
+        Returns None when a merged increment changed or disappeared: its rows
+        cannot be taken out of the snapshot, so it has to be rebuilt.
+        """
+        by_name = {os.path.basename(path): path for path in paths}
+        for entry in self.increments:
+            path = by_name.get(entry["name"])
+            if path is None or not self._file_unchanged(path, entry):
+                return None
+        merged = {entry["name"] for entry in self.increments}
+        return [path for path in paths if os.path.basename(path) not in merged]
+
+    def save(self, df, increments=()):
+        """Writes the processed frame and its manifest, replacing any previous snapshot.
+
+        `increments` are the paths of the increment files merged into `df`
+        since the snapshot was loaded, or since the workbook was read.
+        """
+        if self.sha256 is None:
+            self.sha256 = file_sha256(self.path)
+        sha256 = self.sha256
+        self.increments = self.increments + [
+            {"name": os.path.basename(path), "source": file_stat(path), "sha256": file_sha256(path)}
+            for path in increments
+        ]
+        self.version = self._make_version(sha256)
+        if not self.enabled:
+            logger.info("pyarrow is not installed, skipping snapshot for %s", self.path)
+            return
+
+        tmp_path = f"{self.snapshot_path}.tmp"
+        self.fresh = False
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, self.snapshot_path)
+            self._write_manifest({
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "sheet_name": self.sheet_name,
+                "load_args": self.load_args,
+                "source": self._source_stat(),
+                "sha256": sha256,
+                "version": self.version,
+                "rows": len(df),
+                "increments": self.increments,
+            })
+            self.fresh = True
+        except OSError:
+            # A read-only data directory must not break loading.
+            logger.warning("Could not write snapshot %s", self.snapshot_path, exc_info=True)
+            return
+        if mmap_enabled():
+            self._write_mapped(df, self.version)
+
+    def _map(self, version):
+        try:
+            return self.mapped.read(version)
+        except (OSError, ValueError):
+            logger.warning("Unreadable column files under %s, reading the Parquet snapshot",
+                           self.mapped.root, exc_info=True)
+            return None
+
+    def _write_mapped(self, df, version):
+        try:
+            self.mapped.write(df, version)
+        except (OSError, TypeError):
+            logger.warning("Could not write column files under %s", self.mapped.root, exc_info=True)
+
+    def ensure_partitions(self, df):
+        """Writes the partitioned copy of the frame of the current version unless it exists.
+
+        Returns the catalog, or None when no partitioned copy could be written.
+        """
+        if self.version is None or not self.partitions.enabled:
+            return None
+        catalog = self.partitions.catalog(self.version)
+        if catalog is not None:
+            return catalog
+        try:
+            self.partitions.write(df, self.version)
+        except OSError:
+            logger.warning("Could not write partitions under %s", self.partitions.root, exc_info=True)
+            return None
+        return self.partitions.catalog(self.version)
+
+
+class PartitionedStore:
+    """Class keeping a copy of the processed frame split into one Parquet file per
+    City and Branch, and optionally per month.
+
+    Every dataset version gets its own directory with a catalog listing the
+    partitions and their row counts, written last, so a version is readable
+    as soon as its catalog exists. Each file keeps all the columns plus the
+    position of its rows in the whole frame, so reading any set of partitions
+    gives back the rows in the order of the whole frame. Partitions that do not
+    match the requested values are never opened.
+    """
+
+    CATALOG_NAME = "catalog.json"
+    ROW_COLUMN = "_row"
+
+    def __init__(self, root, by_month=False):
+        self.root = root
+        # Monthly files allow pruning by date too, but every file read has a fixed
+        # cost, so they only pay off when the branches have a lot of rows
+        self.by_month = by_month
+
+    @property
+    def enabled(self):
+        return _parquet_available()
+
+    def _version_dir(self, version):
+        return os.path.join(self.root, version)
+
+    def catalog(self, version):
+        """Returns the catalog of a version, or None when it was not written."""
+        try:
+            with open(os.path.join(self._version_dir(version), self.CATALOG_NAME)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _partition_path(values, month):
+        parts = [
+            f"{column}={urllib.parse.quote(str(value), safe='')}"
+            for column, value in zip(PARTITION_COLUMNS, values)
+        ]
+        return os.path.join(*parts, f"{month or 'all'}.parquet")
+
+    def write(self, df, version):
+        """Writes the partitions and the catalog of `version`, then drops older versions."""
+        version_dir = self._version_dir(version)
+        tmp_dir = f"{version_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        frame = df.assign(**{self.ROW_COLUMN: range(len(df))})
+        trimmed = [
+            column for column in df.columns
+            if isinstance(df[column].dtype, pd.CategoricalDtype)
+            and len(df[column].cat.categories) > PARTITION_SHARED_CATEGORIES_MAX
+        ]
+        keys = [df[column] for column in PARTITION_COLUMNS]
+        if self.by_month:
+            keys.append(df["Date"].dt.strftime("%Y-%m"))
+        partitions = []
+        for values, part in frame.groupby(keys, observed=True, sort=True):
+            values = list(values)
+            month = values.pop() if self.by_month else None
+            path = self._partition_path(values, month)
+            os.makedirs(os.path.dirname(os.path.join(tmp_dir, path)), exist_ok=True)
+            for column in trimmed:
+                part[column] = part[column].cat.remove_unused_categories()
+            part.to_parquet(os.path.join(tmp_dir, path))
+            partitions.append({
+                **{column: value for column, value in zip(PARTITION_COLUMNS, map(str, values))},
+                "month": month,
+                "rows": len(part),
+                "first_row": int(part[self.ROW_COLUMN].iloc[0]),
+                "path": path,
+            })
+
+        with open(os.path.join(tmp_dir, self.CATALOG_NAME), "w") as f:
+            json.dump({"version": version, "rows": len(df), "by_month": self.by_month, "partitions": partitions},
+                      f, indent=2)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.replace(tmp_dir, version_dir)
+        self._drop_old_versions(version)
+
+    def _drop_old_versions(self, version):
+        versions = [
+            entry for entry in os.listdir(self.root)
+            if entry != version and not entry.endswith(".tmp")
+            and os.path.exists(os.path.join(self._version_dir(entry), self.CATALOG_NAME))
+        ]
+        versions.sort(key=lambda entry: os.path.getmtime(self._version_dir(entry)), reverse=True)
+        for entry in versions[PARTITION_VERSIONS_KEPT - 1:]:
+            shutil.rmtree(self._version_dir(entry), ignore_errors=True)
+
+    @staticmethod
+    def values(catalog, column):
+        """Returns the distinct values of a partition column, in order of first appearance in the frame."""
+        first_rows = {}
+        for entry in catalog["partitions"]:
+            first_rows[entry[column]] = min(first_rows.get(entry[column], entry["first_row"]), entry["first_row"])
+        return sorted(first_rows, key=first_rows.get)
+
+    @staticmethod
+    def matching(catalog, selections, months=None):
+        """Returns the catalog entries whose partition values are all selected.
+
+        `months` ("YYYY-MM") only prune catalogs written `by_month`.
+        """
+        selected = {column: set(map(str, values)) for column, values in selections.items()
+                    if column in PARTITION_COLUMNS}
+        if months is not None and catalog.get("by_month"):
+            selected["month"] = set(months)
+        return [
+            entry for entry in catalog["partitions"]
+            if all(entry[column] in values for column, values in selected.items())
+        ]
+
+    def read(self, version, entries):
+        """Reads the partitions of `entries` into one frame, in the row order of the whole frame."""
+        version_dir = self._version_dir(version)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # The files are concatenated as Arrow tables and converted to pandas once, which
+        # also merges the trimmed categories of each file. The directory names must not
+        # be read as hive partitions: the partition columns are in the files.
+        tables = [
+            pq.read_table(os.path.join(version_dir, entry["path"]), partitioning=None) for entry in entries
+        ]
+        with pd.option_context("mode.string_storage", "pyarrow"):
+            df = pa.concat_tables(tables).to_pandas()
+        df = df.sort_values(self.ROW_COLUMN, kind="stable")
+        return df.drop(columns=self.ROW_COLUMN)
+
+
+class MappedColumns:
+    """Class keeping a frame as one raw NumPy file per column, memory-mapped on load.
+
+    Every dataset version gets its own directory with a `columns.json` that
+    describes the columns, written last. Numeric and datetime columns, the
+    codes of categorical columns and the index are `.npy` files mapped
+    read-only, so loading reads no data: pages are read from disk when first
+    used, and every server process mapping the same version shares them
+    through the page cache. Arrow string columns (e.g. Invoice ID) are Arrow
+    IPC files, mapped the same way. Only categories and object columns (e.g.
+    Time), stored as codes into their distinct values, are built in each
+    process.
+    """
+
+    COLUMNS_NAME = "columns.json"
+
+    def __init__(self, root):
+        self.root = root
+
+    def _version_dir(self, version):
+        return os.path.join(self.root, version)
+
+    @staticmethod
+    def _encode_objects(values):
+        """Returns the codes of an object column and its distinct values as strings, with their type."""
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        if all(isinstance(value, datetime.time) for value in uniques):
+            return codes, [value.isoformat() for value in uniques], "time"
+        if all(isinstance(value, str) for value in uniques):
+            return codes, list(uniques), "str"
+        raise TypeError(f"Cannot map object column {values.name!r}")
+
+    @staticmethod
+    def _decode_objects(codes, uniques, kind):
+        if kind == "time":
+            uniques = [datetime.time.fromisoformat(value) for value in uniques]
+        values = np.empty(len(uniques) + 1, dtype=object)
+        values[:-1] = uniques
+        values[-1] = None
+        # Missing values have code -1, the None at the end
+        return values[codes]
+
+    @staticmethod
+    def _write_arrow(path, values):
+        import pyarrow as pa
+
+        table = pa.table({"values": pa.array(values)})
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    @staticmethod
+    def _map_arrow(path):
+        """Returns the strings of an Arrow IPC file over a read-only mapping of it."""
+        import pyarrow as pa
+
+        with pa.ipc.open_file(pa.memory_map(path, "r")) as reader:
+            return pd.arrays.ArrowStringArray(reader.read_all().column("values"))
+
+    def write(self, df, version):
+        """Writes the column files and the description of `version`, then drops older versions."""
+        version_dir = self._version_dir(version)
+        tmp_dir = f"{version_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        columns = []
+        for position, column in enumerate(df.columns):
+            values = df[column]
+            entry = {"name": column, "file": f"{position}.npy"}
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.to_numpy()
+                categories = values.cat.categories
+                entry.update(kind="category", ordered=bool(values.cat.ordered),
+                             categories_file=f"{position}.categories.npy")
+                np.save(os.path.join(tmp_dir, entry["categories_file"]),
+                        categories.to_numpy().astype(str) if categories.dtype == object else categories.to_numpy())
+            elif isinstance(values.dtype, pd.StringDtype):
+                codes = None
+                entry.update(kind="arrow", file=f"{position}.arrow")
+                self._write_arrow(os.path.join(tmp_dir, entry["file"]), values)
+            elif values.dtype == object:
+                codes, uniques, kind = self._encode_objects(values)
+                entry.update(kind=kind, values=uniques)
+            else:
+                codes = values.to_numpy()
+                entry.update(kind="array")
+            if codes is not None:
+                np.save(os.path.join(tmp_dir, entry["file"]), np.ascontiguousarray(codes))
+            columns.append(entry)
+        np.save(os.path.join(tmp_dir, "index.npy"), df.index.to_numpy())
+
+        with open(os.path.join(tmp_dir, self.COLUMNS_NAME), "w") as f:
+            json.dump({"version": version, "rows": len(df), "columns": columns}, f)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.replace(tmp_dir, version_dir)
+        self._drop_old_versions(version)
+
+    def _drop_old_versions(self, version):
+        versions = [
+            entry for entry in os.listdir(self.root)
+            if entry != version and not entry.endswith(".tmp")
+            and os.path.exists(os.path.join(self._version_dir(entry), self.COLUMNS_NAME))
+        ]
+        versions.sort(key=lambda entry: os.path.getmtime(self._version_dir(entry)), reverse=True)
+        for entry in versions[MAPPED_VERSIONS_KEPT - 1:]:
+            shutil.rmtree(self._version_dir(entry), ignore_errors=True)
+
+    def read(self, version):
+        """Maps the columns of a version into a frame, or returns None when it was not written."""
+        version_dir = self._version_dir(version)
+        try:
+            with open(os.path.join(version_dir, self.COLUMNS_NAME)) as f:
+                description = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        def mapped(name):
+            # A plain read-only ndarray over the mapping, so pandas does not carry np.memmap around
+            return np.load(os.path.join(version_dir, name), mmap_mode="r").view(np.ndarray)
+
+        columns = {}
+        for entry in description["columns"]:
+            if entry["kind"] == "arrow":
+                columns[entry["name"]] = self._map_arrow(os.path.join(version_dir, entry["file"]))
+                continue
+            values = mapped(entry["file"])
+            if entry["kind"] == "category":
+                categories = np.load(os.path.join(version_dir, entry["categories_file"]))
+                if categories.dtype.kind == "U":
+                    categories = categories.astype(object)
+                dtype = pd.CategoricalDtype(categories, ordered=entry["ordered"])
+                columns[entry["name"]] = pd.Categorical.from_codes(values, dtype=dtype)
+            elif entry["kind"] == "array":
+                columns[entry["name"]] = values
+            else:
+                columns[entry["name"]] = self._decode_objects(values, entry["values"], entry["kind"])
+        return pd.DataFrame(columns, index=pd.Index(mapped("index.npy")), copy=False)
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from instrumentation import count
+
+
+logger = logging.getLogger(__name__)
+
+FIGURE_CACHE_SIZE = 256
+
+# Bytes of figure JSON a chart, and all the charts of a page, may send to the
+# browser before a warning is logged
+CHART_BUDGET_ENV = "SUPERMARKET_CHART_BUDGET_BYTES"
+CHART_BUDGET_BYTES = 64_000
+PAGE_BUDGET_ENV = "SUPERMARKET_PAGE_BUDGET_BYTES"
+PAGE_BUDGET_BYTES = 256_000
+
+# Template layout settings that apply to the charts of the dashboard; the
+# rest of a template styles map, 3D, polar and ternary subplots
+TEMPLATE_LAYOUT_KEYS = ["colorway", "font", "hoverlabel", "hovermode", "paper_bgcolor", "title"]
+TEMPLATE_CARTESIAN_KEYS = ["autotypenumbers", "plot_bgcolor", "xaxis", "yaxis"]
+CARTESIAN_TRACES = {"bar", "scatter", "scattergl", "histogram", "box", "violin"}
+# Trace values are sent with this many significant digits, more than a chart or its hover label shows
+FIGURE_SIGNIFICANT_DIGITS = 7
+MIDNIGHT = re.compile(r"^(\d{4}-\d{2}-\d{2})T00:00:00$")
+
+
+def budget(env, default):
+    value = os.environ.get(env)
+    return int(value) if value else default
+
+
+def compact_figure(figure):
+    """Returns a plotly Figure as a dict keeping only the template settings its traces use.
+
+    Plotly Express embeds the whole template in every figure, with defaults
+    for every trace type and subplot kind, which is most of the payload of an
+    aggregated chart. Only the defaults of the trace types present, and the
+    cartesian axes settings when there are cartesian traces, are kept. Trace
+    values are shortened: floats to FIGURE_SIGNIFICANT_DIGITS and midnight
+    timestamps to dates.
+    """
+    spec = json.loads(figure.to_json())
+    spec["data"] = [_compact_values(trace) for trace in spec.get("data", [])]
+    template = spec.get("layout", {}).get("template")
+    if template:
+        trace_types = {trace.get("type", "scatter") for trace in spec.get("data", [])}
+        keys = TEMPLATE_LAYOUT_KEYS + (TEMPLATE_CARTESIAN_KEYS if trace_types & CARTESIAN_TRACES else [])
+        spec["layout"]["template"] = {
+            "data": {name: value for name, value in template.get("data", {}).items() if name in trace_types},
+            "layout": {name: value for name, value in template.get("layout", {}).items() if name in keys},
+        }
+    return spec
+
+
+def _compact_values(value):
+    if isinstance(value, dict):
+        return {name: _compact_values(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_compact_values(item) for item in value]
+    if isinstance(value, float):
+        return float(f"{value:.{FIGURE_SIGNIFICANT_DIGITS}g}")
+    if isinstance(value, str):
+        match = MIDNIGHT.match(value)
+        return match.group(1) if match else value
+    return value
+
+
+def figure_bytes(spec):
+    return len(json.dumps(spec, separators=(",", ":")))
+
+
+class PayloadBudget:
+    """Class adding up the bytes of the figures a page sends, against per chart and per page budgets.
+
+    Exceeding a budget is logged, not enforced: it means a chart sends data
+    that grows with the rows rather than pre-aggregated traces.
+    """
+
+    def __init__(self, chart_budget=None, page_budget=None):
+        self.chart_budget = budget(CHART_BUDGET_ENV, CHART_BUDGET_BYTES) if chart_budget is None else chart_budget
+        self.page_budget = budget(PAGE_BUDGET_ENV, PAGE_BUDGET_BYTES) if page_budget is None else page_budget
+        self.charts = {}
+
+    @property
+    def total(self):
+        return sum(self.charts.values())
+
+    def add(self, name, spec):
+        """Records the size of a chart's figure and returns it."""
+        size = figure_bytes(spec)
+        before = self.total
+        self.charts[name] = self.charts.get(name, 0) + size
+        count("figure.bytes", size)
+        if size > self.chart_budget:
+            logger.warning("Chart %s sends %d bytes, over its budget of %d", name, size, self.chart_budget)
+        if before <= self.page_budget < self.total:
+            logger.warning("The page's charts send %d bytes, over the budget of %d", self.total, self.page_budget)
+        return size
+
+
+class FigureCache:
+    """Class to keep finished Plotly figures as JSON, bounded with LRU eviction.
+
+    Keys are expected to identify everything a figure depends on, typically
+    (dataset version, filter signature, chart name). The cache is shared by all
+    sessions of the server process, so it is guarded by a lock.
+    """
+
+    def __init__(self, max_entries=FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_build(self, key, build):
+        """Returns the cached figure for `key` as a dict, or builds, stores and returns it.
+
+        `build` is only called on a miss and must return a figure dict, e.g.
+        from `compact_figure`.
+        """
+        with self._lock:
+            figure_json = self._entries.get(key)
+            if figure_json is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(figure_json)
+            self.misses += 1
+
+        figure = build()
+        figure_json = json.dumps(figure)
+
+        with self._lock:
+            self._entries[key] = figure_json
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return figure
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, dataset_version):
+        """Drops the figures of a dataset version and of the partition sets read from it."""
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == dataset_version or str(key[0]).startswith(f"{dataset_version}-"):
+                    del self._entries[key]
+
+    def stats(self):
+        """Returns the hit, miss and eviction counters and the current size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
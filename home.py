@@ -1,6 +1,6 @@
 import streamlit as st
 
-from utils import DataLoader, SidebarFilter, Dashboard
+from utils import DATA_PATH, DataLoader, SidebarFilter, Dashboard
 
 
 TITLE_ICON = ":house:"
@@ -22,17 +22,14 @@ def app():
     st.markdown("This dashboard provides key insights into supermarket performance.")
     st.divider()
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     df_selection, selected_filters = sidebar_filter.filter_data()
 
     selected_cities = selected_filters['cities']
@@ -41,7 +38,8 @@ def app():
 
     st.markdown(f"### KPIs for {city_title}")
 
-    dashboard = Dashboard(df_selection)
+    dashboard = Dashboard(df_selection, sidebar_filter.aggregates())
+    dashboard.plan("display_kpis", "display_city_branch")
     dashboard.display_kpis()
 
     dashboard.display_city_branch(selected_filters)
@@ -0,0 +1,586 @@
+import datetime
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+
+
+logger = logging.getLogger(__name__)
+
+STREAMING_CHUNK_SIZE = 10_000
+# Cell texts read as missing values, like the default na_values of pd.read_excel
+NA_STRINGS = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+])
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Declarative description of the columns of the processed sales frame, compiled
+# into a vectorized pipeline by TransformPipeline:
+# - "type": the target representation. "category" columns get their sorted
+#   distinct values as categories unless an explicit order (a list) is given;
+#   "date" and "time" columns are parsed, with an optional "format" and "dayfirst".
+#   Money columns stay float64 so that totals and the KPIs shown on the Home
+#   page are not affected by float32 rounding.
+# - "derive": (source column, field) for columns computed from a parsed column.
+# - "required", "min", "max": validation rules; rows breaking one are dropped.
+SALES_COLUMNS = {
+    # Unique per row: a categorical would hold every ID once more next to its codes
+    "Invoice ID": {"type": "string", "required": True},
+    "Branch": {"type": "category", "required": True},
+    "City": {"type": "category", "required": True},
+    "Customer_type": {"type": "category"},
+    "Gender": {"type": "category"},
+    "Product line": {"type": "category"},
+    "Unit price": {"type": "float64", "min": 0},
+    "Quantity": {"type": "integer", "min": 1},
+    "Tax 5%": {"type": "float64", "min": 0},
+    "Total": {"type": "float64", "required": True, "min": 0},
+    "Date": {"type": "date", "dayfirst": True, "required": True},
+    "Time": {"type": "time", "format": "%H:%M:%S", "required": True},
+    "Payment": {"type": "category"},
+    "cogs": {"type": "float64", "min": 0},
+    "gross margin percentage": {"type": "float32"},
+    "gross income": {"type": "float64", "min": 0},
+    "Rating": {"type": "float32", "min": 0, "max": 10},
+    "hour": {"type": "int8", "derive": ("Time", "hour")},
+    "DayOfWeek": {"type": WEEKDAYS, "derive": ("Date", "weekday")},
+}
+
+# Target representation of every column of the processed sales frame, as used by
+# compact_frame and append_sorted
+SALES_SCHEMA = {
+    column: spec["type"] for column, spec in SALES_COLUMNS.items() if spec["type"] not in ("date", "time")
+}
+
+# Fields a parsed date or time column can derive, computed on its distinct values
+DERIVED_FIELDS = {
+    "hour": lambda parsed: parsed.hour,
+    "weekday": lambda parsed: parsed.dayofweek,
+}
+
+
+def parse_usecols(usecols):
+    """Converts an Excel column spec such as "B:R" or "A,C:E" to 1-based column indices."""
+    indices = []
+    for part in usecols.replace(" ", "").split(","):
+        if ":" in part:
+            first, last = part.split(":")
+            indices.extend(range(column_index_from_string(first), column_index_from_string(last) + 1))
+        else:
+            indices.append(column_index_from_string(part))
+    return indices
+
+
+def string_dtype():
+    """Returns the dtype of "string" columns: Arrow-backed strings, which take a few
+    bytes per value and can be memory-mapped (see data_store.MappedColumns), or
+    Python strings without pyarrow."""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return np.dtype(object)
+    return pd.StringDtype("pyarrow")
+
+
+def compact_frame(df, schema=SALES_SCHEMA):
+    """Converts the columns of `df` to the compact types declared in `schema`.
+
+    Returns the compacted frame and a memory report with the deep size in bytes
+    and the resulting type of every column. Columns that are not in the schema
+    are left untouched; keys declared as "string", such as Invoice ID, are kept
+    as strings (see string_dtype) since a categorical of unique values is larger.
+    """
+    before = df.memory_usage(deep=True, index=False)
+    compacted = df.copy()
+
+    for column, target in schema.items():
+        if column not in compacted.columns:
+            continue
+        values = compacted[column]
+        if isinstance(target, list):
+            compacted[column] = pd.Categorical(values, categories=target, ordered=True)
+        elif target == "category" and not isinstance(values.dtype, pd.CategoricalDtype):
+            # One hashing pass gives both the sorted categories and the codes
+            codes, categories = pd.factorize(values, sort=True)
+            compacted[column] = pd.Categorical.from_codes(codes, categories=categories, ordered=True)
+        elif target == "category":
+            categories = sorted(values.dropna().unique())
+            compacted[column] = pd.Categorical(values, categories=categories, ordered=True)
+        elif target == "integer":
+            compacted[column] = pd.to_numeric(values, downcast="integer")
+        elif target == "string":
+            compacted[column] = values.astype(string_dtype())
+        else:
+            compacted[column] = values.astype(target)
+
+    after = compacted.memory_usage(deep=True, index=False)
+    report = {
+        "bytes_before": int(before.sum()),
+        "bytes_after": int(after.sum()),
+        "columns": {
+            column: {
+                "before": int(before[column]),
+                "after": int(after[column]),
+                "type": str(compacted[column].dtype),
+            }
+            for column in compacted.columns
+        },
+    }
+    logger.info(
+        "Compacted sales frame from %.1f MB to %.1f MB",
+        report["bytes_before"] / 1e6,
+        report["bytes_after"] / 1e6,
+    )
+    return compacted, report
+
+
+def freeze_frame(df):
+    """Returns `df` over read-only views of its column arrays, without copying them.
+
+    Frames shared by every session are frozen, so an in-place write raises
+    instead of changing the data other sessions see. Object columns are left
+    writable, as some pandas routines cannot read them otherwise. Arrow string
+    columns are kept as they are: their buffers are immutable, but a write
+    swaps the column's buffers instead of raising, so they are not protected
+    either.
+    """
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Categorical.codes is already a read-only view
+            columns[column] = pd.Categorical.from_codes(values.cat.codes.to_numpy(), dtype=values.dtype)
+        elif isinstance(values.dtype, pd.StringDtype):
+            columns[column] = values.array
+        else:
+            array = values.to_numpy()
+            if array.dtype != object:
+                array.flags.writeable = False
+            columns[column] = array
+    frozen = pd.DataFrame(columns, index=df.index, copy=False)
+    frozen.attrs = df.attrs
+    return frozen
+
+
+def parse_unique(values, parse):
+    """Applies `parse` to every distinct value of `values` once.
+
+    Returns the distinct parsed values and the code of every row into them,
+    -1 for missing values. Sales repeat a few hundred dates and times over
+    any number of rows, so this parses a handful of values instead of a
+    string per row.
+    """
+    codes, uniques = pd.factorize(values)
+    return parse(pd.Index(uniques)), codes
+
+
+def take_codes(uniques, codes, missing):
+    """Maps per-row `codes` from parse_unique back to values, `missing` for -1."""
+    return np.append(np.asarray(uniques), np.array([missing], dtype=np.asarray(uniques).dtype))[codes]
+
+
+class TransformPipeline:
+    """Class compiling a column specification such as SALES_COLUMNS into the
+    processing of a frame as read from a workbook or CSV.
+
+    The stages run in order: parse (dates and times, each distinct value once),
+    derive (hour and weekday as integer codes, from the parsed distinct
+    values), validate (rows breaking a rule are dropped and counted), sort
+    and compact (the types of `compact_frame`). `run` reports the time and
+    the throughput of every stage.
+    """
+
+    STAGES = ["parse", "derive", "validate", "sort", "compact"]
+
+    def __init__(self, columns, sort_by=None):
+        self.columns = columns
+        self.sort_by = sort_by
+        self.parsed = {name: spec for name, spec in columns.items() if spec["type"] in ("date", "time")}
+        self.derived = {name: spec for name, spec in columns.items() if "derive" in spec}
+        self.schema = {
+            name: spec["type"] for name, spec in columns.items() if spec["type"] not in ("date", "time")
+        }
+
+    def run(self, df):
+        """Returns the processed frame and a report with rows per second of every stage."""
+        state = {"df": df, "parsed": {}, "invalid": {}, "memory": None}
+        stages = []
+        for stage in self.STAGES:
+            rows = len(state["df"])
+            start = time.perf_counter()
+            getattr(self, f"_{stage}")(state)
+            seconds = time.perf_counter() - start
+            stages.append({
+                "stage": stage,
+                "rows": rows,
+                "seconds": round(seconds, 6),
+                "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+            })
+            logger.debug("Pipeline stage %s: %d rows in %.4fs", stage, rows, seconds)
+
+        report = {
+            "rows_in": len(df),
+            "rows_out": len(state["df"]),
+            "rows_dropped": len(df) - len(state["df"]),
+            "invalid_rows": state["invalid"],
+            "stages": stages,
+            "memory": state["memory"],
+        }
+        if state["invalid"]:
+            logger.warning("Dropped %d invalid rows: %s", report["rows_dropped"], state["invalid"])
+        return state["df"], report
+
+    @staticmethod
+    def _parse_date(spec):
+        def parse(uniques):
+            if pd.api.types.is_datetime64_any_dtype(uniques):
+                return pd.DatetimeIndex(uniques)
+            return pd.DatetimeIndex(pd.to_datetime(
+                uniques, format=spec.get("format"), dayfirst=spec.get("dayfirst", False), errors="coerce"
+            ))
+        return parse
+
+    @staticmethod
+    def _parse_time(spec):
+        def parse(uniques):
+            # Workbook cells hold datetime.time values, CSV files strings; both print as the format
+            return pd.DatetimeIndex(pd.to_datetime(
+                uniques.astype(str), format=spec.get("format"), errors="coerce"
+            ))
+        return parse
+
+    def _parse(self, state):
+        df = state["df"].copy()
+        for name, spec in self.parsed.items():
+            if name not in df.columns:
+                continue
+            if spec["type"] == "date":
+                parsed, codes = parse_unique(df[name], self._parse_date(spec))
+                df[name] = take_codes(parsed.to_numpy(dtype="datetime64[ns]"), codes, np.datetime64("NaT"))
+            else:
+                parsed, codes = parse_unique(df[name], self._parse_time(spec))
+                # Times of day are kept as the datetime.time values the workbook holds
+                times = np.array([None if pd.isna(value) else value.time() for value in parsed], dtype=object)
+                df[name] = take_codes(times, codes, None)
+            state["parsed"][name] = (parsed, codes)
+        state["df"] = df
+
+    def _derive(self, state):
+        df = state["df"]
+        for name, spec in self.derived.items():
+            source, field = spec["derive"]
+            if source not in state["parsed"]:
+                continue
+            parsed, codes = state["parsed"][source]
+            values = np.asarray(DERIVED_FIELDS[field](parsed))
+            if isinstance(spec["type"], list):
+                # Codes into the declared categories, e.g. 0 for Monday; values
+                # that did not parse are NaN and get no category
+                values = np.where(np.isnan(values), -1, values)
+                df[name] = pd.Categorical.from_codes(
+                    take_codes(values.astype("int8"), codes, -1),
+                    dtype=pd.CategoricalDtype(spec["type"], ordered=True),
+                )
+            else:
+                df[name] = take_codes(values.astype("float64"), codes, np.nan)
+
+    def _validate(self, state):
+        df = state["df"]
+        valid = np.ones(len(df), dtype=bool)
+        for name, spec in self.columns.items():
+            if name not in df.columns:
+                continue
+            values = df[name]
+            checks = []
+            if spec.get("required"):
+                checks.append(("missing", values.isna().to_numpy()))
+            if "min" in spec:
+                checks.append((f"below {spec['min']}", (values < spec["min"]).to_numpy()))
+            if "max" in spec:
+                checks.append((f"above {spec['max']}", (values > spec["max"]).to_numpy()))
+            for rule, failed in checks:
+                num_failed = int(failed.sum())
+                if num_failed:
+                    state["invalid"][f"{name}: {rule}"] = num_failed
+                    valid &= ~failed
+        if not valid.all():
+            state["df"] = df[valid]
+
+    def _sort(self, state):
+        if self.sort_by is not None and self.sort_by in state["df"].columns:
+            state["df"] = state["df"].sort_values(by=self.sort_by, kind="stable")
+
+    def _compact(self, state):
+        state["df"], state["memory"] = compact_frame(state["df"], self.schema)
+
+
+SALES_PIPELINE = TransformPipeline(SALES_COLUMNS, sort_by="Date")
+
+
+def _align_dtypes(store, rows, schema):
+    """Gives `rows` the column types of `store`, widening the store where needed.
+
+    Categorical columns declared as "category" get the new values appended
+    after their categories, so the codes of the stored rows stay valid and are
+    not remapped; columns with a fixed category order keep it.
+    """
+    store = store.copy(deep=False)
+    rows = rows.copy()
+    for column in store.columns:
+        if column not in rows.columns:
+            continue
+        dtype = store[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = dtype.categories
+            if not isinstance(schema.get(column), list):
+                extra = pd.Index(rows[column].dropna().unique()).difference(categories)
+                if len(extra):
+                    store[column] = store[column].cat.add_categories(extra)
+                    categories = store[column].dtype.categories
+            rows[column] = pd.Categorical(rows[column], categories=categories, ordered=dtype.ordered)
+        elif isinstance(dtype, pd.StringDtype):
+            rows[column] = rows[column].astype(dtype)
+        elif dtype != rows[column].dtype:
+            common = np.result_type(dtype, rows[column].dtype)
+            store[column] = store[column].astype(common)
+            rows[column] = rows[column].astype(common)
+    return store, rows[store.columns]
+
+
+def append_sorted(store, rows, key="Invoice ID", date_column="Date", schema=SALES_SCHEMA):
+    """Merges new processed rows into `store`, a frame sorted by `date_column`.
+
+    Rows whose `key` is already in the store, or repeated within `rows`, are
+    dropped. Rows dated after the store's watermark (its latest date) are
+    appended at the end; late rows are inserted after the stored rows of the
+    same date, so the existing rows are never re-sorted.
+
+    Returns the merged frame and the ascending positions of the added rows in it.
+    """
+    if isinstance(store[key].dtype, pd.CategoricalDtype):
+        existing = store[key].cat.categories
+    else:
+        existing = store[key].unique()
+    rows = rows.drop_duplicates(subset=key, keep="first")
+    rows = rows[~rows[key].isin(existing)].sort_values(by=date_column, kind="stable")
+    if rows.empty:
+        return store, np.array([], dtype="int64")
+
+    store, rows = _align_dtypes(store, rows, schema)
+    num_stored = len(store)
+    start = store.index.max() + 1 if num_stored else 0
+    rows.index = pd.RangeIndex(start, start + len(rows))
+    merged = pd.concat([store, rows])
+
+    watermark = store[date_column].iloc[-1] if num_stored else None
+    if watermark is None or rows[date_column].iloc[0] >= watermark:
+        positions = np.arange(num_stored, len(merged))
+    else:
+        insert_at = store[date_column].searchsorted(rows[date_column], side="right")
+        order = np.insert(np.arange(num_stored), insert_at, np.arange(num_stored, len(merged)))
+        merged = merged.take(order)
+        positions = np.flatnonzero(order >= num_stored)
+
+    merged.attrs = {}
+    return merged, positions
+
+
+class _ColumnBuilder:
+    """Accumulates one column chunk by chunk as typed arrays.
+
+    Numbers and datetimes are stored as numpy arrays. Everything else (text,
+    times of day) is dictionary encoded: every distinct value is kept once and
+    each row only stores an int32 code, so repeated values such as city names
+    cost four bytes per row while reading. A number or datetime column that
+    meets a value of another type is converted to the dictionary encoding, so
+    it comes out as an object column like `pd.read_excel` gives. Texts in
+    NA_STRINGS are read as blanks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.kind = None
+        self.all_int = True
+        self.chunks = []
+        self.dictionary = {}
+
+    def _infer_kind(self, values):
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                return "object"
+            if isinstance(value, (int, float)):
+                return "number"
+            if isinstance(value, datetime.datetime):
+                return "datetime"
+            return "object"
+        return None
+
+    def _fits(self, values):
+        """Tells whether `values` can be stored in the numpy arrays of a number or datetime column."""
+        if self.kind == "number":
+            return all(
+                value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+                for value in values
+            )
+        if self.kind == "datetime":
+            return all(value is None or isinstance(value, datetime.datetime) for value in values)
+        return True
+
+    def _to_objects(self):
+        """Converts the chunks read so far to dictionary codes of their values."""
+        chunks = self.chunks
+        self.chunks = []
+        kind, self.kind = self.kind, "object"
+        for chunk in chunks:
+            if isinstance(chunk, tuple):
+                self.append((None,) * chunk[1])
+            elif kind == "number":
+                self.append(tuple(
+                    None if np.isnan(value) else int(value) if self.all_int else float(value) for value in chunk
+                ))
+            else:
+                self.append(tuple(None if pd.isna(value) else pd.Timestamp(value).to_pydatetime() for value in chunk))
+
+    def append(self, values):
+        values = tuple(None if isinstance(value, str) and value in NA_STRINGS else value for value in values)
+        if self.kind is None:
+            self.kind = self._infer_kind(values)
+            if self.kind is None:
+                # Nothing but blanks so far; keep them until a value shows up.
+                self.chunks.append(("blank", len(values)))
+                return
+        if not self._fits(values):
+            self._to_objects()
+
+        if self.kind == "number":
+            if self.all_int:
+                self.all_int = all(isinstance(v, int) for v in values)
+            array = np.array([np.nan if v is None else v for v in values], dtype="float64")
+        elif self.kind == "datetime":
+            array = pd.to_datetime(pd.Series(values, dtype="object")).to_numpy()
+        else:
+            codes = self.dictionary
+            array = np.fromiter(
+                (codes.setdefault(v, len(codes)) for v in values),
+                dtype="int32",
+                count=len(values),
+            )
+        self.chunks.append(array)
+
+    def _blank(self, length):
+        if self.kind == "number":
+            return np.full(length, np.nan)
+        if self.kind == "datetime":
+            return np.full(length, np.datetime64("NaT"), dtype="datetime64[ns]")
+        return np.full(length, self.dictionary.setdefault(None, len(self.dictionary)), dtype="int32")
+
+    def finish(self):
+        """Concatenates the chunks into the final column."""
+        if self.kind is None:
+            self.kind = "object"
+        arrays = [
+            self._blank(chunk[1]) if isinstance(chunk, tuple) else chunk
+            for chunk in self.chunks
+        ]
+        self.chunks = []
+        values = np.concatenate(arrays) if arrays else np.array([], dtype="float64")
+
+        if self.kind == "number":
+            if self.all_int and not np.isnan(values).any():
+                return pd.Series(values.astype("int64"), name=self.name)
+            return pd.Series(values, name=self.name)
+        if self.kind == "datetime":
+            return pd.Series(values, name=self.name, dtype="datetime64[ns]")
+
+        lookup = np.empty(len(self.dictionary), dtype="object")
+        for value, code in self.dictionary.items():
+            lookup[code] = value
+        self.dictionary = {}
+        return pd.Series(lookup[values.astype("intp")], name=self.name, dtype="object")
+
+
+class StreamingExcelReader:
+    """Class to read a worksheet row by row in openpyxl read-only mode.
+
+    Rows are converted into typed arrays every `chunk_size` rows, so only one
+    chunk of Python cell values is alive at any time regardless of how many rows
+    the sheet has. The result matches `pd.read_excel` for the same arguments,
+    except that completely blank rows are dropped.
+    """
+
+    def __init__(self, path, sheet_name, skiprows=0, usecols=None, nrows=None,
+                 chunk_size=STREAMING_CHUNK_SIZE, progress_callback=None):
+        self.path = path
+        self.sheet_name = sheet_name
+        self.skiprows = skiprows
+        self.usecols = usecols
+        self.nrows = nrows
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+
+    def _report_progress(self, rows_read, total_rows):
+        if self.progress_callback is not None:
+            self.progress_callback(rows_read, total_rows)
+
+    def read(self):
+        """Reads the sheet and returns it as a dataframe."""
+        workbook = load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook[self.sheet_name]
+
+            if self.usecols:
+                columns = parse_usecols(self.usecols)
+            else:
+                columns = list(range(1, (worksheet.max_column or 0) + 1))
+            min_col, max_col = min(columns), max(columns)
+            offsets = [col - min_col for col in columns]
+
+            header_row = self.skiprows + 1
+            rows = worksheet.iter_rows(
+                min_row=header_row, min_col=min_col, max_col=max_col, values_only=True
+            )
+            header = next(rows, None)
+            if header is None:
+                return pd.DataFrame()
+            names = [header[offset] for offset in offsets]
+            builders = [_ColumnBuilder(name) for name in names]
+
+            total_rows = None
+            if worksheet.max_row is not None:
+                total_rows = max(worksheet.max_row - header_row, 0)
+                if self.nrows is not None:
+                    total_rows = min(total_rows, self.nrows)
+
+            rows_read = 0
+            chunk = []
+            for row in rows:
+                if self.nrows is not None and rows_read + len(chunk) >= self.nrows:
+                    break
+                values = tuple(row[offset] if offset < len(row) else None for offset in offsets)
+                if all(value is None for value in values):
+                    continue
+                chunk.append(values)
+                if len(chunk) == self.chunk_size:
+                    rows_read += self._flush(chunk, builders)
+                    self._report_progress(rows_read, total_rows)
+                    chunk = []
+            if chunk:
+                rows_read += self._flush(chunk, builders)
+            self._report_progress(rows_read, rows_read)
+        finally:
+            workbook.close()
+
+        return pd.concat([builder.finish() for builder in builders], axis=1)
+
+    @staticmethod
+    def _flush(chunk, builders):
+        for builder, values in zip(builders, zip(*chunk)):
+            builder.append(values)
+        return len(chunk)
@@ -0,0 +1,232 @@
+"""Opt-in timing spans and allocation counters for the hot path of a page rerun.
+
+Instrumentation is off unless the SUPERMARKET_PROFILE environment variable is
+set. With SUPERMARKET_PROFILE=1 every span records its wall time; with
+SUPERMARKET_PROFILE=memory it also records the bytes allocated through
+tracemalloc, which slows Python code down noticeably, so timings taken in that
+mode are inflated. When SUPERMARKET_PROFILE_LOG names a file, the spans of every
+rerun are appended to it as JSON lines.
+
+Summarize an exported log per stage with:
+    python instrumentation.py logs/profile.jsonl
+"""
+import contextlib
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+PROFILE_ENV = "SUPERMARKET_PROFILE"
+PROFILE_LOG_ENV = "SUPERMARKET_PROFILE_LOG"
+
+# Reruns kept per session for the percentiles of the debug panel
+PROFILE_HISTORY_SIZE = 200
+
+# Streamlit runs every script run of a session in its own thread
+_active = threading.local()
+_log_lock = threading.Lock()
+
+
+def profile_mode():
+    """Returns None when instrumentation is off, "time" or "memory" otherwise."""
+    value = os.environ.get(PROFILE_ENV, "").strip().lower()
+    if value in ("", "0", "false", "off"):
+        return None
+    return "memory" if value == "memory" else "time"
+
+
+class RerunProfile:
+    """Class collecting the spans and counters of one script run.
+
+    Spans nest: a span's `seconds` include its children while `self_seconds`
+    only count the time spent outside of them, so the self times of a rerun
+    add up to its total. Allocation counters are only filled with
+    `track_memory`; tracemalloc traces the whole process, so with several
+    sessions rerunning at once they include the others' allocations.
+    """
+
+    def __init__(self, page, session_id=None, track_memory=False):
+        self.page = page
+        self.session_id = session_id
+        self.track_memory = track_memory
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self._stack = []
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        parent = self._stack[-1] if self._stack else None
+        frame = {"children": 0.0, "peak": 0}
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent["peak"] = max(parent["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["memory"] = current
+            frame["peak"] = current
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            record = {
+                "stage": stage,
+                "depth": len(self._stack),
+                "seconds": seconds,
+                "self_seconds": seconds - frame["children"],
+            }
+            if self.track_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(frame["peak"], peak)
+                record["allocated_bytes"] = current - frame["memory"]
+                record["peak_bytes"] = peak - frame["memory"]
+                if parent is not None:
+                    parent["peak"] = max(parent["peak"], peak)
+            if parent is not None:
+                parent["children"] += seconds
+            self.spans.append(record)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def records(self):
+        """Returns the spans as flat dicts, ready to be written as JSON lines."""
+        context = {"started": self.started, "session_id": self.session_id, "page": self.page}
+        records = [{**context, **span} for span in self.spans]
+        if self.counters:
+            records.append({**context, "stage": "counters", "counters": dict(self.counters)})
+        return records
+
+    def total_seconds(self):
+        return sum(span["seconds"] for span in self.spans if span["depth"] == 0)
+
+
+def start_rerun(page, session_id=None):
+    """Starts profiling the current script run, or returns None when instrumentation is off."""
+    mode = profile_mode()
+    if mode is None:
+        return None
+    if mode == "memory" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    profile = RerunProfile(page, session_id, track_memory=(mode == "memory"))
+    _active.profile = profile
+    return profile
+
+
+def finish_rerun():
+    """Stops profiling the current script run and exports its spans if a log file is set."""
+    profile = getattr(_active, "profile", None)
+    _active.profile = None
+    if profile is not None and os.environ.get(PROFILE_LOG_ENV):
+        append_jsonl(profile.records(), os.environ[PROFILE_LOG_ENV])
+    return profile
+
+
+def span(stage):
+    """Returns a context manager timing `stage` in the current rerun; a no-op when not profiling."""
+    profile = getattr(_active, "profile", None)
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.span(stage)
+
+
+def count(name, amount=1):
+    """Adds to a counter of the current rerun; a no-op when not profiling."""
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.count(name, amount)
+
+
+def timed(stage):
+    """Decorator running the wrapped function inside a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def to_jsonl(records):
+    return "".join(json.dumps(record, default=str) + "\n" for record in records)
+
+
+def append_jsonl(records, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _log_lock, open(path, "a") as f:
+        f.write(to_jsonl(records))
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(math.ceil(q / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(records):
+    """Returns per-stage call counts, p50/p99 of total and self time, and mean allocations.
+
+    Spans of the same stage within one rerun are added up first, so a stage
+    entered once per chart is summarized per rerun rather than per call.
+    """
+    per_rerun = {}
+    for record in records:
+        if record.get("stage") == "counters":
+            continue
+        key = (record["stage"], record.get("session_id"), record.get("started"))
+        totals = per_rerun.setdefault(key, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0, "allocated_bytes": None})
+        totals["calls"] += 1
+        totals["seconds"] += record["seconds"]
+        totals["self_seconds"] += record["self_seconds"]
+        if "allocated_bytes" in record:
+            totals["allocated_bytes"] = (totals["allocated_bytes"] or 0) + record["allocated_bytes"]
+
+    stages = {}
+    for (stage, _, _), totals in per_rerun.items():
+        stages.setdefault(stage, []).append(totals)
+
+    summary = []
+    for stage, reruns in stages.items():
+        seconds = sorted(totals["seconds"] for totals in reruns)
+        self_seconds = sorted(totals["self_seconds"] for totals in reruns)
+        allocated = [totals["allocated_bytes"] for totals in reruns if totals["allocated_bytes"] is not None]
+        summary.append({
+            "stage": stage,
+            "reruns": len(reruns),
+            "calls": sum(totals["calls"] for totals in reruns),
+            "p50_ms": round(percentile(seconds, 50) * 1000, 2),
+            "p99_ms": round(percentile(seconds, 99) * 1000, 2),
+            "self_p50_ms": round(percentile(self_seconds, 50) * 1000, 2),
+            "self_p99_ms": round(percentile(self_seconds, 99) * 1000, 2),
+            "mean_allocated_kib": round(sum(allocated) / len(allocated) / 1024, 1) if allocated else None,
+        })
+    return sorted(summary, key=lambda row: row["p50_ms"], reverse=True)
+
+
+def main():
+    if len(sys.argv) != 2:
+        raise SystemExit(__doc__)
+    with open(sys.argv[1]) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{'stage':<28} {'reruns':>7} {'calls':>7} {'p50 ms':>10} {'p99 ms':>10} "
+          f"{'self p50':>10} {'self p99':>10} {'alloc KiB':>10}")
+    for row in summarize(records):
+        allocated = "" if row["mean_allocated_kib"] is None else f"{row['mean_allocated_kib']:.1f}"
+        print(f"{row['stage']:<28} {row['reruns']:>7} {row['calls']:>7} {row['p50_ms']:>10.2f} "
+              f"{row['p99_ms']:>10.2f} {row['self_p50_ms']:>10.2f} {row['self_p99_ms']:>10.2f} {allocated:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,26 @@ from nav_menu import MultiApp
 PAGE_ICON = ":department_store:"
 LAYOUT = "wide"
 
+# (title, module, icon) of every page, in menu order
+PAGES = [
+    ("Home", "home", "house-fill"),
+    ("About", "about", "chat-fill"),
+    ("Sales", "sales", "cash"),
+    ("Rating", "rating", "star"),
+    ("Transactions", "transaction", "list"),
+    ("Contact", "contact", "envelope"),
+]
+
 
 def main():
 
     # Configuration of Streamlit page
     st.set_page_config(page_title="Supermarket Analytics", page_icon=PAGE_ICON, layout=LAYOUT)
 
-    MultiApp.run() 
+    app = MultiApp()
+    for title, module, icon in PAGES:
+        app.add_app(title, module, icon)
+    app.run()
 
 
 if __name__ == "__main__":
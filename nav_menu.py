@@ -1,26 +1,76 @@
+import importlib
+import logging
+import sys
+import time
+from collections import deque
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from streamlit_option_menu import option_menu
-import home, about, sales, rating, transaction, contact
 
+from instrumentation import PROFILE_HISTORY_SIZE, finish_rerun, span, start_rerun, summarize, to_jsonl
+
+
+logger = logging.getLogger(__name__)
+
+# Heavy libraries the pages pull in, imported one by one before the first page
+# so that the startup report shows what each of them costs.
+PAGE_DEPENDENCIES = ["numpy", "pandas", "plotly.express", "streamlit_shadcn_ui", "utils"]
+
+# Seconds spent importing each module, in import order, for this process
+IMPORT_TIMINGS = {}
+
+
+def timed_import(name):
+    """Imports a module, recording how long the first import took."""
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMINGS[name] = time.perf_counter() - start
+    logger.info("Imported %s in %.3fs", name, IMPORT_TIMINGS[name])
+    return module
+
+
+def startup_report():
+    """Returns the import cost per module, most expensive first."""
+    return sorted(IMPORT_TIMINGS.items(), key=lambda item: item[1], reverse=True)
 
 
 class MultiApp:
+    """Class to register the pages and lazily run the selected one.
+
+    Pages are registered by module name. A page module, and with it pandas,
+    plotly and the other page dependencies, is only imported the first time
+    its page is selected.
+    """
 
     def __init__(self):
         self.apps=[]
 
-    def add_app(self, title, function):
+    def add_app(self, title, module, icon=None):
         self.apps.append({
             "title":title,
-            "function": function
+            "module": module,
+            "icon": icon,
         })
 
-    def run():
+    def load_app(self, title):
+        """Imports the page module registered under `title` and returns its app function."""
+        app = next(app for app in self.apps if app["title"] == title)
+        with span("import"):
+            if app["module"] not in sys.modules:
+                for dependency in PAGE_DEPENDENCIES:
+                    timed_import(dependency)
+            return timed_import(app["module"]).app
+
+    def run(self):
         app = option_menu(
-        menu_title=None, 
-        options=["Home", "About", "Sales", "Rating", "Transactions", "Contact"], 
-        icons=["house-fill", "chat-fill", "cash", "star", "list", "envelope"],  
+        menu_title=None,
+        options=[app["title"] for app in self.apps],
+        icons=[app["icon"] for app in self.apps],
         menu_icon="cast",
-        default_index=0, 
+        default_index=0,
         orientation="horizontal",
         styles={"container": {"padding":"5!important", "background-color": 'blue'},
                 "icon": {"color":"white", "font-size": "20px"},
@@ -28,15 +78,40 @@ class MultiApp:
                 "nav-link-selected": {"background-color": "#02ab21"},}
     )
 
-        if app == "Home":
-            home.app()
-        if app == "About":
-            about.app()        
-        if app == "Sales":
-            sales.app()            
-        if app == "Rating":
-            rating.app()  
-        if app == "Transactions":
-            transaction.app()   
-        if app == "Contact":
-            contact.app() 
\ No newline at end of file
+        if app is not None:
+            ctx = get_script_run_ctx()
+            profile = start_rerun(app, ctx.session_id if ctx is not None else None)
+            try:
+                with span("rerun"):
+                    self.load_app(app)()
+            finally:
+                finish_rerun()
+                if profile is not None:
+                    self.show_profile(profile)
+
+    @staticmethod
+    def show_profile(profile):
+        """Displays the spans of this rerun and their percentiles over the session in the sidebar."""
+        history = st.session_state.setdefault("profile_history", deque(maxlen=PROFILE_HISTORY_SIZE))
+        history.append(profile.records())
+        session_records = [record for records in history for record in records]
+
+        with st.sidebar.expander("Performance", expanded=False):
+            st.caption(f"{profile.page}: {profile.total_seconds() * 1000:.1f} ms")
+            st.dataframe(summarize(profile.records()), hide_index=True)
+            if profile.counters:
+                st.json(profile.counters)
+            st.caption(f"Last {len(history)} reruns of this session")
+            st.dataframe(summarize(session_records), hide_index=True)
+            if IMPORT_TIMINGS:
+                st.caption("Import cost")
+                st.dataframe(
+                    [{"module": name, "seconds": round(seconds, 3)} for name, seconds in startup_report()],
+                    hide_index=True,
+                )
+            st.download_button(
+                "Download spans (JSON lines)",
+                to_jsonl(session_records),
+                file_name="profile.jsonl",
+                mime="application/jsonl",
+            )
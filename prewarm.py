@@ -0,0 +1,199 @@
+"""Starts the dashboard with its caches warmed in the background.
+
+While the server starts, a background thread imports every page, loads the
+data and builds what the pages show with the default filters, so the first
+visitor after a deploy does not pay for it. Readiness is exposed as a file
+and/or an HTTP endpoint for the load balancer:
+
+    SUPERMARKET_READY_FILE   path written with the warming report once ready
+    SUPERMARKET_READY_PORT   port answering GET /ready with 200 once ready, 503 before
+
+Usage:
+    SUPERMARKET_READY_PORT=8502 python prewarm.py [streamlit run options]
+"""
+import http.server
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+READY_FILE_ENV = "SUPERMARKET_READY_FILE"
+READY_PORT_ENV = "SUPERMARKET_READY_PORT"
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+PREWARM_THREAD_NAME = "prewarm"
+# Seconds to wait for the Streamlit runtime, whose caches the warmed results go to
+RUNTIME_WAIT_SECONDS = 60
+
+_prewarmer = None
+_prewarmer_lock = threading.Lock()
+
+
+class PrewarmThreadFilter(logging.Filter):
+    """Drops Streamlit's "missing ScriptRunContext" warnings of the prewarm thread,
+    which calls cached functions outside of any session on purpose."""
+
+    def filter(self, record):
+        return record.threadName != PREWARM_THREAD_NAME
+
+
+class Prewarmer:
+    """Class warming the caches of the default page views in a background thread.
+
+    `state` holds the status ("pending", "warming", "ready" or "failed") and
+    the seconds spent in each stage.
+    """
+
+    def __init__(self, ready_file=None, ready_port=None, wait_for_runtime=True):
+        self.ready_file = ready_file
+        self.ready_port = ready_port
+        self.wait_for_runtime = wait_for_runtime
+        self.state = {"status": "pending", "stages": {}}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server = None
+
+    @property
+    def ready(self):
+        return self.state["status"] == "ready"
+
+    def status(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def start(self):
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+        if self.ready_port:
+            self._server = ReadinessServer(("", int(self.ready_port)), self)
+            threading.Thread(target=self._server.serve_forever, name="readiness", daemon=True).start()
+            logger.info("Readiness endpoint listening on port %s", self.ready_port)
+        self._thread = threading.Thread(target=self.run, name=PREWARM_THREAD_NAME, daemon=True)
+        self._thread.start()
+        return self
+
+    def _stage(self, name, function):
+        start = time.perf_counter()
+        result = function()
+        with self._lock:
+            self.state["stages"][name] = round(time.perf_counter() - start, 4)
+        return result
+
+    def run(self):
+        with self._lock:
+            self.state.update(status="warming", started=time.time())
+        script_logger = logging.getLogger("streamlit.runtime.scriptrunner.script_run_context")
+        thread_filter = PrewarmThreadFilter()
+        script_logger.addFilter(thread_filter)
+        try:
+            if self.wait_for_runtime:
+                self._stage("runtime", wait_for_runtime)
+            self._stage("import", import_pages)
+            figures = self._stage("default_views", warm_pages)
+            with self._lock:
+                self.state.update(status="ready", finished=time.time(), figures=figures)
+            logger.info("Caches warmed in %.2fs: %s", self.state["finished"] - self.state["started"],
+                        self.state["stages"])
+            if self.ready_file:
+                write_ready_file(self.ready_file, self.status())
+        except Exception as error:
+            with self._lock:
+                self.state.update(status="failed", finished=time.time(), error=repr(error))
+            logger.exception("Warming the caches failed")
+        finally:
+            script_logger.removeFilter(thread_filter)
+
+
+class ReadinessServer(http.server.ThreadingHTTPServer):
+    """Class answering readiness probes with the state of a Prewarmer."""
+
+    daemon_threads = True
+
+    def __init__(self, address, prewarmer):
+        super().__init__(address, ReadinessHandler)
+        self.prewarmer = prewarmer
+
+
+class ReadinessHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/ready"):
+            self.send_error(404)
+            return
+        state = self.server.prewarmer.status()
+        body = json.dumps(state).encode()
+        self.send_response(200 if state["status"] == "ready" else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Readiness probe: " + format, *args)
+
+
+def wait_for_runtime(timeout=RUNTIME_WAIT_SECONDS):
+    """Waits until the Streamlit server runtime exists, so results land in the caches it serves."""
+    from streamlit.runtime import Runtime
+
+    deadline = time.monotonic() + timeout
+    while not Runtime.exists():
+        if time.monotonic() > deadline:
+            raise TimeoutError("The Streamlit runtime did not start")
+        time.sleep(0.1)
+
+
+def import_pages():
+    """Imports every page module of main.PAGES and their dependencies."""
+    from main import PAGES
+    from nav_menu import MultiApp
+
+    app = MultiApp()
+    for title, module, icon in PAGES:
+        app.add_app(title, module, icon)
+        app.load_app(title)
+
+
+def warm_pages():
+    from utils import DATA_PATH, DataLoader, warm_default_views
+
+    # The arguments every page passes to SidebarFilter.load
+    return warm_default_views(DataLoader(), DATA_PATH, "Sales", "B:R")
+
+
+def write_ready_file(path, state):
+    """Writes the readiness file atomically, so a probe never reads half of it."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+
+def start(ready_file=None, ready_port=None, wait_for_runtime=True):
+    """Starts warming once per process and returns the Prewarmer; readiness settings
+    default to the environment."""
+    global _prewarmer
+    with _prewarmer_lock:
+        if _prewarmer is None:
+            _prewarmer = Prewarmer(
+                ready_file or os.environ.get(READY_FILE_ENV),
+                ready_port or os.environ.get(READY_PORT_ENV),
+                wait_for_runtime,
+            ).start()
+        return _prewarmer
+
+
+def main():
+    from streamlit.web import cli
+
+    start()
+    sys.argv = ["streamlit", "run", MAIN_SCRIPT, *sys.argv[1:]]
+    sys.exit(cli.main())
+
+
+if __name__ == "__main__":
+    main()
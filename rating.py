@@ -1,5 +1,5 @@
 import streamlit as st
-from utils import DataLoader, SidebarFilter, Dashboard
+from utils import DATA_PATH, DataLoader, SidebarFilter, Dashboard
 
 TITLE_ICON = ":star:"
 HIDE_STREAMLIT_STYLE = """
@@ -16,20 +16,18 @@ def app():
 
     st.header("Customer Satisfaction Analysis")
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     df_selection, _ = sidebar_filter.filter_data()
 
-    dashboard = Dashboard(df_selection)
+    dashboard = Dashboard(df_selection, sidebar_filter.aggregates())
+    dashboard.plan("average_rating_by_branch", "plot_avg_rating_by_customer_type", "rating_vs_product_line")
 
     dashboard.average_rating_by_branch()
 
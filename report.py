@@ -0,0 +1,245 @@
+"""Writes a static HTML report of the dashboard for every city and branch.
+
+Each report holds the Home KPIs and the Sales, Rating and Transactions
+charts of one branch, built by Dashboard from the aggregate cube and the time
+rollups, without a Streamlit server. The data is loaded and the cube and
+rollups are built once in the parent process; the reports are then rendered
+by a pool of worker processes that get them pickled, and an index.html links
+them all.
+plotly.js is written once next to the reports, which link to it.
+
+Usage:
+    python report.py --output reports
+    python report.py --output reports --workers 4 --plotlyjs cdn
+"""
+import argparse
+import concurrent.futures
+import functools
+import html
+import logging
+import os
+import pickle
+import time
+import urllib.parse
+
+import plotly.io as pio
+import plotly.offline
+
+from aggregates import AggregateCube, parallel_workers, process_context, reset_worker_pool
+from figures import compact_figure
+from rollups import TimeRollups
+from utils import DATA_PATH, Dashboard, DataLoader
+
+
+logger = logging.getLogger(__name__)
+
+# Display methods whose aggregations a report uses, planned in one pass
+REPORT_AGGREGATIONS = [
+    "display_kpis",
+    "display_charts_sales",
+    "average_rating_by_branch",
+    "plot_avg_rating_dayofweek",
+    "plot_avg_rating_by_customer_type",
+    "rating_vs_product_line",
+    "transactions_by_branch",
+    "plot_transaction_by_dayofweek",
+    "transactions_vs_product_line",
+]
+# (section title, [(figure name, arguments)]) in page order
+REPORT_SECTIONS = [
+    ("Sales", [
+        ("product_sales", ()),
+        ("hourly_sales", ()),
+        ("daily_sales", ()),
+        ("branch_pie", ()),
+        ("payment_sales", ()),
+        ("gender_sales", ()),
+        ("sales_trend", ("week",)),
+    ]),
+    ("Rating", [
+        ("avg_rating_dayofweek", ()),
+        ("avg_rating_by_customer_type", ()),
+        ("rating_vs_product_line", ()),
+    ]),
+    ("Transactions", [
+        ("transaction_by_dayofweek", ()),
+        ("transactions_vs_product_line", ()),
+    ]),
+]
+# How the reports get plotly.js: the include_plotlyjs argument of plotly.io.to_html
+# for every --plotlyjs choice. "file" links to PLOTLYJS_FILE, written once.
+PLOTLYJS_FILE = "plotly.min.js"
+PLOTLYJS_MODES = {"file": PLOTLYJS_FILE, "cdn": "cdn", "inline": True}
+REPORT_STYLE = """
+body { font-family: sans-serif; margin: 2rem; }
+.kpis { display: flex; gap: 3rem; }
+.kpis p { margin: 0.2rem 0; }
+.kpis .value { font-size: 1.2rem; font-weight: bold; }
+"""
+
+# Cube and rollups of the process, built once and shared by every report
+_shared = None
+
+
+def load_shared(path, sheet_name, usecols, pickled=None):
+    """Loads the data and builds its cube and rollups, unless this process already has them.
+
+    Workers get them as `pickled`, the parent's structures pickled once, and
+    never load the data: the reports only read the cube and the rollups.
+    """
+    global _shared
+    if _shared is None and pickled is not None:
+        _shared = pickle.loads(pickled)
+    elif _shared is None:
+        df = DataLoader().read_dataset(path, sheet_name, usecols)
+        _shared = {"cube": AggregateCube.build(df), "rollups": TimeRollups(df)}
+        # The pool of a parallel cube build is not needed anymore
+        reset_worker_pool()
+    return _shared
+
+
+def combinations():
+    """Returns the (city, branch) pairs of the shared data, in order of appearance."""
+    dashboard = Dashboard(None, _shared["cube"].slice({}))
+    return [(city, branch) for city, branches in dashboard.branches_by_city().items() for branch in branches]
+
+
+def report_name(city, branch):
+    return f"{urllib.parse.quote(str(city), safe='')}_{urllib.parse.quote(str(branch), safe='')}.html"
+
+
+def render_report(city, branch, output, plotlyjs):
+    """Writes the report of one city and branch and returns what was written."""
+    start = time.perf_counter()
+    selections = {"City": [city], "Branch": [branch]}
+    dashboard = Dashboard(
+        None,
+        _shared["cube"].slice(selections),
+        functools.partial(_shared["rollups"].trend, selections=selections),
+    )
+    dashboard.plan(*REPORT_AGGREGATIONS)
+
+    kpis = dashboard.kpis()
+    ratings = dashboard.aggregates.aggregate(["Branch"], "Rating", "mean", sort=False)
+    transactions = dashboard.aggregates.aggregate(["Branch"], "Invoice ID", "nunique", sort=False)
+    kpi_cards = [
+        ("Total Sales", f"US $ {kpis['total_sales']:,}"),
+        ("Average Sales Per Transaction", f"US $ {kpis['average_sale_by_transaction']}"),
+        ("Average Rating", f"{kpis['average_rating']}/10.0"),
+        ("Gross Income", f"US $ {kpis['gross_income']}"),
+        ("Transactions", f"{int(transactions.sum()):,}"),
+    ]
+
+    parts = [
+        f"<h1>{html.escape(str(city))}, branch {html.escape(str(branch))}</h1>",
+        "<h2>KPIs</h2>",
+        '<div class="kpis">',
+        *(f'<div><p>{html.escape(title)}</p><p class="value">{html.escape(value)}</p></div>'
+          for title, value in kpi_cards),
+        "</div>",
+    ]
+    # plotly.js is linked (or embedded) once, before the first chart
+    include_plotlyjs = plotlyjs
+    for title, figures in REPORT_SECTIONS:
+        parts.append(f"<h2>{html.escape(title)}</h2>")
+        if title == "Rating":
+            parts.append(f"<p>Average rating: {ratings.iloc[0]:.2f}/10</p>")
+        for name, args in figures:
+            figure = compact_figure(getattr(dashboard, f"{name}_figure")(*args))
+            # Fixed element ids keep the reports of unchanged data byte for byte identical
+            parts.append(pio.to_html(figure, full_html=False, include_plotlyjs=include_plotlyjs,
+                                     div_id="-".join([name, *map(str, args)])))
+            include_plotlyjs = False
+
+    document = "\n".join([
+        "<!DOCTYPE html>",
+        '<html><head><meta charset="utf-8">',
+        f"<title>Supermarket report: {html.escape(str(city))} {html.escape(str(branch))}</title>",
+        f"<style>{REPORT_STYLE}</style></head><body>",
+        *parts,
+        "</body></html>",
+    ])
+    path = os.path.join(output, report_name(city, branch))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(document)
+    return {
+        "city": str(city),
+        "branch": str(branch),
+        "path": path,
+        "bytes": len(document.encode()),
+        "seconds": round(time.perf_counter() - start, 4),
+        "pid": os.getpid(),
+    }
+
+
+def write_index(output, reports):
+    rows = "\n".join(
+        f'<li><a href="{html.escape(os.path.basename(report["path"]))}">'
+        f'{html.escape(report["city"])}, branch {html.escape(report["branch"])}</a></li>'
+        for report in reports
+    )
+    with open(os.path.join(output, "index.html"), "w", encoding="utf-8") as f:
+        f.write(
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Supermarket reports</title>'
+            f"<style>{REPORT_STYLE}</style></head><body>\n"
+            f"<h1>Supermarket reports</h1>\n<p>Generated {time.strftime('%Y-%m-%d %H:%M')}</p>\n"
+            f"<ul>\n{rows}\n</ul>\n</body></html>\n"
+        )
+
+
+def generate(path, sheet_name, usecols, output, workers=None, plotlyjs="file"):
+    """Writes the report of every city and branch of the data into `output`, with `workers`
+    processes (parallel_workers() by default). `plotlyjs` is one of PLOTLYJS_MODES.
+    Returns what was written, in combination order."""
+    workers = parallel_workers() if workers is None else workers
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    load_shared(path, sheet_name, usecols)
+    pairs = combinations()
+    logger.info("Loaded the data in %.2fs, writing %d reports", time.perf_counter() - start, len(pairs))
+    if plotlyjs == "file":
+        with open(os.path.join(output, PLOTLYJS_FILE), "w", encoding="utf-8") as f:
+            f.write(plotly.offline.get_plotlyjs())
+    plotlyjs = PLOTLYJS_MODES[plotlyjs]
+
+    if workers < 2 or len(pairs) < 2:
+        reports = [render_report(city, branch, output, plotlyjs) for city, branch in pairs]
+    else:
+        # Workers are started like those of the cube build (see aggregates.process_context)
+        # and get the parent's cube and rollups pickled once
+        pickled = pickle.dumps(_shared, protocol=pickle.HIGHEST_PROTOCOL)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(pairs)),
+            mp_context=process_context(),
+            initializer=load_shared,
+            initargs=(path, sheet_name, usecols, pickled),
+        ) as pool:
+            futures = [pool.submit(render_report, city, branch, output, plotlyjs) for city, branch in pairs]
+            reports = [future.result() for future in futures]
+
+    write_index(output, reports)
+    logger.info("Wrote %d reports to %s in %.2fs", len(reports), output, time.perf_counter() - start)
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=DATA_PATH, help="Workbook to report on")
+    parser.add_argument("--sheet", default="Sales")
+    parser.add_argument("--usecols", default="B:R")
+    parser.add_argument("--output", default="reports", help="Directory the HTML files are written to")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: the CPUs available, or SUPERMARKET_WORKERS)")
+    parser.add_argument("--plotlyjs", choices=list(PLOTLYJS_MODES), default="file",
+                        help=f"Link every report to {PLOTLYJS_FILE} written next to them, "
+                             "load plotly.js from a CDN, or embed it in every report")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    reports = generate(args.data, args.sheet, args.usecols, args.output, args.workers, args.plotlyjs)
+    for report in reports:
+        print(f"{report['path']}  {report['bytes'] / 1e3:,.1f} kB  {report['seconds'] * 1e3:,.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import streamlit as st
-from utils import DataLoader, SidebarFilter, Dashboard
+from utils import DATA_PATH, DataLoader, SidebarFilter, Dashboard
 
 
 # Constants for styling and page configuration
@@ -15,17 +15,14 @@ HIDE_STREAMLIT_STYLE = """
 
 def app():
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     df_selection, selected_filters = sidebar_filter.filter_data()
 
     selected_cities = selected_filters['cities']
@@ -36,8 +33,12 @@ def app():
     st.header(f"Sales Analysis for {city_title}")
 
     # Display dashboard
-    dashboard = Dashboard(df_selection)
+    dashboard = Dashboard(df_selection, sidebar_filter.aggregates(), sidebar_filter.trends())
+    dashboard.plan("display_charts_sales", "display_sales_trend")
     dashboard.display_charts_sales()
 
+    st.markdown("""---""")
+    dashboard.display_sales_trend()
+
     # Hide Streamlit default style
     st.markdown(HIDE_STREAMLIT_STYLE, unsafe_allow_html=True)
\ No newline at end of file
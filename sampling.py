@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from aggregates import CUBE_MEASURES, DISTINCT_COLUMN, AggregationPlan, PlanTable
+from rollups import period_starts
+
+
+# Selections with at least this many rows are first shown from a sample while
+# the exact aggregates are computed in the background. Set
+# SUPERMARKET_PROGRESSIVE=0 to always wait for the exact aggregates.
+PROGRESSIVE_ENV = "SUPERMARKET_PROGRESSIVE"
+PROGRESSIVE_MIN_ROWS_ENV = "SUPERMARKET_PROGRESSIVE_MIN_ROWS"
+PROGRESSIVE_MIN_ROWS = 1_000_000
+
+SAMPLE_STRATA = ["Branch", "Product line"]
+SAMPLE_ROWS = 50_000
+# Every stratum gets at least this many rows (or all of its rows), so every
+# branch and product line shows up and each stratum has a variance estimate
+SAMPLE_MIN_STRATUM_ROWS = 30
+# Two-sided 95% normal quantile
+CONFIDENCE_Z = 1.96
+
+
+def progressive_enabled():
+    return os.environ.get(PROGRESSIVE_ENV, "1").strip().lower() not in ("0", "false", "off")
+
+
+def progressive_min_rows():
+    value = os.environ.get(PROGRESSIVE_MIN_ROWS_ENV)
+    return int(value) if value else PROGRESSIVE_MIN_ROWS
+
+
+class StratifiedSample:
+    """Class answering dashboard aggregations with estimates from a stratified sample.
+
+    Rows are drawn at random within each combination of SAMPLE_STRATA,
+    proportionally to its size, and every sampled row stands for N_h / n_h
+    rows of its stratum. Sums and counts are the weighted sums of the sample,
+    means the ratio of two of them. `interval` gives the half-width of the 95%
+    confidence interval of a sum, count or mean, from the within-stratum
+    variances. Distinct invoices are estimated without an interval.
+
+    The estimates are not tied to the exact results of the selection, so
+    `key` and `results` are None and nothing derived from them is cached.
+    """
+
+    key = None
+    results = None
+
+    def __init__(self, df, size=SAMPLE_ROWS, strata=SAMPLE_STRATA, seed=0):
+        self.rows_total = len(df)
+        strata = [column for column in strata if column in df.columns]
+        stratum_ids = np.zeros(len(df), dtype="int64")
+        for column in strata:
+            codes, categories = pd.factorize(df[column])
+            stratum_ids = stratum_ids * max(len(categories), 1) + codes
+        _, stratum_ids = np.unique(stratum_ids, return_inverse=True)
+        stratum_sizes = np.bincount(stratum_ids)
+
+        allocation = np.ceil(stratum_sizes * min(size / max(len(df), 1), 1.0)).astype("int64")
+        allocation = np.minimum(np.maximum(allocation, SAMPLE_MIN_STRATUM_ROWS), stratum_sizes)
+
+        # Rows grouped by stratum, keeping frame order within each
+        rng = np.random.default_rng(seed)
+        order = np.argsort(stratum_ids, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+        picked = [
+            order[start + rng.choice(population, sample_size, replace=False)]
+            for start, population, sample_size in zip(starts, stratum_sizes, allocation)
+        ]
+        positions = np.sort(np.concatenate(picked))
+
+        self.rows = df.take(positions)
+        self.positions = positions
+        self.strata = stratum_ids[positions]
+        # The first row of a branch is the first row of one of its strata, so
+        # groupings in order of appearance match the exact ones
+        self.first_rows = order[starts][self.strata]
+        self.population = stratum_sizes.astype("float64")
+        self.sizes = allocation.astype("float64")
+        self.weights = (self.population / self.sizes)[self.strata]
+        self._intervals = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def plan_table(self):
+        table = PlanTable.from_rows(self.rows)
+        table.measures = {name: values * self.weights for name, values in table.measures.items()}
+        # Every invoice stands for the weight of its rows, shared among its sampled lines
+        invoice_codes, _ = pd.factorize(self.rows[DISTINCT_COLUMN])
+        table.invoice_counts = self.weights / np.bincount(invoice_codes)[invoice_codes]
+        table.invoices_disjoint = True
+        table.first_row = self.first_rows
+        return table
+
+    def execute(self, plan):
+        return plan.execute(self.plan_table())
+
+    def aggregate(self, by, column, how, sort=True):
+        """Same contract as FrameAggregator.aggregate, with estimated values."""
+        plan = AggregationPlan().add(by, column, how, sort)
+        return self.execute(plan)[plan.requests[0]]
+
+    def interval(self, by, column, how, sort=True):
+        """Returns the half-width of the 95% confidence interval of an estimate, like it
+        (a scalar or a Series), or None for distinct counts."""
+        if how == "nunique":
+            return None
+        key = AggregationPlan.request_key(by, column, how, sort)
+        if key not in self._intervals:
+            self._intervals[key] = self._interval(*key)
+        return self._intervals[key]
+
+    def _interval(self, by, column, how, sort):
+        table = PlanTable.from_rows(self.rows)
+        keys, size, index = AggregationPlan._group_keys(table, by)
+        sum_column, count_column = CUBE_MEASURES.get(column, (None, "count"))
+        counts = table.measures[count_column]
+        if how == "count":
+            values = counts
+        elif sum_column is None:
+            raise ValueError(f"No additive measure is kept for {column!r}")
+        else:
+            values = table.measures[sum_column]
+        weights = self.weights
+
+        if how == "mean":
+            # Linearized variance of the ratio of the estimated sum and count
+            totals = np.bincount(keys, weights=weights * values, minlength=size)
+            denominators = np.bincount(keys, weights=weights * counts, minlength=size)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                ratios = totals / denominators
+                values = (values - np.nan_to_num(ratios)[keys] * counts) / denominators[keys]
+
+        # Var = sum over strata of N_h^2 (1 - n_h / N_h) s_h^2 / n_h, per group
+        strata = len(self.population)
+        cells = keys * strata + self.strata
+        first = np.bincount(cells, weights=values, minlength=size * strata).reshape(size, strata)
+        second = np.bincount(cells, weights=values * values, minlength=size * strata).reshape(size, strata)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variances = (second - first * first / self.sizes) / (self.sizes - 1)
+            factors = self.population**2 * (1 - self.sizes / self.population) / self.sizes
+        half_widths = CONFIDENCE_Z * np.sqrt(np.maximum(np.nan_to_num(variances * factors).sum(axis=1), 0))
+
+        if not by:
+            return float(half_widths[0])
+        estimates = self.aggregate(by, column, how, sort)
+        observed = np.flatnonzero(np.bincount(keys, minlength=size) > 0)
+        return pd.Series(half_widths[observed], index=index[observed], name=column).reindex(estimates.index)
+
+    def trend(self, grain, selections=None, first_day=None, last_day=None):
+        """Returns the estimated Total per period of `grain` and Branch, like TimeRollups.trend."""
+        periods = period_starts(self.rows["Date"].to_numpy().astype("datetime64[D]"), grain)
+        return (
+            self.rows.assign(period=periods, Total=self.rows["Total"].astype("float64") * self.weights)
+            .groupby(["period", "Branch"], observed=True)["Total"]
+            .sum()
+            .reset_index()
+        )
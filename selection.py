@@ -0,0 +1,205 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# Columns that get a bitmap per distinct value. Filtering on any of them only
+# combines precomputed bitmaps instead of scanning the column.
+INDEXED_COLUMNS = ["City", "Customer_type", "Gender", "Branch", "Payment", "Product line"]
+
+
+def filter_signature(selections, date_range=None):
+    """Returns a canonical digest of column selections and an optional (first, last) date range.
+
+    The order in which values were picked does not change the selected rows, so
+    values are sorted before hashing.
+    """
+    canonical = {column: sorted(map(str, values)) for column, values in selections.items()}
+    if date_range is not None:
+        canonical["Date"] = [str(day) for day in date_range]
+    payload = json.dumps(canonical, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def date_bounds(dates, first_day, last_day):
+    """Returns the [start, stop) row bounds of the days first_day..last_day in sorted `dates`.
+
+    Two binary searches, so the cost does not depend on the number of rows.
+    """
+    start = np.searchsorted(dates, np.datetime64(first_day, "D"), side="left")
+    stop = np.searchsorted(dates, np.datetime64(last_day, "D") + 1, side="left")
+    return int(start), int(stop)
+
+
+class FilterIndex:
+    """Class holding one packed bitmap per distinct value of the indexed columns.
+
+    Bit `i` of the bitmap for `(column, value)` is set when row `i` of the frame
+    has that value. A selection ORs the bitmaps of the selected values within a
+    column and ANDs the columns together, so its cost depends on the number of
+    selected values rather than on re-evaluating the columns. Columns where
+    every value is selected are skipped altogether.
+    """
+
+    def __init__(self, df, columns=INDEXED_COLUMNS):
+        self.num_rows = len(df)
+        self.bitmaps = {}
+        for column in columns:
+            if column in df.columns:
+                self.bitmaps[column] = self._build_bitmaps(df[column])
+
+    @staticmethod
+    def _build_bitmaps(values):
+        codes, uniques = pd.factorize(values, sort=False)
+        bitmaps = {}
+        for code, value in enumerate(uniques):
+            bitmaps[value] = np.packbits(codes == code)
+        return bitmaps
+
+    def values(self, column):
+        """Returns the distinct values of an indexed column, in order of first appearance."""
+        return list(self.bitmaps[column])
+
+    def mask(self, selections):
+        """Returns the packed bitmap of the rows matching every column selection.
+
+        `selections` maps an indexed column to the list of accepted values.
+        Returns None when no column restricts the rows.
+        """
+        combined = None
+        for column, selected in selections.items():
+            bitmaps = self.bitmaps[column]
+            if len(bitmaps) == len(set(selected) & bitmaps.keys()):
+                continue
+
+            column_mask = np.zeros((self.num_rows + 7) // 8, dtype=np.uint8)
+            for value in selected:
+                bitmap = bitmaps.get(value)
+                if bitmap is not None:
+                    np.bitwise_or(column_mask, bitmap, out=column_mask)
+
+            if combined is None:
+                combined = column_mask
+            else:
+                np.bitwise_and(combined, column_mask, out=combined)
+        return combined
+
+    def select(self, selections, bounds=None):
+        """Returns the ascending row positions matching every column selection.
+
+        `bounds` optionally restricts the result to the rows [start, stop), as
+        returned by date_bounds for a frame sorted by date.
+        """
+        start, stop = bounds if bounds is not None else (0, self.num_rows)
+        combined = self.mask(selections)
+        if combined is None:
+            return np.arange(start, stop)
+        # Only unpack the bytes covering the bounds
+        first_byte = start // 8
+        bits = np.unpackbits(combined[first_byte:(stop + 7) // 8])
+        positions = np.flatnonzero(bits) + first_byte * 8
+        return positions[np.searchsorted(positions, start):np.searchsorted(positions, stop)]
+
+
+class SelectedRows:
+    """Class standing for the selected rows of a shared frame by their positions.
+
+    Nothing is copied up front: a column is gathered at the selected
+    positions the first time it is read, and `frame()` builds a DataFrame of
+    the rows for code that needs one. Supports what the aggregations read
+    from a frame: `len`, `empty`, `columns`, `attrs`, `rows[column]` and
+    `take`.
+    """
+
+    def __init__(self, df, positions):
+        self.df = df
+        self.positions = positions
+        self._columns = {}
+        self._frame = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def empty(self):
+        return len(self.positions) == 0
+
+    @property
+    def columns(self):
+        return self.df.columns
+
+    @property
+    def attrs(self):
+        return self.df.attrs
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = self.df[column].take(self.positions)
+        return self._columns[column]
+
+    def take(self, positions):
+        """Returns a frame of the selected rows at `positions`, like DataFrame.take."""
+        return self.df.take(self.positions[positions])
+
+    def frame(self):
+        if self._frame is None:
+            self._frame = self.df.take(self.positions)
+        return self._frame
+
+
+def as_frame(rows):
+    """Returns the DataFrame of `rows`, a DataFrame or SelectedRows."""
+    return rows.frame() if isinstance(rows, SelectedRows) else rows
+
+
+SELECTION_CACHE_SIZE = 16
+
+
+class SelectionCache:
+    """Class keeping the filtered row positions and derived aggregates of recent selections.
+
+    Entries are keyed by (dataset version, filter signature) and evicted least
+    recently used first. An entry is a dict with the ascending row `positions`
+    of the selection (read-only) and an `aggregates` dict that consumers fill with results
+    they derived from it, so they can be reused by any page showing the same
+    selection.
+    """
+
+    def __init__(self, max_entries=SELECTION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_create(self, dataset_version, signature, select):
+        """Returns the entry of a selection, calling `select()` for its positions on a miss."""
+        key = (dataset_version, signature)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        positions = select()
+        # Shared by every page of the session, so nothing may change them
+        positions.flags.writeable = False
+        entry = {"positions": positions, "aggregates": {}}
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, keep_version=None):
+        """Drops every entry, or only those of other versions than `keep_version`."""
+        if keep_version is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] != keep_version]:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,117 @@
+import logging
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# How distinct invoices are counted when they span several cells: "exact"
+# (a union of the invoice codes of the selected cells) or "approx"
+# (HyperLogLog sketches kept per cell and merged per group)
+DISTINCT_COUNT_ENV = "SUPERMARKET_DISTINCT_COUNT"
+DISTINCT_COUNT_MODES = ["exact", "approx"]
+# Relative standard error of approximate distinct counts
+DISTINCT_ERROR_ENV = "SUPERMARKET_DISTINCT_ERROR"
+DISTINCT_ERROR = 0.02
+
+SKETCH_MIN_PRECISION = 4
+SKETCH_MAX_PRECISION = 16
+# Bits of the hash below the register index used for the rank
+RANK_BITS = 32
+
+
+def distinct_count_mode():
+    mode = os.environ.get(DISTINCT_COUNT_ENV, "exact").strip().lower()
+    if mode not in DISTINCT_COUNT_MODES:
+        logger.warning("Unknown distinct count mode %r, counting exactly", mode)
+        return "exact"
+    return mode
+
+
+def distinct_error():
+    value = os.environ.get(DISTINCT_ERROR_ENV)
+    return float(value) if value else DISTINCT_ERROR
+
+
+def precision_for_error(error):
+    """Returns the number of index bits p whose 2**p registers give a standard error of at most `error`."""
+    precision = math.ceil(math.log2((1.04 / error) ** 2))
+    return min(max(precision, SKETCH_MIN_PRECISION), SKETCH_MAX_PRECISION)
+
+
+def hash_values(values):
+    """Returns a 64-bit hash of every value, the same in every process and for every frame."""
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def registers_and_ranks(hashes, precision):
+    """Returns the register of every hash (its top `precision` bits) and its rank, the
+    position of the first set bit among the next RANK_BITS bits."""
+    registers = (hashes >> np.uint64(64 - precision)).astype("int64")
+    rest = (hashes >> np.uint64(64 - precision - RANK_BITS)) & np.uint64(2**RANK_BITS - 1)
+    # rest < 2**32 is exact as a float, so frexp gives floor(log2(rest)) + 1
+    _, exponents = np.frexp(rest.astype("float64"))
+    return registers, (RANK_BITS + 1 - exponents).astype("uint8")
+
+
+def estimate(registers):
+    """Returns the HyperLogLog estimates of the rows of a (sketches, 2**p) array of ranks."""
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype("float64")).sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    # Linear counting is more accurate while many registers are empty
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    counts = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+    return np.rint(counts).astype("int64")
+
+
+class CellSketches:
+    """Class holding a HyperLogLog sketch of the distinct invoices of every cube cell.
+
+    Only the non-empty registers are stored, back to back by cell like the
+    invoice codes of AggregateCube: cell `i` owns `registers[offsets[i]:
+    offsets[i + 1]]` and their `ranks`. Sketches merge by taking the largest
+    rank of every register, so the sketch of any selection or grouping of
+    cells is built from theirs without going back to the invoices.
+    """
+
+    def __init__(self, invoice_codes, invoice_offsets, invoice_hashes, precision):
+        self.precision = precision
+        size = 2**precision
+        registers, ranks = registers_and_ranks(invoice_hashes, precision)
+        pair_cells = np.repeat(np.arange(len(invoice_offsets) - 1), np.diff(invoice_offsets))
+
+        # Sorting by (cell, register, rank) puts the largest rank of every register last
+        keys = np.unique((pair_cells * size + registers[invoice_codes]) * 64 + ranks[invoice_codes])
+        cell_registers = keys // 64
+        last = np.append(cell_registers[1:] != cell_registers[:-1], True)
+        cell_registers = cell_registers[last]
+        self.registers = (cell_registers % size).astype("int32")
+        self.ranks = (keys[last] % 64).astype("uint8")
+        self.offsets = np.searchsorted(cell_registers // size, np.arange(len(invoice_offsets)))
+
+    @property
+    def error(self):
+        return 1.04 / math.sqrt(2**self.precision)
+
+    def count(self, cell_positions, group_ids, num_groups):
+        """Returns the estimated distinct invoices of each of `num_groups` groups, cell
+        `cell_positions[i]` belonging to group `group_ids[i]`."""
+        starts = self.offsets[cell_positions]
+        lengths = self.offsets[cell_positions + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        # Only the groups with cells get registers
+        groups, group_ids = np.unique(group_ids, return_inverse=True)
+        size = 2**self.precision
+        merged = np.zeros(len(groups) * size, dtype="uint8")
+        np.maximum.at(merged, np.repeat(group_ids, lengths) * size + self.registers[positions], self.ranks[positions])
+
+        counts = np.zeros(num_groups, dtype="int64")
+        counts[groups] = estimate(merged.reshape(len(groups), size))
+        return counts
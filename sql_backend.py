@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aggregates import AggregationPlan
+from selection import filter_signature
+
+
+logger = logging.getLogger(__name__)
+
+# Selects the engine answering the dashboard aggregations: "pandas" (the
+# in-process aggregate cube) or "duckdb" (SQL pushed down to DuckDB)
+QUERY_BACKEND_ENV = "SUPERMARKET_QUERY_BACKEND"
+QUERY_BACKENDS = ["pandas", "duckdb"]
+
+SQL_AGGREGATES = {
+    "sum": "SUM({})",
+    "mean": "AVG({})",
+    "count": "COUNT({})",
+    "nunique": "COUNT(DISTINCT {})",
+}
+
+
+def duckdb_available():
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def query_backend():
+    """Returns the configured query backend, falling back to pandas when it cannot be used."""
+    backend = os.environ.get(QUERY_BACKEND_ENV, "pandas").strip().lower()
+    if backend not in QUERY_BACKENDS:
+        logger.warning("Unknown query backend %r, using pandas", backend)
+        return "pandas"
+    if backend == "duckdb" and not duckdb_available():
+        logger.warning("duckdb is not installed, using the pandas query backend")
+        return "pandas"
+    return backend
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def sql_column(values):
+    """Tells whether a column is stored in DuckDB: every column but the times of day,
+    which have no portable SQL type and are never aggregated."""
+    if values.dtype != object:
+        return True
+    first = values.dropna().head(1)
+    return first.empty or isinstance(first.iloc[0], str)
+
+
+class DuckDBStore:
+    """Class exposing the sales rows to an embedded DuckDB database as `sales`.
+
+    `sales` is a view over the Parquet snapshot when one matches the frame, so
+    the engine scans only the columns a query needs, with all cores. Otherwise
+    the rows of the frame are copied into a DuckDB table. `df` also provides
+    the column types that results are converted back to, so that they match
+    the pandas backend.
+    """
+
+    def __init__(self, df, parquet_path=None):
+        import duckdb
+
+        self.dataset_version = df.attrs.get("dataset_version")
+        self.dtypes = df.dtypes
+        columns = ", ".join(quote(column) for column in df.columns if sql_column(df[column]))
+
+        self._connection = duckdb.connect()
+        self._lock = threading.Lock()
+        if parquet_path is not None and os.path.exists(parquet_path):
+            source = "read_parquet('{}', file_row_number = true)".format(parquet_path.replace("'", "''"))
+            self._connection.execute(f"CREATE VIEW sales AS SELECT {columns}, file_row_number AS _row FROM {source}")
+        else:
+            # Registered frames are only visible to their own cursor, so the rows are copied in
+            frame = df.reset_index(drop=True).assign(_row=np.arange(len(df)))
+            self._connection.register("sales_frame", frame)
+            self._connection.execute(f"CREATE TABLE sales AS SELECT {columns}, _row FROM sales_frame")
+            self._connection.unregister("sales_frame")
+
+    def query(self, sql, parameters=None):
+        """Runs `sql` on a cursor of its own, so that sessions can query concurrently."""
+        with self._lock:
+            cursor = self._connection.cursor()
+        try:
+            return cursor.execute(sql, parameters or []).fetchdf()
+        finally:
+            cursor.close()
+
+    def slice(self, selections, results=None, date_range=None):
+        """Returns the aggregate source of `selections` and the optional (first, last) date range,
+        like AggregateCube.slice."""
+        key = None
+        if self.dataset_version is not None:
+            key = (self.dataset_version, filter_signature(selections, date_range))
+        return SQLSlice(self, selections, key, results, date_range)
+
+
+class SQLSlice:
+    """Class answering dashboard aggregations with SQL queries on a DuckDB store.
+
+    The selections become the WHERE clause and every grouping of a plan one
+    GROUP BY query, so DuckDB does the scanning and grouping in parallel and
+    only the grouped rows come back to pandas.
+    """
+
+    def __init__(self, store, selections, key=None, results=None, date_range=None):
+        self.store = store
+        self.key = key
+        self.results = results
+        self.selections = selections
+        self.date_range = date_range
+
+    def _where(self):
+        predicates = []
+        parameters = []
+        for column, selected in self.selections.items():
+            if not selected:
+                predicates.append("FALSE")
+                continue
+            predicates.append(f"{quote(column)} IN ({', '.join('?' * len(selected))})")
+            parameters.extend(value.item() if isinstance(value, np.generic) else value for value in selected)
+        if self.date_range is not None:
+            first_day, last_day = self.date_range
+            predicates.append('"Date" >= ? AND "Date" < ?')
+            parameters.extend([pd.Timestamp(first_day), pd.Timestamp(last_day) + pd.Timedelta(days=1)])
+        return (" WHERE " + " AND ".join(predicates) if predicates else ""), parameters
+
+    def aggregate(self, by, column, how, sort=True):
+        """Same contract as FrameAggregator.aggregate."""
+        plan = AggregationPlan().add(by, column, how, sort)
+        return self.execute(plan)[plan.requests[0]]
+
+    def execute(self, plan):
+        """Returns {request key: result} for the requests of `plan`, like AggregationPlan.execute.
+
+        Requests sharing a grouping are answered by one query.
+        """
+        where, parameters = self._where()
+        results = {}
+        for by in dict.fromkeys(by for by, _, _, _ in plan.requests):
+            requests = [request for request in plan.requests if request[0] == by]
+            measures = list(dict.fromkeys((column, how) for _, column, how, _ in requests))
+            for _, how in measures:
+                if how not in SQL_AGGREGATES:
+                    raise ValueError(f"Unsupported aggregation {how!r}")
+
+            select = [quote(dimension) for dimension in by]
+            select.extend(
+                f"{SQL_AGGREGATES[how].format(quote(column))} AS _m{i}" for i, (column, how) in enumerate(measures)
+            )
+            select.append("MIN(_row) AS _first")
+            sql = f"SELECT {', '.join(select)} FROM sales{where}"
+            if by:
+                sql += f" GROUP BY {', '.join(quote(dimension) for dimension in by)}"
+            rows = self.store.query(sql, parameters)
+
+            for request in requests:
+                measure = f"_m{measures.index((request[1], request[2]))}"
+                results[request] = self._result(rows, request, measure)
+        return results
+
+    def _result(self, group, request, measure):
+        by, column, how, sort = request
+        values = group[measure]
+        if how in ("count", "nunique"):
+            values = values.fillna(0).astype("int64")
+        elif how == "sum":
+            # SUM of no rows is NULL in SQL and 0 in pandas
+            values = values.fillna(0).astype("float64")
+        else:
+            values = values.astype("float64")
+        if not by:
+            return values.iloc[0].item() if len(values) else (0 if how in ("count", "nunique") else np.nan)
+
+        keys = [self._keys(group[dimension], dimension) for dimension in by]
+        if sort:
+            order = np.lexsort([self._sort_codes(key) for key in reversed(keys)])
+        else:
+            order = np.argsort(group["_first"].to_numpy(), kind="stable")
+
+        if len(by) == 1:
+            index = pd.Index(keys[0][order], name=by[0])
+        else:
+            index = pd.MultiIndex.from_arrays([np.asarray(key[order], dtype=object) for key in keys], names=list(by))
+        return pd.Series(values.to_numpy()[order], index=index, name=column)
+
+    def _keys(self, values, dimension):
+        dtype = self.store.dtypes[dimension]
+        if isinstance(dtype, pd.CategoricalDtype):
+            return pd.Categorical(values, dtype=dtype)
+        return values.to_numpy().astype(dtype)
+
+    @staticmethod
+    def _sort_codes(keys):
+        if isinstance(keys, pd.Categorical):
+            return keys.codes
+        return keys
@@ -0,0 +1,160 @@
+"""Generates supermarket sales data with the schema of data/supermarkt_sales.xlsx.
+
+Usage:
+    python synthetic_data.py --rows 100000 --cities 6 --branches-per-city 2 --output data/synthetic.xlsx
+"""
+import argparse
+import datetime
+import string
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+
+EXCEL_MAX_ROWS = 1_048_576
+HEADER_ROWS = 4
+
+CITIES = [
+    "Yangon", "Mandalay", "Naypyitaw", "Bago", "Mawlamyine", "Taunggyi",
+    "Pathein", "Monywa", "Sittwe", "Myitkyina", "Meiktila", "Magway",
+]
+PRODUCT_LINES = [
+    "Health and beauty", "Electronic accessories", "Home and lifestyle",
+    "Sports and travel", "Food and beverages", "Fashion accessories",
+]
+PAYMENTS = ["Ewallet", "Cash", "Credit card"]
+PAYMENT_WEIGHTS = [0.35, 0.35, 0.30]
+CUSTOMER_TYPES = ["Member", "Normal"]
+GENDERS = ["Female", "Male"]
+
+# Opening hours 10:00 to 20:59, busier around lunch and after work
+HOUR_WEIGHTS = np.array([6, 8, 9, 8, 7, 8, 8, 9, 10, 11, 9], dtype="float64")
+# Monday to Sunday, busier at the weekend
+WEEKDAY_WEIGHTS = np.array([13, 13, 13, 14, 15, 17, 15], dtype="float64")
+
+COLUMNS = [
+    "Invoice ID", "Branch", "City", "Customer_type", "Gender", "Product line",
+    "Unit price", "Quantity", "Tax 5%", "Total", "Date", "Time", "Payment",
+    "cogs", "gross margin percentage", "gross income", "Rating",
+]
+
+
+def branch_names(count):
+    """Returns branch codes A, B, ..., Z, AA, AB, ..."""
+    names = []
+    for i in range(count):
+        name = ""
+        i += 1
+        while i:
+            i, remainder = divmod(i - 1, 26)
+            name = string.ascii_uppercase[remainder] + name
+        names.append(name)
+    return names
+
+
+def city_names(count):
+    return [CITIES[i] if i < len(CITIES) else f"City {i + 1}" for i in range(count)]
+
+
+def generate_sales(rows, cities=3, branches_per_city=1, days=365, start="2021-01-01", seed=0):
+    """Returns `rows` synthetic transactions as they would be read from the workbook.
+
+    With the defaults, branches A, B and C belong to Yangon, Mandalay and
+    Naypyitaw like in the bundled workbook. Larger chains get more cities and
+    several branches per city, with uneven city sizes.
+    """
+    rng = np.random.default_rng(seed)
+
+    city_list = city_names(cities)
+    branch_list = branch_names(cities * branches_per_city)
+    branch_city = np.repeat(np.arange(cities), branches_per_city)
+    # Bigger cities first: Zipf-like weights over branches
+    branch_weights = 1.0 / np.sqrt(np.arange(1, len(branch_list) + 1))
+    branch_codes = rng.choice(len(branch_list), size=rows, p=branch_weights / branch_weights.sum())
+
+    start_date = pd.Timestamp(start)
+    calendar = pd.date_range(start_date, periods=days, freq="D")
+    day_weights = WEEKDAY_WEIGHTS[calendar.dayofweek]
+    dates = calendar.to_numpy()[rng.choice(days, size=rows, p=day_weights / day_weights.sum())]
+
+    # Every distinct time of day is one shared object, like cells read by openpyxl
+    times = np.array([datetime.time(10 + h, m) for h in range(11) for m in range(60)], dtype="object")
+    minute_weights = np.repeat(HOUR_WEIGHTS, 60)
+    time_codes = rng.choice(len(times), size=rows, p=minute_weights / minute_weights.sum())
+
+    unit_price = np.round(rng.uniform(10, 100, size=rows), 2)
+    quantity = rng.integers(1, 11, size=rows)
+    cogs = np.round(unit_price * quantity, 2)
+    tax = np.round(cogs * 0.05, 4)
+    rating = np.round(np.clip(rng.normal(7.0, 1.7, size=rows), 4.0, 10.0), 1)
+
+    # i -> (i * A + B) mod 10^9 is a bijection because A is coprime to 10^9,
+    # so invoice numbers are unique and look random without a huge permutation
+    invoice_numbers = (np.arange(rows, dtype="int64") * 387_420_489 + int(rng.integers(10**9))) % 10**9
+    invoice_digits = pd.Series(invoice_numbers).astype(str).str.zfill(9)
+    invoice_ids = invoice_digits.str[:3] + "-" + invoice_digits.str[3:5] + "-" + invoice_digits.str[5:]
+
+    def pick(values, weights=None):
+        codes = rng.choice(len(values), size=rows, p=weights)
+        return np.array(values, dtype="object")[codes]
+
+    df = pd.DataFrame({
+        "Invoice ID": invoice_ids.to_numpy(dtype="object"),
+        "Branch": np.array(branch_list, dtype="object")[branch_codes],
+        "City": np.array(city_list, dtype="object")[branch_city[branch_codes]],
+        "Customer_type": pick(CUSTOMER_TYPES),
+        "Gender": pick(GENDERS),
+        "Product line": pick(PRODUCT_LINES),
+        "Unit price": unit_price,
+        "Quantity": quantity,
+        "Tax 5%": tax,
+        "Total": cogs + tax,
+        "Date": dates,
+        "Time": times[time_codes],
+        "Payment": pick(PAYMENTS, PAYMENT_WEIGHTS),
+        "cogs": cogs,
+        "gross margin percentage": np.full(rows, 4.761904762),
+        "gross income": tax,
+        "Rating": rating,
+    })
+    return df[COLUMNS]
+
+
+def write_workbook(df, path, sheet_name="Sales"):
+    """Writes `df` in the layout of the bundled workbook (title rows, data from column B)."""
+    if len(df) + HEADER_ROWS > EXCEL_MAX_ROWS:
+        raise ValueError(f"Excel sheets hold at most {EXCEL_MAX_ROWS - HEADER_ROWS:,} data rows")
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.append([])
+    worksheet.append([None, "Sales 2021"])
+    worksheet.append([])
+    worksheet.append([None, *df.columns])
+    for row in df.itertuples(index=False):
+        worksheet.append([None, *row])
+    workbook.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--cities", type=int, default=3)
+    parser.add_argument("--branches-per-city", type=int, default=1)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="data/synthetic_sales.xlsx",
+                        help="Target file; .xlsx writes a workbook, .parquet the raw frame")
+    args = parser.parse_args()
+
+    df = generate_sales(args.rows, args.cities, args.branches_per_city, args.days, seed=args.seed)
+    if args.output.endswith(".parquet"):
+        df.to_parquet(args.output, index=False)
+    else:
+        write_workbook(df, args.output)
+    print(f"Wrote {len(df):,} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
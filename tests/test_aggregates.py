@@ -0,0 +1,161 @@
+import concurrent.futures
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregates
+from aggregates import AggregateCube, AggregationPlan
+from ingest import append_sorted
+from rollups import DateRangeSlice, TimeRollups, period_starts
+from synthetic_data import generate_sales
+from utils import Dashboard, DataLoader
+
+FILTER_COLUMNS = ["City", "Customer_type", "Gender"]
+
+
+@pytest.fixture(scope="module")
+def sales():
+    df = DataLoader.process_frame(generate_sales(4000, cities=3, branches_per_city=2, seed=11))
+    df.attrs["dataset_version"] = "test"
+    return df
+
+
+def selections_of(df):
+    values = {column: list(df[column].dropna().unique()) for column in FILTER_COLUMNS}
+    return [
+        values,
+        {**values, "City": values["City"][:1]},
+        {**values, "City": values["City"][1:], "Gender": values["Gender"][:1]},
+    ]
+
+
+def selected_rows(df, selections, first_day=None, last_day=None):
+    mask = np.ones(len(df), dtype=bool)
+    for column, values in selections.items():
+        mask &= df[column].isin(values).to_numpy()
+    if first_day is not None:
+        days = df["Date"].dt.date
+        mask &= ((days >= first_day) & (days <= last_day)).to_numpy()
+    return df[mask]
+
+
+def chart_plan():
+    plan = AggregationPlan()
+    for requests in Dashboard.CHART_AGGREGATIONS.values():
+        for request in requests:
+            plan.add(*request)
+    return plan
+
+
+def groupby(rows, by, column, how, sort=True):
+    """The plain pandas answer every aggregate source has to match."""
+    if not by:
+        return rows[column].agg(how)
+    return rows.groupby(list(by), observed=True, sort=sort)[column].agg(how)
+
+
+def assert_same(result, expected):
+    # Rating is float32, which pandas averages in float32
+    if isinstance(expected, pd.Series):
+        assert list(result.index) == list(expected.index)
+        np.testing.assert_allclose(result.to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-6)
+    else:
+        assert result == pytest.approx(expected, rel=1e-6, nan_ok=True)
+
+
+def assert_plan_matches_groupby(source, rows):
+    plan = chart_plan()
+    results = source.execute(plan)
+    for by, column, how, sort in plan.requests:
+        expected = groupby(rows, by, column, how, sort)
+        assert_same(results[(by, column, how, sort)], expected)
+        assert_same(source.aggregate(list(by), column, how, sort), expected)
+
+
+def test_cube_slices_match_groupby(sales):
+    cube = AggregateCube.build(sales)
+    for selections in selections_of(sales):
+        assert_plan_matches_groupby(cube.slice(selections), selected_rows(sales, selections))
+
+
+def test_cube_counts_invoices_spanning_groups(sales):
+    shared = sales.copy()
+    shared["Invoice ID"] = shared["Invoice ID"].str[:2]
+    cube = AggregateCube.build(shared)
+
+    assert not cube.invoices_disjoint
+    for selections in selections_of(shared):
+        assert_plan_matches_groupby(cube.slice(selections), selected_rows(shared, selections))
+
+
+def test_parallel_cube_matches_serial_cube(sales):
+    serial = AggregateCube(sales)
+    parallel = AggregateCube.build(sales, workers=2, min_rows=0)
+
+    pd.testing.assert_frame_equal(parallel.cells, serial.cells)
+    np.testing.assert_array_equal(parallel.invoice_codes, serial.invoice_codes)
+
+
+def test_appended_cube_matches_groupby(sales):
+    cube = AggregateCube.build(sales)
+    rows = DataLoader.process_frame(generate_sales(500, cities=4, branches_per_city=2, seed=12))
+    rows["Invoice ID"] = "new-" + rows["Invoice ID"]
+    merged, positions = append_sorted(sales, rows)
+
+    appended = cube.append(merged.take(positions), positions, "appended")
+    for selections in selections_of(merged):
+        assert_plan_matches_groupby(appended.slice(selections), selected_rows(merged, selections))
+
+
+def test_rollups_match_groupby(sales):
+    rollups = TimeRollups(sales)
+    first_day, last_day = sales["Date"].iloc[0].date(), sales["Date"].iloc[-1].date()
+    ranges = [
+        (first_day, last_day),
+        (first_day + datetime.timedelta(days=17), last_day - datetime.timedelta(days=40)),
+        (first_day + datetime.timedelta(days=3), first_day + datetime.timedelta(days=3)),
+    ]
+    for first, last in ranges:
+        for selections in selections_of(sales):
+            rows = selected_rows(sales, selections, first, last)
+            assert_plan_matches_groupby(DateRangeSlice(rollups, rows, selections, first, last), rows)
+
+            for grain in ("day", "week", "month"):
+                periods = period_starts(rows["Date"].to_numpy().astype("datetime64[D]"), grain)
+                expected = rows.assign(period=periods).groupby(["period", "Branch"], observed=True)["Total"].sum()
+                trend = rollups.trend(grain, selections, first, last)
+                pd.testing.assert_frame_equal(
+                    trend.reset_index(drop=True), expected.reset_index(),
+                    check_dtype=False, check_categorical=False, rtol=1e-6,
+                )
+
+
+def test_duckdb_matches_groupby(sales, tmp_path):
+    pytest.importorskip("duckdb")
+    from sql_backend import DuckDBStore
+
+    parquet_path = str(tmp_path / "sales.parquet")
+    sales.to_parquet(parquet_path)
+    for store in (DuckDBStore(sales), DuckDBStore(sales, parquet_path)):
+        for selections in selections_of(sales):
+            assert_plan_matches_groupby(store.slice(selections), selected_rows(sales, selections))
+
+
+def _exit_worker():
+    os._exit(1)
+
+
+def test_parallel_build_falls_back_to_a_serial_build_when_the_pool_breaks(sales, monkeypatch):
+    broken = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+        broken.submit(_exit_worker).result()
+    monkeypatch.setattr(aggregates, "worker_pool", lambda workers: broken)
+
+    serial = AggregateCube(sales)
+    # A broken pool raises from submit; every build falls back instead
+    for _ in range(2):
+        cube = AggregateCube.build(sales, workers=2, min_rows=0)
+        pd.testing.assert_frame_equal(cube.cells, serial.cells)
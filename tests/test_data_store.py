@@ -0,0 +1,118 @@
+import mmap
+import os
+import sys
+
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from data_store import MappedColumns, PartitionedStore, SnapshotCache
+from ingest import string_dtype
+from synthetic_data import generate_sales, write_workbook
+from utils import DataLoader
+
+
+def load(path):
+    return DataLoader().read_dataset(path, "Sales", "B:R", increments=DataLoader.increment_stats(path))
+
+
+def test_catalog_is_read_without_loading_the_frame(tmp_path):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(400, cities=3, seed=3), path)
+    assert SnapshotCache(path, "Sales", "B:R", None).catalog() is None
+
+    df = load(path)
+    catalog = SnapshotCache(path, "Sales", "B:R", None).catalog()
+
+    assert catalog == df.attrs["partitions"]
+    assert sum(entry["rows"] for entry in catalog["partitions"]) == len(df)
+
+
+def test_catalog_is_none_while_an_increment_is_pending(tmp_path):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(400, cities=3, seed=3), path)
+    load(path)
+
+    increment = str(tmp_path / "sales_2022-01-01.csv")
+    rows = generate_sales(20, cities=3, seed=4, start="2022-01-01")
+    rows["Invoice ID"] = "new-" + rows["Invoice ID"]
+    rows.to_csv(increment, index=False)
+
+    assert SnapshotCache(path, "Sales", "B:R", None).catalog([increment]) is None
+    df = load(path)
+    assert SnapshotCache(path, "Sales", "B:R", None).catalog([increment])["version"] == df.attrs["dataset_version"]
+
+
+def test_partitions_give_back_the_selected_rows(tmp_path):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(400, cities=3, seed=3), path)
+    df = load(path)
+    catalog = df.attrs["partitions"]
+    city = PartitionedStore.values(catalog, "City")[0]
+
+    entries = PartitionedStore.matching(catalog, {"City": [city]})
+    rows = PartitionedStore(catalog["root"]).read(catalog["version"], entries)
+
+    expected = df[df["City"] == city]
+    pd.testing.assert_frame_equal(
+        rows.reset_index(drop=True).astype(str), expected.reset_index(drop=True).astype(str)
+    )
+
+
+def mapped_base(array):
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = array.base
+    return array
+
+
+def test_mapped_columns_are_read_back_as_memory_maps(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    df = DataLoader.process_frame(generate_sales(500, cities=3, seed=10))
+    mapped = MappedColumns(str(tmp_path / "columns"))
+    mapped.write(df, "v1")
+
+    allocated = pa.total_allocated_bytes()
+    read = mapped.read("v1")
+
+    pd.testing.assert_frame_equal(read, df, check_index_type=False)
+    # The strings of Invoice ID stay in the mapped file instead of Arrow memory
+    assert read["Invoice ID"].dtype == string_dtype()
+    assert pa.total_allocated_bytes() - allocated < 1024
+    for column in ("Total", "Date", "Rating"):
+        assert mapped_base(read[column].to_numpy()) is not None
+    assert mapped_base(read["City"].cat.codes.to_numpy()) is not None
+    assert mapped.read("v2") is None
+
+
+def catalog_app(path):
+    import streamlit as st
+
+    from utils import DataLoader
+
+    st.session_state.setdefault("catalogs", []).append(DataLoader().get_catalog(path, "Sales", "B:R"))
+
+
+def test_catalog_is_read_once_until_the_files_change(tmp_path, monkeypatch):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(400, cities=3, seed=3), path)
+    df = load(path)
+    reads = []
+    catalog = SnapshotCache.catalog
+    monkeypatch.setattr(SnapshotCache, "catalog", lambda self, *args: reads.append(1) or catalog(self, *args))
+    # AppTest runs the script as __main__ and leaves it there, where spawned workers would import it
+    monkeypatch.setitem(sys.modules, "__main__", sys.modules["__main__"])
+
+    app = AppTest.from_function(catalog_app, args=(path,))
+    app.run()
+    app.run()
+    assert len(reads) == 1
+    first, second = app.session_state["catalogs"]
+    assert second is first
+    assert first == df.attrs["partitions"]
+
+    # Touched, not changed: read again, and still valid
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    app.run()
+    assert len(reads) == 2
+    assert app.session_state["catalogs"][-1] == first
+    assert not app.exception
@@ -0,0 +1,163 @@
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import pytest
+
+import utils
+from aggregates import AggregateCube
+from figures import FIGURE_SIGNIFICANT_DIGITS, FigureCache, PayloadBudget, compact_figure, figure_bytes
+from synthetic_data import generate_sales
+from utils import Dashboard, DataLoader
+
+
+@pytest.fixture(scope="module")
+def sales():
+    df = DataLoader.process_frame(generate_sales(1000, cities=3, branches_per_city=2, seed=7))
+    df.attrs["dataset_version"] = "v1"
+    return df
+
+
+def figure_of(name):
+    return {"data": [{"type": "bar", "name": name}], "layout": {}}
+
+
+def test_figure_cache_evicts_the_least_recently_used_figure():
+    cache = FigureCache(max_entries=2)
+    cache.get_or_build(("v1", "a", "chart"), lambda: figure_of("a"))
+    cache.get_or_build(("v1", "b", "chart"), lambda: figure_of("b"))
+    # Reading "a" makes "b" the least recently used
+    assert cache.get_or_build(("v1", "a", "chart"), pytest.fail) == figure_of("a")
+    cache.get_or_build(("v1", "c", "chart"), lambda: figure_of("c"))
+
+    assert cache.stats() == {"hits": 1, "misses": 3, "evictions": 1, "entries": 2, "max_entries": 2}
+    assert cache.get_or_build(("v1", "a", "chart"), pytest.fail) == figure_of("a")
+    assert cache.get_or_build(("v1", "c", "chart"), pytest.fail) == figure_of("c")
+    assert cache.get_or_build(("v1", "b", "chart"), lambda: figure_of("rebuilt")) == figure_of("rebuilt")
+    assert cache.stats()["misses"] == 4
+
+
+def test_figure_cache_returns_copies():
+    cache = FigureCache()
+    figure = cache.get_or_build(("v1", "a", "chart"), lambda: figure_of("a"))
+    figure["layout"]["title"] = "changed"
+    assert cache.get_or_build(("v1", "a", "chart"), pytest.fail) == figure_of("a")
+
+
+def test_figure_cache_discards_a_dataset_version_and_its_partitions():
+    cache = FigureCache()
+    for version in ("v1", "v1-0123", "v2"):
+        cache.get_or_build((version, "a", "chart"), lambda: figure_of(version))
+
+    cache.discard("v1")
+    assert cache.stats()["entries"] == 1
+    assert cache.get_or_build(("v2", "a", "chart"), pytest.fail) == figure_of("v2")
+
+
+def test_dashboard_figures_are_keyed_by_version_and_filter_signature(sales, monkeypatch):
+    cache = FigureCache()
+    monkeypatch.setattr(utils, "get_figure_cache", lambda: cache)
+    cube = AggregateCube.build(sales)
+    cities = list(sales["City"].cat.categories)
+    other = sales.copy(deep=False)
+    other.attrs = {**sales.attrs, "dataset_version": "v2"}
+    other_cube = AggregateCube.build(other)
+
+    def figure(cube, selections):
+        return Dashboard(None, aggregates=cube.slice(selections)).figure("branch_pie")
+
+    first = figure(cube, {"City": cities})
+    assert (cache.misses, cache.hits) == (1, 0)
+    # The order in which values were picked does not change the key
+    assert figure(cube, {"City": cities[::-1]}) == first
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    assert figure(cube, {"City": cities[:1]}) != first
+    assert (cache.misses, cache.hits) == (2, 1)
+    # Same selection of another dataset version
+    assert figure(other_cube, {"City": cities}) == first
+    assert (cache.misses, cache.hits) == (3, 1)
+
+
+def assert_values_close(compact, full):
+    if isinstance(full, dict):
+        assert compact.keys() == full.keys()
+        for name in full:
+            assert_values_close(compact[name], full[name])
+    elif isinstance(full, list):
+        assert len(compact) == len(full)
+        for compact_item, full_item in zip(compact, full):
+            assert_values_close(compact_item, full_item)
+    elif isinstance(full, float):
+        assert compact == pytest.approx(full, rel=10.0 ** (1 - FIGURE_SIGNIFICANT_DIGITS))
+    elif isinstance(full, str) and full.endswith("T00:00:00"):
+        assert pd.Timestamp(compact) == pd.Timestamp(full)
+    else:
+        assert compact == full
+
+
+def test_compact_figure_keeps_the_data_of_the_figure(sales):
+    days = sales.groupby("Date")["Total"].sum().reset_index()
+    lines = sales.groupby(["Product line", "Gender"], observed=True)["Rating"].mean().reset_index()
+    figures = [
+        px.line(days, x="Date", y="Total"),
+        px.bar(lines, x="Rating", y="Product line", color="Gender", orientation="h"),
+        px.pie(sales.groupby("Payment", observed=True)["Total"].sum().reset_index(), values="Total",
+               names="Payment"),
+    ]
+    for figure in figures:
+        full = json.loads(figure.to_json())
+        compact = compact_figure(figure)
+
+        assert_values_close(compact["data"], full["data"])
+        assert {name: value for name, value in compact["layout"].items() if name != "template"} == {
+            name: value for name, value in full["layout"].items() if name != "template"
+        }
+        assert figure_bytes(compact) < figure_bytes(full)
+        # Only the defaults of the trace types in the figure are kept
+        trace_types = {trace.get("type", "scatter") for trace in full["data"]}
+        assert set(compact["layout"]["template"]["data"]) == trace_types & set(full["layout"]["template"]["data"])
+
+
+def test_compact_figure_shortens_floats_and_midnight_timestamps():
+    figure = px.line(pd.DataFrame({
+        "day": pd.to_datetime(["2019-01-01", "2019-01-02", "2019-01-03T12:30:00"], format="ISO8601"),
+        "value": [1 / 3, 123456.789012, np.pi * 1e-9],
+    }), x="day", y="value")
+
+    trace = compact_figure(figure)["data"][0]
+
+    assert trace["x"] == ["2019-01-01", "2019-01-02", "2019-01-03T12:30:00"]
+    assert trace["y"] == [0.3333333, 123456.8, 3.141593e-09]
+
+
+def test_payload_budget_logs_charts_and_pages_over_budget(caplog):
+    spec = figure_of("a")
+    size = figure_bytes(spec)
+    payload = PayloadBudget(chart_budget=size, page_budget=2 * size)
+
+    with caplog.at_level(logging.WARNING, logger="figures"):
+        assert payload.add("first", spec) == size
+        payload.add("second", spec)
+        assert caplog.records == []
+
+        payload.add("third", figure_of("abc"))
+        assert payload.total == 3 * size + 2
+        assert payload.charts == {"first": size, "second": size, "third": size + 2}
+        assert [record.getMessage() for record in caplog.records] == [
+            f"Chart third sends {size + 2} bytes, over its budget of {size}",
+            f"The page's charts send {3 * size + 2} bytes, over the budget of {2 * size}",
+        ]
+
+        # The page budget is only reported once it is first exceeded
+        payload.add("fourth", spec)
+        assert len(caplog.records) == 2
+
+
+def test_payload_budget_reads_its_budgets_from_the_environment(monkeypatch):
+    monkeypatch.setenv("SUPERMARKET_CHART_BUDGET_BYTES", "10")
+    monkeypatch.setenv("SUPERMARKET_PAGE_BUDGET_BYTES", "20")
+    payload = PayloadBudget()
+    assert (payload.chart_budget, payload.page_budget) == (10, 20)
@@ -0,0 +1,236 @@
+import datetime
+import sys
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from ingest import (
+    SALES_PIPELINE, WEEKDAYS, StreamingExcelReader, TransformPipeline, append_sorted, compact_frame,
+    freeze_frame, string_dtype,
+)
+from synthetic_data import generate_sales, write_workbook
+from utils import DataLoader
+
+
+@pytest.fixture
+def mixed_workbook(tmp_path):
+    path = tmp_path / "mixed.xlsx"
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "Sheet"
+    sheet.append(["number", "price", "date", "text"])
+    rows = [
+        [1, 1.5, datetime.datetime(2019, 1, 1), "x"],
+        [2, "n/a", datetime.datetime(2019, 1, 2), "NA"],
+        [3, 2.5, "soon", "y"],
+        [None, "free", None, "z"],
+        [5, 3, datetime.datetime(2019, 1, 3), None],
+    ]
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_streaming_reader_matches_read_excel_on_mixed_types(mixed_workbook, chunk_size):
+    streamed = StreamingExcelReader(mixed_workbook, "Sheet", chunk_size=chunk_size).read()
+    expected = pd.read_excel(mixed_workbook, sheet_name="Sheet")
+
+    assert streamed.dtypes.tolist() == expected.dtypes.tolist()
+    # Blanks of object columns are None instead of NaN
+    pd.testing.assert_frame_equal(streamed.fillna(np.nan), expected.fillna(np.nan))
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_missing_unit_price_loads_as_nan(tmp_path, streaming):
+    df = generate_sales(200, cities=2)
+    df["Unit price"] = df["Unit price"].astype(object)
+    df.loc[150, "Unit price"] = "n/a"
+    path = tmp_path / "sales.xlsx"
+    write_workbook(df, path)
+
+    loaded = DataLoader.read_excel(str(path), "Sales", "B:R", streaming=streaming)
+
+    assert len(loaded) == 200
+    assert loaded["Unit price"].dtype == "float64"
+    assert loaded.loc[loaded["Invoice ID"] == df.loc[150, "Invoice ID"], "Unit price"].isna().all()
+
+
+def test_streaming_reader_matches_read_excel(tmp_path):
+    path = tmp_path / "sales.xlsx"
+    write_workbook(generate_sales(500, cities=3, branches_per_city=2), path)
+
+    streamed = DataLoader.read_excel(str(path), "Sales", "B:R", streaming=True)
+    expected = DataLoader.read_excel(str(path), "Sales", "B:R", streaming=False)
+
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_append_sorted_keeps_the_codes_of_stored_rows():
+    store = DataLoader.process_frame(generate_sales(300, cities=2, seed=1))
+    rows = DataLoader.process_frame(generate_sales(50, cities=4, seed=2))
+    rows["Invoice ID"] = "new-" + rows["Invoice ID"].astype(str)
+
+    merged, positions = append_sorted(store, rows)
+
+    stored = merged.drop(merged.index[positions])
+    for column in ("City", "Branch"):
+        categories = store[column].cat.categories
+        assert merged[column].cat.categories[:len(categories)].equals(categories)
+        np.testing.assert_array_equal(stored[column].cat.codes.sort_index(), store[column].cat.codes.sort_index())
+    both = pd.concat([store, rows])
+    expected = dict(zip(both["Invoice ID"].astype(str), both["City"].astype(str)))
+    assert dict(zip(merged["Invoice ID"].astype(str), merged["City"].astype(str))) == expected
+
+
+def test_compact_frame_keeps_invoice_ids_as_strings():
+    df, report = compact_frame(generate_sales(1000, cities=3))
+
+    assert df["Invoice ID"].dtype == string_dtype()
+    assert report["columns"]["Invoice ID"]["type"] == str(string_dtype())
+    assert report["columns"]["Invoice ID"]["after"] < report["columns"]["Invoice ID"]["before"]
+    assert report["columns"]["City"]["type"] == "category"
+    assert report["columns"]["City"]["after"] < report["columns"]["City"]["before"]
+
+
+def test_append_sorted_drops_known_and_repeated_invoices():
+    store = DataLoader.process_frame(generate_sales(300, cities=2, seed=1))
+    new = DataLoader.process_frame(generate_sales(40, cities=2, seed=9, start="2022-01-01"))
+    new["Invoice ID"] = "new-" + new["Invoice ID"]
+    rows = pd.concat([new, new.iloc[:5], store.iloc[:7]], ignore_index=True)
+
+    merged, positions = append_sorted(store, rows)
+
+    assert len(merged) == len(store) + 40
+    assert merged["Invoice ID"].is_unique
+    assert set(merged["Invoice ID"].iloc[positions]) == set(new["Invoice ID"])
+    np.testing.assert_array_equal(positions, np.arange(len(store), len(merged)))
+
+    merged, positions = append_sorted(store, store.iloc[:10])
+    assert merged is store
+    assert len(positions) == 0
+
+
+def test_append_sorted_inserts_late_rows_after_the_rows_of_their_date():
+    store = DataLoader.process_frame(generate_sales(300, cities=2, seed=1))
+    rows = store.iloc[[40, 120, 200]].copy()
+    rows["Invoice ID"] = ["late-1", "late-2", "late-3"]
+
+    merged, positions = append_sorted(store, rows)
+
+    assert merged["Date"].is_monotonic_increasing
+    assert list(merged["Invoice ID"].iloc[positions]) == ["late-1", "late-2", "late-3"]
+    for position in positions:
+        date = merged["Date"].iloc[position]
+        assert position + 1 == len(merged) or merged["Date"].iloc[position + 1] > date
+    # The stored rows keep their order
+    stored = np.delete(np.arange(len(merged)), positions)
+    assert list(merged["Invoice ID"].iloc[stored]) == list(store["Invoice ID"])
+
+
+def test_pipeline_drops_and_reports_invalid_rows():
+    df = generate_sales(40, seed=4)
+    df["Date"] = df["Date"].dt.strftime("%d/%m/%Y")
+    df.loc[3, "Date"] = "not a date"
+    df.loc[5, "Unit price"] = -1.0
+    df.loc[7, "Rating"] = 11.0
+    df.loc[9, "Invoice ID"] = None
+    # Breaks two rules, but is only dropped once
+    df.loc[11, ["Total", "Rating"]] = [-5.0, -1.0]
+
+    processed, report = SALES_PIPELINE.run(df)
+
+    assert [stage["stage"] for stage in report["stages"]] == SALES_PIPELINE.STAGES
+    assert report["rows_in"] == 40
+    assert report["rows_dropped"] == 5
+    assert report["rows_out"] == len(processed) == 35
+    assert report["invalid_rows"] == {
+        "Invoice ID: missing": 1,
+        "Unit price: below 0": 1,
+        "Total: below 0": 1,
+        "Date: missing": 1,
+        "Rating: below 0": 1,
+        "Rating: above 10": 1,
+    }
+    assert set(df.loc[[3, 5, 7, 9, 11], "Invoice ID"].dropna()).isdisjoint(processed["Invoice ID"])
+
+    expected = df.drop(index=[3, 5, 7, 9, 11])
+    expected_dates = pd.to_datetime(expected["Date"], format="%d/%m/%Y")
+    assert processed["Date"].is_monotonic_increasing
+    assert sorted(processed["Date"]) == sorted(expected_dates)
+    weekdays = processed["Date"].dt.dayofweek.to_numpy()
+    np.testing.assert_array_equal(processed["DayOfWeek"].cat.codes.to_numpy(), weekdays)
+    np.testing.assert_array_equal(
+        processed["hour"].to_numpy(), [time.hour for time in processed["Time"]]
+    )
+
+
+def test_weekdays_of_unparsed_dates_are_missing():
+    pipeline = TransformPipeline({
+        "Date": {"type": "date", "dayfirst": True},
+        "DayOfWeek": {"type": WEEKDAYS, "derive": ("Date", "weekday")},
+    })
+    df = pd.DataFrame({"Date": ["07/01/2019", "not a date", "08/01/2019", None]})
+
+    processed, report = pipeline.run(df)
+
+    assert report["rows_dropped"] == 0
+    assert processed["DayOfWeek"].tolist()[0] == "Monday"
+    assert processed["DayOfWeek"].isna().tolist() == [False, True, False, True]
+
+
+def test_frozen_columns_raise_on_write():
+    df = DataLoader.process_frame(generate_sales(100, seed=6))
+    frozen = freeze_frame(df)
+
+    pd.testing.assert_frame_equal(frozen, df)
+    # Object and Arrow string columns are not protected, see freeze_frame
+    protected = [column for column in frozen.columns if column not in ("Invoice ID", "Time")]
+    for column in protected:
+        # pandas reports a write to a read-only datetime column as an AssertionError
+        with pytest.raises((ValueError, AssertionError)):
+            frozen.loc[frozen.index[0], column] = frozen[column].iloc[1]
+        if not isinstance(frozen[column].dtype, pd.CategoricalDtype):
+            assert np.shares_memory(frozen[column].to_numpy(), df[column].to_numpy()), column
+    assert not frozen["Total"].to_numpy().flags.writeable
+    with pytest.raises(ValueError):
+        frozen["Total"].to_numpy()[0] = 0
+    with pytest.raises(ValueError):
+        frozen["City"].cat.codes.to_numpy()[0] = 0
+    pd.testing.assert_frame_equal(frozen, df)
+
+
+def load_twice(path):
+    import streamlit as st
+
+    from utils import DataLoader, get_dataset_watcher
+
+    if st.session_state.get("stop"):
+        get_dataset_watcher(path, "Sales", "B:R").stop()
+        return
+    frames = st.session_state.setdefault("frames", [])
+    frames.append(DataLoader().get_data_from_excel(path, "Sales", "B:R"))
+
+
+@pytest.mark.parametrize("watch", ["0", "1"])
+def test_reruns_get_the_cached_frame_without_a_copy(tmp_path, monkeypatch, watch):
+    monkeypatch.setenv("SUPERMARKET_WATCH", watch)
+    # AppTest runs the script as __main__ and leaves it there, where spawned workers would import it
+    monkeypatch.setitem(sys.modules, "__main__", sys.modules["__main__"])
+    path = tmp_path / "sales.xlsx"
+    write_workbook(generate_sales(300, seed=7), path)
+
+    app = AppTest.from_function(load_twice, args=(str(path),))
+    app.run()
+    app.run()
+    app.session_state["stop"] = True
+    app.run()
+
+    assert not app.exception
+    first, second = app.session_state["frames"]
+    assert second is first
+    assert not first["Total"].to_numpy().flags.writeable
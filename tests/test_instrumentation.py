@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+import instrumentation
+from instrumentation import count, finish_rerun, span, start_rerun, summarize
+
+
+class Clock:
+    """Stands for time.perf_counter and time.time, moving only when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(instrumentation.time, "perf_counter", clock)
+    monkeypatch.setattr(instrumentation.time, "time", clock)
+    return clock
+
+
+def rerun_records(started, seconds, self_seconds=None):
+    return {
+        "started": started, "session_id": "s", "page": "Dashboard", "stage": "filter_data", "depth": 0,
+        "seconds": seconds, "self_seconds": seconds if self_seconds is None else self_seconds,
+    }
+
+
+def test_summarize_gives_nearest_rank_percentiles_per_rerun():
+    # 100 reruns taking 1..100 ms, and a stage entered twice per rerun
+    records = [rerun_records(started, started / 1000, started / 2000) for started in range(1, 101)]
+    for started in range(1, 101):
+        for _ in range(2):
+            records.append({**rerun_records(started, 0.004), "stage": "figure", "depth": 1})
+    records.append({"started": 1, "session_id": "s", "page": "Dashboard", "stage": "counters",
+                    "counters": {"figure_cache.hits": 2}})
+
+    summary = summarize(records)
+
+    assert summary == [
+        {"stage": "filter_data", "reruns": 100, "calls": 100, "p50_ms": 50.0, "p99_ms": 99.0,
+         "self_p50_ms": 25.0, "self_p99_ms": 49.5, "mean_allocated_kib": None},
+        {"stage": "figure", "reruns": 100, "calls": 200, "p50_ms": 8.0, "p99_ms": 8.0,
+         "self_p50_ms": 8.0, "self_p99_ms": 8.0, "mean_allocated_kib": None},
+    ]
+
+
+def test_summarize_of_a_single_rerun():
+    summary = summarize([{**rerun_records(1, 0.003), "allocated_bytes": 2048}])
+    assert summary[0]["p50_ms"] == summary[0]["p99_ms"] == 3.0
+    assert summary[0]["mean_allocated_kib"] == 2.0
+
+
+def test_reruns_are_exported_as_json_lines(clock, monkeypatch, tmp_path):
+    log_path = tmp_path / "logs" / "profile.jsonl"
+    monkeypatch.setenv("SUPERMARKET_PROFILE", "1")
+    monkeypatch.setenv("SUPERMARKET_PROFILE_LOG", str(log_path))
+
+    for _ in range(2):
+        profile = start_rerun("Dashboard", "session-1")
+        with span("filter_data"):
+            clock.advance(0.010)
+            with span("filter_data.select"):
+                clock.advance(0.030)
+            count("figure_cache.hits", 3)
+        with span("figure"):
+            clock.advance(0.005)
+        assert finish_rerun() is profile
+        assert profile.total_seconds() == pytest.approx(0.045)
+    # Spans outside of a rerun are not recorded
+    with span("figure"):
+        clock.advance(1)
+
+    records = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert len(records) == 8
+    context = {"started": profile.started, "session_id": "session-1", "page": "Dashboard"}
+    assert records[4:] == [
+        {**context, "stage": "filter_data.select", "depth": 1, "seconds": pytest.approx(0.030),
+         "self_seconds": pytest.approx(0.030)},
+        {**context, "stage": "filter_data", "depth": 0, "seconds": pytest.approx(0.040),
+         "self_seconds": pytest.approx(0.010)},
+        {**context, "stage": "figure", "depth": 0, "seconds": pytest.approx(0.005),
+         "self_seconds": pytest.approx(0.005)},
+        {**context, "stage": "counters", "counters": {"figure_cache.hits": 3}},
+    ]
+
+    summary = {row["stage"]: row for row in summarize(records)}
+    assert summary["filter_data"]["reruns"] == 2
+    assert summary["filter_data"]["p50_ms"] == summary["filter_data"]["p99_ms"] == 40.0
+    assert summary["filter_data"]["self_p50_ms"] == 10.0
+
+
+def test_spans_are_no_ops_when_profiling_is_off(monkeypatch):
+    monkeypatch.delenv("SUPERMARKET_PROFILE", raising=False)
+    assert start_rerun("Dashboard") is None
+    with span("filter_data"):
+        count("figure_cache.hits")
+    assert finish_rerun() is None
@@ -0,0 +1,92 @@
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import prewarm
+from prewarm import Prewarmer
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def probe(port, path="/ready"):
+    """Returns the status code and body of a readiness probe."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+@pytest.fixture
+def warming(monkeypatch):
+    """Replaces the warming stages by one that waits for the returned event."""
+    release = threading.Event()
+    monkeypatch.setattr(prewarm, "import_pages", lambda: None)
+
+    def warm_pages():
+        assert release.wait(10)
+        return 3
+
+    monkeypatch.setattr(prewarm, "warm_pages", warm_pages)
+    return release
+
+
+def test_ready_endpoint_answers_503_until_warm_and_200_after(warming, tmp_path):
+    port = free_port()
+    ready_file = tmp_path / "ready.json"
+    ready_file.write_text("left over from the previous deploy")
+
+    prewarmer = Prewarmer(str(ready_file), port, wait_for_runtime=False).start()
+    try:
+        # A stale file must not report the new instance ready
+        assert not ready_file.exists()
+        status, body = probe(port)
+        state = json.loads(body)
+        assert status == 503
+        assert state["status"] in ("pending", "warming")
+        assert probe(port, "/other")[0] == 404
+
+        warming.set()
+        prewarmer._thread.join(10)
+
+        status, body = probe(port)
+        state = json.loads(body)
+        assert status == 200
+        assert state["status"] == "ready"
+        assert state["figures"] == 3
+        assert set(state["stages"]) == {"import", "default_views"}
+        assert json.loads(ready_file.read_text()) == state
+    finally:
+        prewarmer._server.shutdown()
+        prewarmer._server.server_close()
+
+
+def test_failed_warming_stays_unready(monkeypatch, tmp_path):
+    def warm_pages():
+        raise OSError("no workbook")
+
+    monkeypatch.setattr(prewarm, "import_pages", lambda: None)
+    monkeypatch.setattr(prewarm, "warm_pages", warm_pages)
+    port = free_port()
+    ready_file = tmp_path / "ready.json"
+
+    prewarmer = Prewarmer(str(ready_file), port, wait_for_runtime=False).start()
+    try:
+        prewarmer._thread.join(10)
+        status, body = probe(port)
+        state = json.loads(body)
+        assert status == 503
+        assert state["status"] == "failed"
+        assert "no workbook" in state["error"]
+        assert not ready_file.exists()
+    finally:
+        prewarmer._server.shutdown()
+        prewarmer._server.server_close()
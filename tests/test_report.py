@@ -0,0 +1,52 @@
+import os
+import pickle
+
+import report
+from synthetic_data import generate_sales, write_workbook
+
+
+def test_reports_link_to_one_plotlyjs_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(300, cities=2, branches_per_city=2, seed=7), path)
+    monkeypatch.setattr(report, "_shared", None)
+
+    reports = report.generate(path, "Sales", "B:R", str(tmp_path / "reports"), workers=1)
+
+    assert len(reports) == 4
+    assert os.path.exists(tmp_path / "reports" / report.PLOTLYJS_FILE)
+    for written in reports:
+        with open(written["path"], encoding="utf-8") as f:
+            document = f.read()
+        assert document.count(f'src="{report.PLOTLYJS_FILE}"') == 1
+        assert written["bytes"] < 500_000
+
+
+def test_spawned_workers_get_the_pickled_structures(tmp_path, monkeypatch):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(300, cities=2, seed=8), path)
+    monkeypatch.setattr(report, "_shared", None)
+    shared = report.load_shared(path, "Sales", "B:R")
+    pickled = pickle.dumps(shared)
+
+    monkeypatch.setattr(report, "_shared", None)
+    received = report.load_shared(str(tmp_path / "missing.xlsx"), "Sales", "B:R", pickled)
+
+    assert set(received) == {"cube", "rollups"}
+    assert received["cube"].cells.equals(shared["cube"].cells)
+
+
+def test_reports_of_spawned_workers_match_a_single_process(tmp_path, monkeypatch):
+    path = str(tmp_path / "sales.xlsx")
+    write_workbook(generate_sales(300, cities=2, branches_per_city=2, seed=9), path)
+    monkeypatch.setattr(report, "_shared", None)
+
+    serial = report.generate(path, "Sales", "B:R", str(tmp_path / "serial"), workers=1)
+    parallel = report.generate(path, "Sales", "B:R", str(tmp_path / "parallel"), workers=2)
+
+    assert [(written["city"], written["branch"]) for written in parallel] == [
+        (written["city"], written["branch"]) for written in serial
+    ]
+    assert os.getpid() not in {written["pid"] for written in parallel}
+    for serial_report, parallel_report in zip(serial, parallel):
+        with open(serial_report["path"], encoding="utf-8") as f, open(parallel_report["path"], encoding="utf-8") as g:
+            assert f.read() == g.read()
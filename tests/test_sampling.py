@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sampling import StratifiedSample
+from synthetic_data import generate_sales
+from utils import DataLoader
+
+
+@pytest.fixture(scope="module")
+def sales():
+    return DataLoader.process_frame(generate_sales(20000, cities=3, branches_per_city=2, seed=21))
+
+
+def test_intervals_cover_the_exact_values(sales):
+    requests = [
+        ((), "Total", "sum", True),
+        (("Branch",), "Rating", "mean", False),
+        (("Gender",), "Total", "count", True),
+        (("Product line",), "Total", "mean", True),
+    ]
+    covered = {request: [] for request in requests}
+    for seed in range(100):
+        sample = StratifiedSample(sales, size=2000, seed=seed)
+        for request in requests:
+            by, column, how, sort = request
+            estimate = sample.aggregate(list(by), column, how, sort)
+            half_width = sample.interval(list(by), column, how, sort)
+            if not by:
+                covered[request].append(abs(estimate - sales[column].agg(how)) <= half_width)
+                continue
+            exact = sales.groupby(list(by), observed=True)[column].agg(how).reindex(estimate.index)
+            assert half_width.index.equals(estimate.index)
+            covered[request].extend((estimate - exact).abs() <= half_width)
+
+    # 95% intervals over 100 samples: a few misses, but not many and not none
+    for request, hits in covered.items():
+        assert 0.85 <= np.mean(hits) <= 0.99, request
+
+
+def test_single_row_strata_are_kept_with_their_own_weight(sales):
+    df = sales.copy()
+    df["Branch"] = df["Branch"].cat.add_categories(["Z"])
+    # One row of its own stratum, and branch, in the middle of the frame
+    df.iloc[len(df) // 2, df.columns.get_loc("Branch")] = "Z"
+
+    sample = StratifiedSample(df, size=2000)
+
+    assert (sample.rows["Branch"] == "Z").sum() == 1
+    assert sample.weights[(sample.rows["Branch"] == "Z").to_numpy()].tolist() == [1.0]
+    totals = sample.aggregate(["Branch"], "Total", "sum", False)
+    assert totals["Z"] == pytest.approx(df.loc[df["Branch"] == "Z", "Total"].iloc[0])
+    half_widths = sample.interval(["Branch"], "Total", "sum", False)
+    # A stratum sampled whole adds no variance
+    assert half_widths["Z"] == 0
+    assert np.isfinite(half_widths).all()
+    assert np.isfinite(sample.interval([], "Total", "sum"))
+    assert np.isfinite(sample.interval(["Branch"], "Rating", "mean", False)).all()
+
+
+def test_strata_smaller_than_the_minimum_are_sampled_whole():
+    df = DataLoader.process_frame(generate_sales(200, cities=3, branches_per_city=2, seed=22))
+
+    sample = StratifiedSample(df, size=20)
+
+    assert len(sample) == len(df)
+    assert (sample.weights == 1).all()
+    assert sample.aggregate([], "Total", "sum") == pytest.approx(df["Total"].sum())
+    assert sample.interval([], "Total", "sum") == 0
+    pd.testing.assert_series_equal(
+        sample.aggregate(["City"], "Total", "sum"), df.groupby("City", observed=True)["Total"].sum(),
+        check_names=False, rtol=1e-9,
+    )
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from selection import (
+    INDEXED_COLUMNS, SELECTION_CACHE_SIZE, FilterIndex, SelectedRows, SelectionCache, date_bounds,
+    filter_signature,
+)
+from synthetic_data import generate_sales
+from utils import DataLoader
+
+
+@pytest.fixture(scope="module")
+def sales():
+    # Not a multiple of 8, so the last byte of every bitmap is only partly used
+    return DataLoader.process_frame(generate_sales(1003, cities=3, branches_per_city=2, seed=5))
+
+
+def selected_mask(df, selections, bounds=None):
+    mask = np.ones(len(df), dtype=bool)
+    for column, values in selections.items():
+        mask &= df[column].isin(values).to_numpy()
+    if bounds is not None:
+        mask[:bounds[0]] = False
+        mask[bounds[1]:] = False
+    return mask
+
+
+def test_filter_index_selects_the_rows_of_a_boolean_mask(sales):
+    assert len(sales) % 8 != 0
+    index = FilterIndex(sales)
+    values = {column: index.values(column) for column in INDEXED_COLUMNS}
+    last_row = {column: [sales[column].iloc[-1]] for column in INDEXED_COLUMNS}
+    selections = [
+        {},
+        values,
+        {**values, "City": values["City"][:1]},
+        {**values, "City": values["City"][1:], "Gender": values["Gender"][:1]},
+        # Nothing selected in a column selects no rows
+        {**values, "Payment": []},
+        # Values missing from the data select nothing on their own
+        {**values, "Branch": ["No such branch"]},
+        {**values, "Branch": [*values["Branch"][:1], "No such branch"]},
+        last_row,
+    ]
+
+    days = sales["Date"].to_numpy().astype("datetime64[D]")
+    first_day, last_day = days[0].item(), days[-1].item()
+    all_bounds = [
+        None,
+        date_bounds(days, first_day, last_day),
+        date_bounds(days, days[len(days) // 3].item(), days[2 * len(days) // 3].item()),
+        # The last day ends in the partly used byte
+        date_bounds(days, last_day, last_day),
+        (len(sales) - 3, len(sales)),
+        (5, 5),
+    ]
+    for selection in selections:
+        for bounds in all_bounds:
+            positions = index.select(selection, bounds)
+            np.testing.assert_array_equal(positions, np.flatnonzero(selected_mask(sales, selection, bounds)))
+    assert len(index.select(last_row)) and index.select(last_row)[-1] == len(sales) - 1
+
+
+def test_selected_rows_match_the_rows_of_a_boolean_mask(sales):
+    index = FilterIndex(sales)
+    for selection in ({"City": index.values("City")[:1]}, {"Payment": []}):
+        positions = index.select(selection)
+        rows = SelectedRows(sales, positions)
+        expected = sales[selected_mask(sales, selection)]
+
+        assert len(rows) == len(expected)
+        assert rows.empty == expected.empty
+        pd.testing.assert_frame_equal(rows.frame(), expected)
+        for column in ("Total", "City", "Invoice ID"):
+            pd.testing.assert_series_equal(rows[column], expected[column])
+        if len(rows):
+            pd.testing.assert_frame_equal(rows.take(np.array([0, len(rows) - 1])), expected.iloc[[0, -1]])
+
+
+def test_selection_cache_evicts_the_least_recently_used_entry():
+    cache = SelectionCache()
+    signatures = [filter_signature({"City": [f"City {i}"]}) for i in range(SELECTION_CACHE_SIZE + 1)]
+    for signature in signatures[:SELECTION_CACHE_SIZE]:
+        cache.get_or_create("v1", signature, lambda: np.arange(3))
+    assert len(cache) == SELECTION_CACHE_SIZE
+
+    # Reading the oldest entry makes the second one the least recently used
+    first = cache.get_or_create("v1", signatures[0], pytest.fail)
+    assert cache.hits == 1
+    cache.get_or_create("v1", signatures[-1], lambda: np.arange(3))
+    assert len(cache) == SELECTION_CACHE_SIZE
+    assert cache.misses == SELECTION_CACHE_SIZE + 1
+
+    assert cache.get_or_create("v1", signatures[0], pytest.fail) is first
+    cache.get_or_create("v1", signatures[1], lambda: np.arange(3))
+    assert cache.misses == SELECTION_CACHE_SIZE + 2
+    # Re-creating the second entry evicted the third
+    assert cache.get_or_create("v1", signatures[3], pytest.fail)["aggregates"] == {}
+    cache.get_or_create("v1", signatures[2], lambda: np.arange(3))
+    assert cache.misses == SELECTION_CACHE_SIZE + 3
+
+
+def test_selection_cache_entries_are_read_only():
+    cache = SelectionCache()
+    entry = cache.get_or_create("v1", filter_signature({}), lambda: np.arange(3))
+    with pytest.raises(ValueError):
+        entry["positions"][0] = 1
+
+
+def test_selection_cache_invalidate_drops_replaced_versions():
+    cache = SelectionCache()
+    signature = filter_signature({"City": ["Yangon"]})
+    old = cache.get_or_create("v1", signature, lambda: np.arange(3))
+    new = cache.get_or_create("v2", signature, lambda: np.arange(2))
+    assert new is not old
+
+    cache.invalidate(keep_version="v2")
+    assert len(cache) == 1
+    assert cache.get_or_create("v2", signature, pytest.fail) is new
+    assert cache.get_or_create("v1", signature, lambda: np.arange(3)) is not old
+
+    cache.invalidate()
+    assert len(cache) == 0
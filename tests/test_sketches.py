@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from sketches import CellSketches, hash_values, precision_for_error
+
+NUM_INVOICES = 100_000
+NUM_CELLS = 40
+NUM_GROUPS = 5
+
+
+@pytest.fixture(scope="module")
+def cells():
+    """Invoice codes of cells sharing invoices, as a cube of invoices spanning several cells has."""
+    rng = np.random.default_rng(3)
+    sizes = rng.integers(10, 8000, NUM_CELLS)
+    codes = [rng.choice(NUM_INVOICES, size, replace=False) for size in sizes]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    hashes = hash_values([f"INV-{number}" for number in range(NUM_INVOICES)])
+    return codes, offsets, hashes
+
+
+@pytest.mark.parametrize("error", [0.02, 0.05, 0.1])
+def test_distinct_counts_are_within_the_requested_error(cells, error):
+    codes, offsets, hashes = cells
+    sketches = CellSketches(np.concatenate(codes), offsets, hashes, precision_for_error(error))
+    assert sketches.error <= error
+
+    rng = np.random.default_rng(4)
+    relative_errors = []
+    for _ in range(20):
+        group_ids = rng.integers(0, NUM_GROUPS, NUM_CELLS)
+        counts = sketches.count(np.arange(NUM_CELLS), group_ids, NUM_GROUPS)
+        for group in np.unique(group_ids):
+            exact = len(np.unique(np.concatenate([codes[cell] for cell in np.flatnonzero(group_ids == group)])))
+            relative_errors.append(counts[group] / exact - 1)
+    relative_errors = np.array(relative_errors)
+
+    # The standard error is a root mean square; 100 estimates measure it to about 10%
+    assert np.sqrt(np.mean(relative_errors**2)) <= 1.2 * sketches.error
+    assert np.abs(relative_errors).max() <= 4 * sketches.error
+
+
+def test_groups_without_cells_count_nothing(cells):
+    codes, offsets, hashes = cells
+    sketches = CellSketches(np.concatenate(codes), offsets, hashes, precision_for_error(0.02))
+
+    counts = sketches.count(np.array([0, 1]), np.array([2, 2]), 4)
+
+    assert counts[[0, 1, 3]].tolist() == [0, 0, 0]
+    exact = len(np.union1d(codes[0], codes[1]))
+    assert counts[2] == pytest.approx(exact, rel=4 * sketches.error)
@@ -0,0 +1,36 @@
+import gc
+from collections import OrderedDict
+
+from aggregates import AggregateCube
+from synthetic_data import generate_sales
+from utils import DataLoader, extend_or_build, is_built
+
+
+def test_partition_subsets_stay_out_of_the_version_history():
+    df = DataLoader.process_frame(generate_sales(300, cities=3, seed=5))
+    history = OrderedDict()
+    full = extend_or_build("cube", df, "v1", AggregateCube.build, history)
+
+    subsets = []
+    for number, city in enumerate(df["City"].cat.categories):
+        subset = df[df["City"] == city].copy()
+        subset.attrs = {"dataset_version": f"v1-{number}", "partition_of": "v1"}
+        subsets.append(extend_or_build("cube", subset, f"v1-{number}", AggregateCube.build, history))
+
+    assert list(history) == ["v1"]
+    assert history["v1"] is full
+    assert all(is_built("cube", f"v1-{number}") for number in range(len(subsets)))
+
+
+def test_built_structures_are_returned_without_building():
+    df = DataLoader.process_frame(generate_sales(300, cities=2, seed=6))
+    cube = extend_or_build("cube", df, "v2", AggregateCube.build, OrderedDict())
+
+    def fail(df):
+        raise AssertionError("built again")
+
+    assert extend_or_build("cube", df, "v2", fail, OrderedDict()) is cube
+    # Entries only live while a cache, a history or a build holds the structure
+    del cube
+    gc.collect()
+    assert not is_built("cube", "v2")
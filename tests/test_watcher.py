@@ -0,0 +1,38 @@
+import gc
+
+import pandas as pd
+
+from watcher import DatasetWatcher
+
+
+class Session:
+    pass
+
+
+def frame(version):
+    df = pd.DataFrame({"x": [1]})
+    df.attrs["dataset_version"] = version
+    return df
+
+
+def test_replaced_versions_are_released_once_no_session_holds_them(tmp_path):
+    path = tmp_path / "sales.xlsx"
+    path.write_bytes(b"v1")
+    versions = iter(["v1", "v2"])
+    released = []
+    watcher = DatasetWatcher(str(path), lambda signature: frame(next(versions)), released.append,
+                             interval=3600, release_delay=0)
+    watcher.current()
+    session = Session()
+    watcher.hold(session, "v1")
+
+    path.write_bytes(b"v2 with more rows")
+    assert watcher.check()
+    assert watcher.version == "v2"
+    assert released == []
+
+    del session
+    gc.collect()
+    watcher.check()
+    assert released == ["v1"]
+    watcher.stop()
@@ -1,5 +1,5 @@
 import streamlit as st
-from utils import DataLoader, SidebarFilter, Dashboard
+from utils import DATA_PATH, DataLoader, SidebarFilter, Dashboard
 
 
 TITLE_ICON = ":dollar:"
@@ -14,20 +14,18 @@ HIDE_STREAMLIT_STYLE = """
 def app():
     st.title(f"{TITLE_ICON} Transactions")
 
-    # Load data
+    # Sidebar filters; only the data of the selected cities is loaded
     data_loader = DataLoader()
-    df = data_loader.get_data_from_excel(
-        path="data\supermarkt_sales.xlsx",
+    sidebar_filter = SidebarFilter.load(
+        data_loader,
+        path=DATA_PATH,
         sheet_name="Sales",
         usecols="B:R",
-        nrows=1000,
         )
-
-    # Sidebar filters
-    sidebar_filter = SidebarFilter(df)
     df_selection, _ = sidebar_filter.filter_data()
 
-    dashboard = Dashboard(df_selection)
+    dashboard = Dashboard(df_selection, sidebar_filter.aggregates())
+    dashboard.plan("transactions_by_branch", "plot_transaction_by_dayofweek", "transactions_vs_product_line")
 
     dashboard.transactions_by_branch()
 
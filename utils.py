@@ -1,84 +1,726 @@
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
 import pandas as pd
 import plotly.express as px
 
 import streamlit as st
 import streamlit_shadcn_ui as ui
 
+from data_store import PartitionedStore, SnapshotCache, file_stat, find_increments
+from ingest import SALES_PIPELINE, WEEKDAYS, StreamingExcelReader, append_sorted, compact_frame, freeze_frame
+from selection import FilterIndex, SelectedRows, SelectionCache, as_frame, date_bounds, filter_signature
+from aggregates import AggregateCube, AggregationPlan, FrameAggregator, PlannedAggregates
+from figures import FigureCache, PayloadBudget, compact_figure
+from instrumentation import count, span, timed
+from rollups import DateRangeSlice, TimeRollups, period_starts
+from sampling import StratifiedSample, progressive_enabled, progressive_min_rows
+from sql_backend import DuckDBStore, query_backend
+from watcher import DatasetWatcher, watch_enabled
+
+
+logger = logging.getLogger(__name__)
+
+DATA_PATH = os.path.join("data", "supermarkt_sales.xlsx")
 
 
 class DataLoader:
     """Class to handle data loading and processing."""
 
+    # Path taken and timings of the most recent (uncached) load
+    last_load_report = None
+    # Rows per second of every stage of the most recent processing
+    last_pipeline_report = None
+    # (root, paths) of the partition sets read by dataset version, to release them with it
+    partition_reads = {}
+    _partition_reads_lock = threading.Lock()
+
+    @timed("load_data")
+    def get_data_from_excel(self, path: str, sheet_name: str, usecols: str, nrows: int = None,
+                            streaming: bool = True, _progress_callback=None):
+        """Loads data from an Excel file and processes it.
+
+        Sales files named like data_store.INCREMENT_PATTERNS that are dropped
+        next to the workbook are merged in. By default the current dataset is
+        kept by a watcher, which reloads it in the background when the workbook
+        or its increment files change (see watcher.DatasetWatcher). With
+        SUPERMARKET_WATCH=0, listing the files is part of the cache key, so a
+        new file is picked up on the next rerun.
+        """
+        if watch_enabled() and nrows is None and _progress_callback is None:
+            watcher = get_dataset_watcher(path, sheet_name, usecols, streaming)
+            return watcher.current(
+                lambda signature: self.read_dataset(
+                    path, sheet_name, usecols, nrows, streaming, signature_increments(path, signature),
+                    show_progress=True,
+                )
+            )
+        increments = self.increment_stats(path)
+        return self.load_data(path, sheet_name, usecols, nrows, streaming, increments, _progress_callback)
+
+    @staticmethod
+    def increment_stats(path):
+        """Returns (path, mtime_ns, size) of the increment files next to the workbook."""
+        return tuple(
+            (increment, *file_stat(increment).values())
+            for increment in find_increments(os.path.dirname(path))
+        )
+
+    def get_catalog(self, path: str, sheet_name: str, usecols: str, nrows: int = None, streaming: bool = True):
+        """Returns the partition catalog of the current data, or None without a partitioned copy.
+
+        The catalog of a snapshot that is still valid is read from disk, so
+        sessions that select some cities never load the whole frame. The data
+        is loaded (and partitioned) only when its version changed. Reruns only
+        stat the files, see read_catalog.
+        """
+        increments = self.increment_stats(path)
+        manifest_path = SnapshotCache(path, sheet_name, usecols, nrows).manifest_path
+        stats = tuple(
+            tuple(file_stat(source).values()) if os.path.exists(source) else None for source in (path, manifest_path)
+        )
+        catalog = self.read_catalog(path, sheet_name, usecols, nrows, stats, increments)
+        if catalog is not None:
+            return catalog
+        if watch_enabled() and nrows is None:
+            return self.get_data_from_excel(path, sheet_name, usecols, nrows, streaming).attrs.get("partitions")
+        return self.load_catalog(path, sheet_name, usecols, nrows, streaming, increments)
+
+    @st.cache_resource(max_entries=4)
+    def read_catalog(_self, path: str, sheet_name: str, usecols: str, nrows: int, stats: tuple,
+                     increments: tuple):
+        """Reads the catalog of the snapshot once per (mtime_ns, size) of the workbook and the
+        snapshot manifest (`stats`) and of the increment files, so reruns neither parse the
+        manifest nor hash the workbook again."""
+        return SnapshotCache(path, sheet_name, usecols, nrows).catalog([increment[0] for increment in increments])
+
     @st.cache_data
-    def get_data_from_excel(_self, path: str, sheet_name: str, usecols: str, nrows: int):
-        """Loads data from an Excel file and processes it."""
-        df = pd.read_excel(
-            io=path,
-            engine="openpyxl",
-            sheet_name=sheet_name,
-            skiprows=3,
-            usecols=usecols,
-            nrows=nrows,
+    def load_catalog(_self, path: str, sheet_name: str, usecols: str, nrows: int = None,
+                     streaming: bool = True, increments: tuple = ()):
+        df = _self.load_data(path, sheet_name, usecols, nrows, streaming, increments)
+        return df.attrs.get("partitions")
+
+    @timed("load_partitions")
+    def get_partitions(self, catalog, selections):
+        """Loads the rows of the partitions matching `selections` only."""
+        entries = PartitionedStore.matching(catalog, selections)
+        paths = tuple(entry["path"] for entry in entries)
+        with DataLoader._partition_reads_lock:
+            DataLoader.partition_reads.setdefault(catalog["version"], set()).add((catalog["root"], paths))
+        return self.load_partitions(catalog["root"], catalog["version"], paths)
+
+    @staticmethod
+    def partition_version(version, paths):
+        """Returns the dataset version of a set of partitions: every set is a dataset of its
+        own for the indexes and caches."""
+        digest = hashlib.sha1("\n".join(paths).encode()).hexdigest()[:8]
+        return f"{version}-{digest}"
+
+    @staticmethod
+    def forget_partitions(version):
+        """Drops the partition reads of a version from the cache and returns their dataset versions."""
+        with DataLoader._partition_reads_lock:
+            reads = DataLoader.partition_reads.pop(version, set())
+        for root, paths in reads:
+            DataLoader.load_partitions.clear(None, root, version, paths)
+        return [DataLoader.partition_version(version, paths) for _, paths in reads]
+
+    @st.cache_resource
+    def load_partitions(_self, root: str, version: str, paths: tuple):
+        """Reads the given partition files of a version; the rest of the dataset is not touched."""
+        start = time.perf_counter()
+        store = PartitionedStore(root)
+        df = freeze_frame(store.read(version, [{"path": path} for path in paths]))
+        df.attrs["dataset_version"] = DataLoader.partition_version(version, paths)
+        df.attrs["snapshot_path"] = None
+        # Keeps the caches of these rows out of the version histories of whole datasets
+        df.attrs["partition_of"] = version
+
+        report = {
+            "source": "partitions",
+            "path": os.path.join(root, version),
+            "partitions": len(paths),
+            "rows": len(df),
+            "seconds": round(time.perf_counter() - start, 4),
+            "dataset_version": df.attrs["dataset_version"],
+            "memory_bytes": int(df.memory_usage(deep=True).sum()),
+        }
+        DataLoader.last_load_report = report
+        logger.info("Loaded %(rows)d rows from %(partitions)d partitions (%(path)s) in %(seconds).3fs", report)
+        return df
+
+    @st.cache_resource(max_entries=2)
+    def load_data(_self, path: str, sheet_name: str, usecols: str, nrows: int = None,
+                  streaming: bool = True, increments: tuple = (), _progress_callback=None):
+        """Loads the workbook and the increment files listed in `increments`.
+
+        The processed frame is kept as a columnar snapshot next to the workbook,
+        so the workbook is only parsed again when it changes. With `streaming`
+        the sheet is read row by row in bounded memory; `_progress_callback` is
+        called with (rows_read, total_rows) and defaults to a progress bar.
+        Increment files that are not in the snapshot yet are read on their own
+        and merged into it. The frame is read-only (see ingest.freeze_frame)
+        and shared by every session instead of being copied for each caller.
+        """
+        return _self.read_dataset(path, sheet_name, usecols, nrows, streaming, increments, _progress_callback,
+                                  show_progress=_progress_callback is None)
+
+    def read_dataset(self, path, sheet_name, usecols, nrows=None, streaming=True, increments=(),
+                     progress_callback=None, show_progress=False):
+        """Uncached load_data, which draws no progress bar unless `show_progress` is set,
+        so it can run outside of a session."""
+        start = time.perf_counter()
+        snapshot = SnapshotCache(path, sheet_name, usecols, nrows)
+        increment_paths = [increment[0] for increment in increments]
+
+        with span("load_data.snapshot_load"):
+            df_sorted = snapshot.load()
+        pending = snapshot.pending_increments(increment_paths) if df_sorted is not None else None
+        previous_version = snapshot.version
+        source = "snapshot"
+        pipeline_report = None
+        if pending is None:
+            source = "excel"
+            snapshot = SnapshotCache(path, sheet_name, usecols, nrows)
+            pending = increment_paths
+            with span("load_data.read_excel"):
+                if streaming and show_progress:
+                    progress_bar = st.progress(0.0, text="Loading sales data...")
+                    progress_callback = self.progress_bar_callback(progress_bar)
+                    df_sorted = self.read_excel(path, sheet_name, usecols, nrows, streaming, progress_callback)
+                    progress_bar.empty()
+                else:
+                    df_sorted = self.read_excel(path, sheet_name, usecols, nrows, streaming, progress_callback)
+            pipeline_report = DataLoader.last_pipeline_report
+
+        positions = []
+        if pending:
+            with span("load_data.increments"):
+                df_sorted, positions = self.merge_increments(df_sorted, pending, sheet_name, usecols)
+        if source == "excel" or pending:
+            with span("load_data.snapshot_save"):
+                snapshot.save(df_sorted, pending)
+        with span("load_data.partitions"):
+            catalog = snapshot.ensure_partitions(df_sorted)
+
+        df_sorted = freeze_frame(df_sorted)
+        df_sorted.attrs["dataset_version"] = snapshot.version
+        # Lets the SQL backend scan the Parquet file instead of the frame
+        df_sorted.attrs["snapshot_path"] = snapshot.snapshot_path if snapshot.fresh else None
+        if source == "snapshot" and pending:
+            # Lets the aggregate cube of the previous version be extended instead of rebuilt
+            df_sorted.attrs["appended"] = {"previous_version": previous_version, "positions": positions}
+        if catalog is not None:
+            # Lets pages load only the partitions of the selected cities
+            df_sorted.attrs["partitions"] = {"root": snapshot.partitions.root, **catalog}
+
+        report = {
+            "source": source,
+            "path": snapshot.snapshot_path if source == "snapshot" else path,
+            "rows": len(df_sorted),
+            "rows_appended": len(positions),
+            "increments": len(snapshot.increments),
+            "seconds": round(time.perf_counter() - start, 4),
+            "dataset_version": snapshot.version,
+            "memory_bytes": int(df_sorted.memory_usage(deep=True).sum()),
+            # Rows breaking a rule of SALES_COLUMNS, counted when the workbook is parsed
+            "rows_dropped": pipeline_report["rows_dropped"] if pipeline_report else None,
+            "invalid_rows": pipeline_report["invalid_rows"] if pipeline_report else None,
+            "memory_report": pipeline_report["memory"] if pipeline_report else None,
+            "pipeline": pipeline_report["stages"] if pipeline_report else None,
+        }
+        DataLoader.last_load_report = report
+        logger.info("Loaded %(rows)d rows from %(source)s (%(path)s) in %(seconds).3fs", report)
+
+        return df_sorted
+
+    @staticmethod
+    def progress_bar_callback(progress_bar):
+        """Returns a progress callback that updates a Streamlit progress bar in 1% steps."""
+        last_percent = [-1]
+
+        def update(rows_read, total_rows):
+            if not total_rows:
+                return
+            percent = min(int(100 * rows_read / total_rows), 100)
+            if percent > last_percent[0]:
+                last_percent[0] = percent
+                progress_bar.progress(percent / 100, text=f"Loading sales data... {rows_read:,} rows")
+
+        return update
+
+    @staticmethod
+    def read_excel(path, sheet_name, usecols, nrows=None, streaming=False, progress_callback=None):
+        """Parses the workbook sheet and applies the processing steps."""
+        if streaming:
+            df = StreamingExcelReader(
+                path,
+                sheet_name,
+                skiprows=3,
+                usecols=usecols,
+                nrows=nrows,
+                progress_callback=progress_callback,
+            ).read()
+        else:
+            df = pd.read_excel(
+                io=path,
+                engine="openpyxl",
+                sheet_name=sheet_name,
+                skiprows=3,
+                usecols=usecols,
+                nrows=nrows,
+            )
+        return DataLoader.process_frame(df)
+
+    @staticmethod
+    def read_increment(path, sheet_name, usecols):
+        """Parses an increment file: a workbook laid out like the main one, or a CSV with its
+        column names and ISO dates."""
+        if path.endswith(".csv"):
+            df = pd.read_csv(path, parse_dates=["Date"])
+            return DataLoader.process_frame(df)
+        return DataLoader.read_excel(path, sheet_name, usecols, streaming=True)
+
+    @staticmethod
+    def merge_increments(df, paths, sheet_name, usecols):
+        """Merges the rows of increment files into the processed, sorted frame.
+
+        Only the increment rows are parsed and processed. Returns the merged
+        frame and the positions of the rows that were added.
+        """
+        rows = pd.concat(
+            [DataLoader.read_increment(path, sheet_name, usecols) for path in paths], ignore_index=True
         )
-        df["hour"] = pd.to_datetime(df["Time"], format="%H:%M:%S").dt.hour
+        rows, _ = compact_frame(rows)
+        merged, positions = append_sorted(df, rows)
+        logger.info("Merged %d new rows from %d increment file(s), %d duplicates dropped",
+                    len(positions), len(paths), len(rows) - len(positions))
+        return merged, positions
 
-        # Convert the 'Date' column to datetime, ensuring day comes first
-        df['Date'] = pd.to_datetime(df['Date'], dayfirst=True)
-        
-        # Sort the data by the Date column
-        df_sorted = df.sort_values(by='Date')
-        
-        # Extract Day of the Week for grouping
-        df_sorted['DayOfWeek'] = df_sorted['Date'].dt.day_name()
-        
+    @staticmethod
+    def process_frame(df):
+        """Parses, derives, validates, sorts by Date and compacts a frame as read from the
+        workbook, as declared in ingest.SALES_COLUMNS."""
+        df_sorted, report = SALES_PIPELINE.run(df)
+        DataLoader.last_pipeline_report = report
         return df_sorted
 
 
-class SidebarFilter:
-    """Class to handle the sidebar filtering options."""
+@st.cache_resource(max_entries=4)
+def get_filter_index(_df, dataset_version):
+    """Builds the filter index once per dataset version and shares it across reruns."""
+    return FilterIndex(_df)
 
-    def __init__(self, df):
-        self.df = df
 
-    def filter_data(self):
-        """Displays sidebar filters and returns the filtered dataframe."""
-        st.sidebar.header("Filter Options:")
+@st.cache_resource
+def get_figure_cache():
+    """Returns the figure cache shared by every session of the server process."""
+    return FigureCache()
 
-        # City Filter
-        cities = self.df['City'].unique().tolist()        
-        selected_cities = st.sidebar.multiselect(
-            "Select City:", options=cities, default=cities
-            )
 
-        # Customer Type Filter
-        customer_types = self.df['Customer_type'].unique().tolist()
-        selected_customer_types = st.sidebar.multiselect(
-            "Select Customer Type:", options=customer_types, default=customer_types
-            )   
+# Most recent cubes and rollups of whole datasets by version, kept for extending
+# them when rows are appended. Partition subsets are never appended to, so they
+# are not kept here.
+VERSION_HISTORY_SIZE = 2
 
-        # Gender Filter
-        genders = self.df['Gender'].unique().tolist()
-        selected_genders = st.sidebar.multiselect(
-            "Select Gender:", options=genders, default=genders
-            )
+# Cubes and rollups in memory by dataset version, held weakly: an entry lives as
+# long as the get_aggregate_cube or get_time_rollups cache, a version history or a
+# background build keeps the structure
+_built = {"cube": weakref.WeakValueDictionary(), "rollups": weakref.WeakValueDictionary()}
+
+
+# Guards the version histories and the background builds, which script runs, the
+# background build thread and the watcher thread all change
+_versions_lock = threading.Lock()
+
+
+@st.cache_resource
+def get_version_history(kind):
+    return OrderedDict()
+
+
+def is_built(kind, dataset_version):
+    """Tells whether the cube or rollups of a dataset version are in memory, so that
+    get_aggregate_cube or get_time_rollups returns them without building."""
+    return dataset_version in _built[kind]
+
+
+def extend_or_build(kind, df, dataset_version, build, history=None):
+    """Returns `build(df)`, or the previous version's structure extended with the appended rows.
+
+    When the frame was made by appending rows to a version whose structure of
+    this kind is still in memory, its `append` method is used instead of
+    building from scratch. A structure already in memory, e.g. built in the
+    background, is returned as is.
+    """
+    history = get_version_history(kind) if history is None else history
+    with _versions_lock:
+        structure = _built[kind].get(dataset_version)
+        appended = df.attrs.get("appended")
+        previous = history.get(appended["previous_version"]) if appended else None
+    if structure is None:
+        if previous is not None:
+            positions = appended["positions"]
+            structure = previous.append(df.take(positions), positions, dataset_version)
+        else:
+            structure = build(df)
+
+    with _versions_lock:
+        structure = _built[kind].setdefault(dataset_version, structure)
+        if "partition_of" not in df.attrs:
+            history[dataset_version] = structure
+            while len(history) > VERSION_HISTORY_SIZE:
+                history.popitem(last=False)
+    return structure
+
+
+@st.cache_resource(max_entries=4)
+def get_aggregate_cube(_df, dataset_version):
+    """Builds the aggregate cube once per dataset version and shares it across reruns."""
+    return extend_or_build("cube", _df, dataset_version, AggregateCube.build)
+
+
+@st.cache_resource(max_entries=4)
+def get_time_rollups(_df, dataset_version):
+    """Builds the daily, weekly and monthly rollups once per dataset version."""
+    return extend_or_build("rollups", _df, dataset_version, TimeRollups)
+
+
+# Dataset versions whose exact aggregates are built in the background, most recent last
+BACKGROUND_BUILDS_KEPT = 4
+# How often a page shown from a sample checks whether the exact aggregates are ready
+PROGRESSIVE_POLL_SECONDS = 1.0
+
+
+@st.cache_resource
+def get_background_builds():
+    """Returns the thread building exact aggregates in the background and its futures by dataset version."""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="exact-aggregates")
+    return executor, OrderedDict()
+
+
+def build_exact_aggregates(df, dataset_version, histories):
+    """Builds the cube and the rollups of a dataset version and returns them by kind.
+
+    Runs outside of any script run, so it does not call cached functions;
+    get_aggregate_cube and get_time_rollups then pick the results up while
+    the returned structures (e.g. the result of a background build) are kept.
+    """
+    return {
+        "cube": extend_or_build("cube", df, dataset_version, AggregateCube.build, histories["cube"]),
+        "rollups": extend_or_build("rollups", df, dataset_version, TimeRollups, histories["rollups"]),
+    }
+
+
+@st.fragment(run_every=PROGRESSIVE_POLL_SECONDS)
+def show_refinement(dataset_version, sample_rows, selection_rows):
+    """Says that the page shows estimates, and reruns it once the exact aggregates are ready."""
+    _, builds = get_background_builds()
+    future = builds.get(dataset_version)
+    if future is None or future.done():
+        st.rerun()
+    st.info(
+        f"Showing estimates from a sample of {sample_rows:,} of {selection_rows:,} rows, "
+        "with 95% confidence intervals. Exact values are being computed..."
+    )
+
+
+@st.cache_resource(max_entries=2)
+def get_duckdb_store(_df, dataset_version):
+    """Opens the DuckDB store of a dataset version once and shares it across sessions."""
+    return DuckDBStore(_df, _df.attrs.get("snapshot_path"))
+
+
+def signature_increments(path, signature):
+    """Returns the increment entries of a watcher.source_signature, like DataLoader.increment_stats."""
+    return tuple(entry for entry in signature if entry[0] != path)
+
+
+@st.cache_resource
+def get_dataset_watcher(path, sheet_name, usecols, streaming=True):
+    """Returns the watcher keeping the current dataset of a workbook, shared by every session."""
+    histories = {kind: get_version_history(kind) for kind in ("cube", "rollups")}
+    _, builds = get_background_builds()
+    return DatasetWatcher(
+        path,
+        functools.partial(load_watched_dataset, DataLoader(), path, sheet_name, usecols, streaming, histories),
+        functools.partial(release_dataset_version, histories, builds, get_figure_cache()),
+    )
+
+
+def load_watched_dataset(data_loader, path, sheet_name, usecols, streaming, histories, signature):
+    """Loads a new version of the dataset in the watcher's thread, with its cube and rollups,
+    so that sessions do not build them after the swap."""
+    df = data_loader.read_dataset(path, sheet_name, usecols, None, streaming, signature_increments(path, signature))
+    if query_backend() != "duckdb":
+        build_exact_aggregates(df, df.attrs["dataset_version"], histories)
+    return df
+
+
+def release_dataset_version(histories, builds, figure_cache, dataset_version):
+    """Drops everything cached for a dataset version that is no longer served,
+    including the partitions read from it."""
+    versions = [dataset_version, *DataLoader.forget_partitions(dataset_version)]
+    for version in versions:
+        for cached in (get_filter_index, get_aggregate_cube, get_time_rollups, get_duckdb_store):
+            cached.clear(None, version)
+    with _versions_lock:
+        for version in versions:
+            for history in histories.values():
+                history.pop(version, None)
+            builds.pop(version, None)
+    figure_cache.discard(dataset_version)
+
+
+def get_selection_cache():
+    """Returns the selection cache of the current session, shared by all pages."""
+    if "selection_cache" not in st.session_state:
+        st.session_state["selection_cache"] = SelectionCache()
+    return st.session_state["selection_cache"]
 
 
-        df_selection = self.df.query(
-            "City == @selected_cities & Customer_type == @selected_customer_types & Gender == @selected_genders"
+class SidebarFilter:
+    """Class to handle the sidebar filtering options."""
+
+    # (column, label, key in selected_filters) of every sidebar filter
+    FILTERS = [
+        ("City", "Select City:", "cities"),
+        ("Customer_type", "Select Customer Type:", "customer_types"),
+        ("Gender", "Select Gender:", "genders"),
+    ]
+
+    def __init__(self, df, preselected=None):
+        self.df = df
+        # Selections already drawn before `df` was loaded, see `load`
+        self.preselected = preselected or {}
+        self.selections = {}
+        self.date_range = None
+        self.cache_entry = None
+
+    @classmethod
+    def load(cls, data_loader, path, sheet_name, usecols):
+        """Draws the City filter, then loads only the partitions of the selected cities.
+
+        Sessions looking at one city then hold and index that city's rows
+        only. Without a partitioned copy of the data the whole frame is loaded.
+        """
+        catalog = data_loader.get_catalog(path, sheet_name, usecols)
+        if catalog is None:
+            return cls(data_loader.get_data_from_excel(path, sheet_name, usecols)).hold(path, sheet_name, usecols)
+
+        st.sidebar.header("Filter Options:")
+        column, label, _ = cls.FILTERS[0]
+        options = PartitionedStore.values(catalog, column)
+        selected = st.sidebar.multiselect(label, options=options, default=options)
+        if not selected:
+            st.warning("No data available based on the current filter settings!")
+            st.stop()
+        if set(selected) == set(options):
+            # The whole frame keeps its snapshot for the SQL backend and its appended rows
+            df = data_loader.get_data_from_excel(path, sheet_name, usecols)
+        else:
+            df = data_loader.get_partitions(catalog, {column: selected})
+        return cls(df, preselected={column: selected}).hold(path, sheet_name, usecols)
+
+    def hold(self, path, sheet_name, usecols):
+        """Keeps the watcher from releasing the caches of the shown dataset version while
+        this filter, i.e. the script run, lasts. Returns the filter."""
+        version = self.df.attrs.get("partition_of", self.df.attrs.get("dataset_version"))
+        if watch_enabled() and version is not None:
+            get_dataset_watcher(path, sheet_name, usecols, True).hold(self, version)
+        return self
+
+    def date_filter(self):
+        """Displays the date range picker and returns the picked (first, last) days.
+
+        Returns None when the whole period is picked, so that full-range
+        selections keep sharing the caches of the other pages.
+        """
+        first_day = self.df["Date"].iloc[0].date()
+        last_day = self.df["Date"].iloc[-1].date()
+        picked = st.sidebar.date_input(
+            "Select Date Range:", value=(first_day, last_day), min_value=first_day, max_value=last_day
         )
+        # While only the start of the range has been picked, the range runs to the last day
+        picked = tuple(picked) if isinstance(picked, (list, tuple)) else (picked,)
+        start = picked[0] if picked else first_day
+        end = picked[1] if len(picked) > 1 else last_day
+        if (start, end) == (first_day, last_day):
+            return None
+        return start, end
+
+    @timed("filter_data")
+    def filter_data(self):
+        """Displays sidebar filters and returns the filtered rows and the selected filters.
+
+        The rows are SelectedRows, positions into the shared frame, so
+        filtering copies no data.
+        """
+        if not self.preselected:
+            st.sidebar.header("Filter Options:")
+
+        dataset_version = self.df.attrs.get("dataset_version")
+        with span("filter_data.index"):
+            index = get_filter_index(self.df, dataset_version)
+
+        selections = {}
+        selected_filters = {}
+        for column, label, key in self.FILTERS:
+            if column in self.preselected:
+                selected = self.preselected[column]
+            else:
+                options = index.values(column)
+                selected = st.sidebar.multiselect(label, options=options, default=options)
+            selections[column] = selected
+            selected_filters[key] = selected
+        self.selections = selections
+        self.date_range = self.date_filter()
+        selected_filters["date_range"] = self.date_range
+
+        # Reuse the rows of this selection if any page of the session computed them,
+        # otherwise combine the precomputed bitmaps within the rows of the date range,
+        # found by binary search since the frame is sorted by date
+        bounds = None
+        if self.date_range is not None:
+            bounds = date_bounds(self.df["Date"].to_numpy(), *self.date_range)
+        selection_cache = get_selection_cache()
+        selection_cache.invalidate(keep_version=dataset_version)
+        misses = selection_cache.misses
+        with span("filter_data.select"):
+            self.cache_entry = selection_cache.get_or_create(
+                dataset_version,
+                filter_signature(selections, self.date_range),
+                lambda: index.select(selections, bounds),
+            )
+            df_selection = SelectedRows(self.df, self.cache_entry["positions"])
+        count("selection_cache.misses" if selection_cache.misses > misses else "selection_cache.hits")
 
         if df_selection.empty:
             st.warning("No data available based on the current filter settings!")
             st.stop()  # Halts app execution if no data matches the filters
 
-        selected_filters = {
-            'cities': selected_cities,
-            'customer_types': selected_customer_types,
-            'genders': selected_genders,
-        }
-
+        self.df_selection = df_selection
         return df_selection, selected_filters
 
+    def progressive(self):
+        """Returns whether the selection is shown from a sample while its exact aggregates
+        are built in the background, starting that build when needed.
+
+        Only selections of at least progressive_min_rows() rows whose cube or
+        rollups are not built yet are sampled. The background build is that of
+        the whole dataset, not of the selection: it takes as long as building
+        the cube and rollups, and then serves every selection.
+        """
+        dataset_version = self.df.attrs.get("dataset_version")
+        if dataset_version is None or not progressive_enabled() or len(self.df_selection) < progressive_min_rows():
+            return False
+        if all(is_built(kind, dataset_version) for kind in ("cube", "rollups")):
+            return False
+        histories = {kind: get_version_history(kind) for kind in ("cube", "rollups")}
+
+        executor, builds = get_background_builds()
+        with _versions_lock:
+            future = builds.get(dataset_version)
+            if future is None:
+                future = builds[dataset_version] = executor.submit(
+                    build_exact_aggregates, self.df, dataset_version, histories
+                )
+                while len(builds) > BACKGROUND_BUILDS_KEPT:
+                    builds.popitem(last=False)
+        if not future.done():
+            return True
+        if future.exception() is not None:
+            logger.error("Building the exact aggregates failed", exc_info=future.exception())
+        return False
+
+    def sample(self):
+        """Returns the stratified sample of the selection, drawn once per selection."""
+        if self.cache_entry is None:
+            return StratifiedSample(self.df_selection)
+        if "sample" not in self.cache_entry:
+            with span("filter_data.sample"):
+                self.cache_entry["sample"] = StratifiedSample(self.df_selection)
+        return self.cache_entry["sample"]
+
+    def aggregates(self):
+        """Returns the aggregate source of the current selection for the configured query backend.
+
+        The pandas backend slices the in-memory aggregate cube, or answers from
+        the time rollups when a date range is picked; the duckdb backend turns
+        the selection into SQL predicates. While the cube or rollups of a large
+        selection are being built, estimates from a sample are returned instead.
+        """
+        dataset_version = self.df.attrs.get("dataset_version")
+        results = self.cache_entry["aggregates"] if self.cache_entry is not None else None
+        if query_backend() == "duckdb":
+            store = get_duckdb_store(self.df, dataset_version)
+            return store.slice(self.selections, results, self.date_range)
+        if self.progressive():
+            sample = self.sample()
+            show_refinement(dataset_version, len(sample), len(self.df_selection))
+            return sample
+        if self.date_range is None:
+            cube = get_aggregate_cube(self.df, dataset_version)
+            return cube.slice(self.selections, results)
+
+        rollups = get_time_rollups(self.df, dataset_version)
+        key = None
+        if dataset_version is not None:
+            key = (dataset_version, filter_signature(self.selections, self.date_range))
+        return DateRangeSlice(rollups, self.df_selection, self.selections, *self.date_range, key, results)
+
+    def trends(self):
+        """Returns a function of the grain ("day", "week" or "month") giving the
+        sales per period and branch of the current selection, from the rollups."""
+        if query_backend() != "duckdb" and self.progressive():
+            return self.sample().trend
+        rollups = get_time_rollups(self.df, self.df.attrs.get("dataset_version"))
+        first_day, last_day = self.date_range if self.date_range is not None else (None, None)
+        return functools.partial(rollups.trend, selections=self.selections, first_day=first_day, last_day=last_day)
+
+
+def warm_default_views(data_loader, path, sheet_name, usecols):
+    """Computes what the pages show with the default filters into the shared caches.
+
+    Every city, customer type and gender over the whole period is selected,
+    as on a first visit: the data, its filter index, cube and rollups (or
+    DuckDB store) and every figure are built. Widgets are not drawn, so this
+    can run outside of a session, e.g. from prewarm.py. Returns the number of
+    figures built.
+    """
+    data_loader.get_catalog(path, sheet_name, usecols)
+    df = data_loader.get_data_from_excel(path, sheet_name, usecols)
+    dataset_version = df.attrs.get("dataset_version")
+    index = get_filter_index(df, dataset_version)
+
+    sidebar_filter = SidebarFilter(df)
+    sidebar_filter.selections = {column: index.values(column) for column, _, _ in SidebarFilter.FILTERS}
+    sidebar_filter.df_selection = SelectedRows(df, index.select(sidebar_filter.selections))
+    if query_backend() != "duckdb":
+        # Built here so that the figures come from exact aggregates, not from a sample
+        get_aggregate_cube(df, dataset_version)
+    get_time_rollups(df, dataset_version)
+
+    dashboard = Dashboard(sidebar_filter.df_selection, sidebar_filter.aggregates(), sidebar_filter.trends())
+    dashboard.plan(*Dashboard.CHART_AGGREGATIONS)
+    names = sorted(
+        attr[:-len("_figure")] for attr in dir(Dashboard)
+        if attr.endswith("_figure") and attr not in ("show_figure", "sales_trend_figure")
+    )
+    for name in names:
+        dashboard.figure(name)
+    for grain in Dashboard.TREND_LABELS:
+        dashboard.figure("sales_trend", grain)
+    return len(names) + len(Dashboard.TREND_LABELS)
+
+
 PH_ICON="📞"
 EM_ICON="📧"
 AD_ICON="🏢"
@@ -168,17 +810,95 @@ class ContactForm:
 class Dashboard:
     """Class to generate and display the dashboard."""
 
-    def __init__(self, df_selection):
+    # Aggregations (by, column, how[, sort]) each display method asks for
+    CHART_AGGREGATIONS = {
+        "display_kpis": [
+            ([], "Total", "sum"),
+            ([], "Rating", "mean"),
+            ([], "Total", "mean"),
+            ([], "gross income", "sum"),
+        ],
+        "display_charts_sales": [
+            (["Product line"], "Total", "sum"),
+            (["hour"], "Total", "sum"),
+            (["DayOfWeek"], "Total", "sum"),
+            (["Branch"], "Total", "sum"),
+            (["Payment"], "Total", "sum"),
+            (["Gender"], "Total", "sum"),
+        ],
+        "average_rating_by_branch": [(["Branch"], "Rating", "mean", False)],
+        "plot_avg_rating_dayofweek": [(["DayOfWeek"], "Rating", "mean")],
+        "plot_avg_rating_by_customer_type": [(["Customer_type", "Gender"], "Rating", "mean")],
+        "rating_vs_product_line": [(["Product line"], "Rating", "mean")],
+        "transactions_by_branch": [(["Branch"], "Invoice ID", "nunique", False)],
+        "plot_transaction_by_dayofweek": [(["DayOfWeek"], "Invoice ID", "nunique")],
+        "transactions_vs_product_line": [(["Product line"], "Invoice ID", "nunique")],
+        "display_city_branch": [(["City", "Branch"], "Total", "count", False)],
+        "display_city_and_branch_info": [(["City", "Branch"], "Total", "count", False)],
+        # Trends come from the time rollups, not from the aggregate source
+        "display_sales_trend": [],
+    }
+
+    TREND_LABELS = {"day": "Daily", "week": "Weekly", "month": "Monthly"}
+
+    def __init__(self, df_selection, aggregates=None, trends=None):
         self.df_selection = df_selection
+        # Pre-aggregated source for the charts, e.g. SidebarFilter.aggregates()
+        self.aggregates = aggregates if aggregates is not None else FrameAggregator(as_frame(df_selection))
+        # Sales per period and branch by grain, e.g. SidebarFilter.trends()
+        self.trends = trends
+        # Bytes of figure JSON the page sends, per chart
+        self.payload = PayloadBudget()
+
+    def plan(self, *methods):
+        """Computes the aggregations of all the given display methods in one pass.
+
+        Call it once per page with the methods the page is about to use.
+        """
+        plan = AggregationPlan()
+        for method in methods:
+            for request in self.CHART_AGGREGATIONS[method]:
+                plan.add(*request)
+        self.aggregates = PlannedAggregates(self.aggregates, plan)
+        return self
+
+    def interval(self, by, column, how, sort=True):
+        """Returns the 95% confidence interval half-width of an estimated aggregation, or
+        None when the aggregates are exact."""
+        interval = getattr(self.aggregates, "interval", None)
+        return interval(by, column, how, sort) if interval is not None else None
+
+    def margin(self, by, column, how, decimals):
+        """Returns " ± <half-width>" for an estimated KPI, or "" when it is exact."""
+        interval = self.interval(by, column, how)
+        return f" ± {interval:,.{decimals}f}" if interval is not None else ""
+
+    def kpis(self):
+        """Returns the KPI values of the selection and the margins of their estimates."""
+        return {
+            "total_sales": int(self.aggregates.aggregate([], "Total", "sum")),
+            "average_rating": round(self.aggregates.aggregate([], "Rating", "mean"), 1),
+            "average_sale_by_transaction": round(self.aggregates.aggregate([], "Total", "mean"), 2),
+            "gross_income": round(self.aggregates.aggregate([], "gross income", "sum"), 2),
+            "total_sales_margin": self.margin([], "Total", "sum", 0),
+            "average_rating_margin": self.margin([], "Rating", "mean", 2),
+            "average_sale_margin": self.margin([], "Total", "mean", 2),
+            "gross_income_margin": self.margin([], "gross income", "sum", 2),
+        }
 
     def display_kpis(self):
 
         """Displays KPIs in the dashboard."""
-        total_sales = int(self.df_selection["Total"].sum())
-        average_rating = round(self.df_selection["Rating"].mean(), 1)
+        kpis = self.kpis()
+        total_sales = kpis["total_sales"]
+        average_rating = kpis["average_rating"]
         star_rating = ":star:" * int(round(average_rating,0))
-        average_sale_by_transaction = round(self.df_selection["Total"].mean(), 2)
-        gross_income =  round(self.df_selection['gross income'].sum(), 2)
+        average_sale_by_transaction = kpis["average_sale_by_transaction"]
+        gross_income = kpis["gross_income"]
+        total_sales_margin = kpis["total_sales_margin"]
+        average_rating_margin = kpis["average_rating_margin"]
+        average_sale_margin = kpis["average_sale_margin"]
+        gross_income_margin = kpis["gross_income_margin"]
 
 
         # Define the maximum rating
@@ -188,11 +908,11 @@ class Dashboard:
 
         with left_column:
             st.markdown("<p style='font-size:20px; font-weight:bold; margin-bottom:10px;'>Total Sales:</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {total_sales:,}</p>", unsafe_allow_html=True)
+            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {total_sales:,}{total_sales_margin}</p>", unsafe_allow_html=True)
 
         with right_column:
             st.markdown("<p style='font-size:20px; font-weight:bold; margin-bottom:10px;'>Average Sales Per Transaction:</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {average_sale_by_transaction}</p>", unsafe_allow_html=True)
+            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {average_sale_by_transaction}{average_sale_margin}</p>", unsafe_allow_html=True)
 
         st.markdown("### ")
 
@@ -200,25 +920,59 @@ class Dashboard:
 
         with left_column:
             st.markdown("<p style='font-size:20px; font-weight:bold; margin-bottom:10px;'>Average Rating:</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>{average_rating }/{ max_rating}</p>", unsafe_allow_html=True)
+            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>{average_rating }/{ max_rating}{average_rating_margin}</p>", unsafe_allow_html=True)
             st.markdown(f"{star_rating}")
 
         with right_column:
             st.markdown("<p style='font-size:20px; font-weight:bold; margin-bottom:10px;'>Gross Income:</p>", unsafe_allow_html=True)
-            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {gross_income}</p>", unsafe_allow_html=True)
+            st.markdown(f"<p style='font-size:18px; font-weight:bold;'>US $ {gross_income}{gross_income_margin}</p>", unsafe_allow_html=True)
         
         st.markdown("""---""")
 
 
-    def display_charts_sales(self):
-        """Displays the sales by product line, sales by hour, branch, and payment type charts."""
+    def figure(self, name, *args):
+        """Returns the chart built by `<name>_figure(*args)`, from the figure cache when possible.
 
+        Figures are cached under the dataset version and filter signature of
+        the aggregate source, so an unchanged selection skips both the
+        aggregation and the figure construction. They are returned as compact
+        dicts, see figures.compact_figure.
+        """
+        figure_function = timed("figure.build")(getattr(self, f"{name}_figure"))
+
+        def build():
+            return compact_figure(figure_function(*args))
+
+        key = getattr(self.aggregates, "key", None)
+        with span("figure"):
+            if key is None:
+                return build()
+            cache = get_figure_cache()
+            misses = cache.misses
+            figure = cache.get_or_build((*key, name, *args), build)
+        count("figure_cache.misses" if cache.misses > misses else "figure_cache.hits")
+        return figure
+
+    def show_figure(self, name, container=st, *args):
+        """Displays the chart built by `<name>_figure(*args)` in `container`, counting its bytes
+        against the page's payload budget."""
+        figure = self.figure(name, *args)
+        self.payload.add(name, figure)
+        with span("plotly_chart"):
+            container.plotly_chart(figure, use_container_width=True)
+
+    def product_sales_figure(self):
         # Sales by Product Line Chart
-        sales_by_product_line = self.df_selection.groupby(by=["Product line"])[["Total"]].sum().sort_values(by="Total")
+        sales_by_product_line = self.aggregates.aggregate(["Product line"], "Total", "sum").to_frame()
+        error = self.interval(["Product line"], "Total", "sum")
+        if error is not None:
+            sales_by_product_line["error"] = error
+        sales_by_product_line = sales_by_product_line.sort_values(by="Total")
         fig_product_sales = px.bar(
             sales_by_product_line,
             x="Total",
             y=sales_by_product_line.index,
+            error_x="error" if error is not None else None,
             orientation="h",
             title="<b>Sales by Product Line</b>",
             color_discrete_sequence=["#1084B8"] * len(sales_by_product_line),
@@ -228,13 +982,19 @@ class Dashboard:
             plot_bgcolor="rgba(0,0,0,0)",
             xaxis=(dict(showgrid=False))
         )
+        return fig_product_sales
 
+    def hourly_sales_figure(self):
         # Sales by Hour Chart
-        sales_by_hour = self.df_selection.groupby(by=["hour"])[["Total"]].sum()
+        sales_by_hour = self.aggregates.aggregate(["hour"], "Total", "sum").to_frame()
+        error = self.interval(["hour"], "Total", "sum")
+        if error is not None:
+            sales_by_hour["error"] = error
         fig_hourly_sales = px.bar(
             sales_by_hour,
             x=sales_by_hour.index,
             y="Total",
+            error_y="error" if error is not None else None,
             title="<b>Sales by hour</b>",
             color_discrete_sequence=["#1084B8"] * len(sales_by_hour),
             template="plotly_white",
@@ -244,15 +1004,21 @@ class Dashboard:
             plot_bgcolor="rgba(0,0,0,0)",
             yaxis=(dict(showgrid=False)),
         )
+        return fig_hourly_sales
 
+    def daily_sales_figure(self):
         # Group by Day of the Week and calculate total sales
-        sales_by_day = self.df_selection.groupby('DayOfWeek')['Total'].sum().reindex(
-            ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]).reset_index()
+        sales_by_day = self.aggregates.aggregate(["DayOfWeek"], "Total", "sum").to_frame()
+        error = self.interval(["DayOfWeek"], "Total", "sum")
+        if error is not None:
+            sales_by_day["error"] = error
+        sales_by_day = sales_by_day.reindex(WEEKDAYS).reset_index()
 
         fig_daily_sales = px.bar(
             sales_by_day,
             x='DayOfWeek',
             y='Total',
+            error_y="error" if error is not None else None,
             title='Total Sales by Day of Week',
             labels={'Total': 'Total Sales (US$)', 'DayOfWeek': 'Day of Week'},
             template='plotly_white'
@@ -262,11 +1028,13 @@ class Dashboard:
             plot_bgcolor="rgba(0,0,0,0)",
             yaxis=(dict(showgrid=False)),
         )
+        return fig_daily_sales
 
+    def branch_pie_figure(self):
         # Pie Chart for Branch Sales with Separate Slices
-        sales_by_branch = self.df_selection.groupby(by=["Branch"])[["Total"]].sum().sort_values(by="Total")
+        sales_by_branch = self.aggregates.aggregate(["Branch"], "Total", "sum").to_frame().sort_values(by="Total")
         fig_branch_pie = px.pie(
-            self.df_selection, 
+            sales_by_branch.reset_index(),
             names='Branch', 
             values='Total', 
             title='<b>Sales Distribution by Branch</b>',
@@ -277,11 +1045,13 @@ class Dashboard:
             pull=[0.1 for _ in range(len(sales_by_branch))],  # Pulls each slice away from the center
             textinfo='percent+label'  # Show both the percentage and the label on each slice
         )
+        return fig_branch_pie
 
+    def payment_sales_figure(self):
         # Pie Chart for Sales by Payment Type 
-        sales_by_payment = self.df_selection.groupby(by=["Payment"])[["Total"]].sum().sort_values(by="Total")
+        sales_by_payment = self.aggregates.aggregate(["Payment"], "Total", "sum").to_frame().sort_values(by="Total")
         fig_payment_sales = px.pie(
-            self.df_selection, 
+            sales_by_payment.reset_index(),
             names='Payment', 
             values='Total', 
             title='<b>Sales by Payment Type</b>',
@@ -292,9 +1062,11 @@ class Dashboard:
             pull=[0.1 for _ in range(len(sales_by_payment))],  # Pulls each slice away from the center
             textinfo='percent+label'  # Show both the percentage and the label on each slice
         )
+        return fig_payment_sales
 
+    def gender_sales_figure(self):
         # Pie Chart for Sales by Gender Type 
-        sales_by_gender = self.df_selection.groupby('Gender')['Total'].sum().reset_index()
+        sales_by_gender = self.aggregates.aggregate(["Gender"], "Total", "sum").reset_index()
         fig_gender_sales = px.pie(
             sales_by_gender,
             names='Gender',
@@ -307,96 +1079,159 @@ class Dashboard:
             pull=[0.1 for _ in range(len(sales_by_gender))],  # Pulls each slice away from the center
             textinfo='percent+label'  # Show both the percentage and the label on each slice
         )
+        return fig_gender_sales
+
+    def display_charts_sales(self):
+        """Displays the sales by product line, sales by hour, branch, and payment type charts."""
 
         # Display charts in columns
         left_column, right_column = st.columns(2)
-        left_column.plotly_chart(fig_hourly_sales, use_container_width=True)
-        right_column.plotly_chart(fig_product_sales, use_container_width=True)
+        self.show_figure("hourly_sales", left_column)
+        self.show_figure("product_sales", right_column)
 
         st.markdown("""---""")
 
         # Display pie charts in columns
         left_column, right_column = st.columns(2)
-        left_column.plotly_chart(fig_daily_sales, use_container_width=True)
-        right_column.plotly_chart(fig_payment_sales, use_container_width=True)
+        self.show_figure("daily_sales", left_column)
+        self.show_figure("payment_sales", right_column)
 
         st.markdown("""---""")
 
         left_column, right_column = st.columns(2)
-        left_column.plotly_chart(fig_gender_sales, use_container_width=True)
-        right_column.plotly_chart(fig_branch_pie, use_container_width=True)
+        self.show_figure("gender_sales", left_column)
+        self.show_figure("branch_pie", right_column)
+
+    def sales_trend_figure(self, grain):
+        # Sales per day, week or month of every branch
+        if self.trends is not None:
+            trend = self.trends(grain)
+        else:
+            rows = as_frame(self.df_selection)
+            periods = period_starts(rows["Date"].to_numpy().astype("datetime64[D]"), grain)
+            trend = (
+                rows.assign(period=periods)
+                .groupby(["period", "Branch"], observed=True)["Total"]
+                .sum()
+                .reset_index()
+            )
+        fig_sales_trend = px.line(
+            trend,
+            x="period",
+            y="Total",
+            color="Branch",
+            markers=grain != "day",
+            title=f"<b>{self.TREND_LABELS[grain]} Sales by Branch</b>",
+            labels={"Total": "Total Sales (US$)", "period": ""},
+            template="plotly_white",
+        )
+        fig_sales_trend.update_layout(
+            plot_bgcolor="rgba(0,0,0,0)",
+            legend_title_text="Branch",
+        )
+        return fig_sales_trend
+
+    def display_sales_trend(self):
+        """Displays the sales trend of every branch at the picked granularity."""
+        grain = st.radio(
+            "Trend granularity:",
+            options=list(self.TREND_LABELS),
+            format_func=self.TREND_LABELS.get,
+            index=1,
+            horizontal=True,
+        )
+        self.show_figure("sales_trend", st, grain)
 
 
     def average_rating_by_branch(self):
         st.markdown("### Average Rating by Branch")
-        branches = self.df_selection['Branch'].unique()
-        cols = st.columns(len(branches))
+        ratings_by_branch = self.aggregates.aggregate(["Branch"], "Rating", "mean", sort=False)
+        errors = self.interval(["Branch"], "Rating", "mean", sort=False)
+        cols = st.columns(len(ratings_by_branch))
 
-        for idx, branch in enumerate(branches):
-            branch_data = self.df_selection[self.df_selection['Branch'] == branch]
-            avg_rating = branch_data['Rating'].mean()
+        for idx, (branch, avg_rating) in enumerate(ratings_by_branch.items()):
             with cols[idx]:
                 ui.metric_card(
                 title=branch,
                 content=f"{avg_rating:.2f}/10",
-                description=None,
+                description=f"± {errors[branch]:.2f} (95% interval)" if errors is not None else None,
                 key=f"card{idx}"
             )
 
 
-    def plot_avg_rating_dayofweek(self):
-        avg_rating_dayofweek = self.df_selection.groupby('DayOfWeek')['Rating'].mean().reindex(
-            ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]).reset_index()
+    def avg_rating_dayofweek_figure(self):
+        avg_rating_dayofweek = self.aggregates.aggregate(["DayOfWeek"], "Rating", "mean").to_frame()
+        error = self.interval(["DayOfWeek"], "Rating", "mean")
+        if error is not None:
+            avg_rating_dayofweek["error"] = error
+        avg_rating_dayofweek = avg_rating_dayofweek.reindex(WEEKDAYS).reset_index()
         fig = px.line(
             avg_rating_dayofweek,
             x='DayOfWeek',
             y='Rating',
+            error_y="error" if error is not None else None,
             title='Average Rating by Day of Week',
             labels={'Rating': 'Average Rating', 'DayOfWeek': 'Day of Week'},
             template='plotly_white'
         )
-        st.plotly_chart(fig, use_container_width=True)
+        return fig
 
-    def plot_avg_rating_by_customer_type(self):
+    def plot_avg_rating_dayofweek(self):
+        self.show_figure("avg_rating_dayofweek")
+
+    def avg_rating_by_customer_type_figure(self):
         # Group by Customer_type and Gender, and calculate the mean Rating
-        avg_rating = self.df_selection.groupby(['Customer_type', 'Gender'])['Rating'].mean().reset_index()
+        avg_rating = self.aggregates.aggregate(["Customer_type", "Gender"], "Rating", "mean").to_frame()
+        error = self.interval(["Customer_type", "Gender"], "Rating", "mean")
+        if error is not None:
+            avg_rating["error"] = error
+        avg_rating = avg_rating.reset_index()
 
         # Create the plot
         fig = px.bar(
             avg_rating,
             x='Customer_type',
             y='Rating',
+            error_y="error" if error is not None else None,
             color='Gender',
             barmode='group',
             title='Average Rating by Customer Type and Gender',
             labels={'Rating': 'Average Rating', 'Customer_type': 'Customer Type'},
             template='plotly_white'
         )
+        return fig
 
+    def plot_avg_rating_by_customer_type(self):
         # Display the plot in Streamlit
-        st.plotly_chart(fig, use_container_width=True)
-
-    def rating_vs_product_line(self):
-        rating_product = self.df_selection.groupby('Product line')['Rating'].mean().reset_index().sort_values(by='Rating', ascending=False)
+        self.show_figure("avg_rating_by_customer_type")
+
+    def rating_vs_product_line_figure(self):
+        rating_product = self.aggregates.aggregate(["Product line"], "Rating", "mean").to_frame()
+        error = self.interval(["Product line"], "Rating", "mean")
+        if error is not None:
+            rating_product["error"] = error
+        rating_product = rating_product.reset_index().sort_values(by='Rating', ascending=False)
         fig = px.bar(
             rating_product,
             x='Rating',
             y='Product line',
+            error_x="error" if error is not None else None,
             orientation='h',
             title='Average Rating by Product Line',
             labels={'Rating': 'Average Rating', 'Product line': 'Product Line'},
             template='plotly_white'
         )
-        st.plotly_chart(fig, use_container_width=True)
+        return fig
+
+    def rating_vs_product_line(self):
+        self.show_figure("rating_vs_product_line")
 
 
     def transactions_by_branch(self):
         st.markdown("### Transactions by Branch")
-        branches = self.df_selection['Branch'].unique()
-        cols = st.columns(len(branches))
-        for idx, branch in enumerate(branches):
-            branch_data = self.df_selection[self.df_selection['Branch'] == branch]
-            total_transactions = branch_data['Invoice ID'].nunique()
+        transactions = self.aggregates.aggregate(["Branch"], "Invoice ID", "nunique", sort=False)
+        cols = st.columns(len(transactions))
+        for idx, (branch, total_transactions) in enumerate(transactions.items()):
             with cols[idx]:
                 ui.metric_card(
                 title=branch,
@@ -406,9 +1241,8 @@ class Dashboard:
             )
 
 
-    def plot_transaction_by_dayofweek(self):
-        transactions_by_dayofweek = self.df_selection.groupby('DayOfWeek')['Invoice ID'].nunique().reindex(
-            ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]).reset_index()
+    def transaction_by_dayofweek_figure(self):
+        transactions_by_dayofweek = self.aggregates.aggregate(["DayOfWeek"], "Invoice ID", "nunique").reindex(WEEKDAYS).reset_index()
         
         fig = px.bar(
             transactions_by_dayofweek,
@@ -418,10 +1252,13 @@ class Dashboard:
             labels={'Invoice ID': 'Number of Transactions', 'DayOfWeek': 'Day of Week'},
             template='plotly_white'
         )
-        st.plotly_chart(fig, use_container_width=True)
+        return fig
 
-    def transactions_vs_product_line(self):
-        trans_product = self.df_selection.groupby('Product line')['Invoice ID'].nunique().reset_index().sort_values(by='Invoice ID', ascending=False)
+    def plot_transaction_by_dayofweek(self):
+        self.show_figure("transaction_by_dayofweek")
+
+    def transactions_vs_product_line_figure(self):
+        trans_product = self.aggregates.aggregate(["Product line"], "Invoice ID", "nunique").reset_index().sort_values(by='Invoice ID', ascending=False)
         fig = px.bar(
             trans_product,
             x='Invoice ID',
@@ -431,20 +1268,32 @@ class Dashboard:
             labels={'Invoice ID': 'Number of Transactions', 'Product line': 'Product Line'},
             template='plotly_white'
         )
-        st.plotly_chart(fig, use_container_width=True)
+        return fig
+
+    def transactions_vs_product_line(self):
+        self.show_figure("transactions_vs_product_line")
+
 
+    def branches_by_city(self):
+        """Returns the branches present in the selection per city, in order of appearance."""
+        branch_counts = self.aggregates.aggregate(["City", "Branch"], "Total", "count", sort=False)
+        branches = {}
+        for city, branch in branch_counts.index:
+            branches.setdefault(city, []).append(branch)
+        return branches
 
     # Display the data for city, and branch in separate columns
     def display_city_branch(self, selected_filters):
         
         selected_cities = selected_filters['cities']
+        branches = self.branches_by_city()
 
         city_title = ", ".join(selected_cities) if selected_cities else "All Cities"
         st.markdown(f"### Branches for {city_title}")
         cols = st.columns(len(selected_cities))
         
         for idx, city in enumerate(selected_cities):
-            branches_in_city = self.df_selection[self.df_selection['City'] == city]['Branch'].unique()        
+            branches_in_city = branches.get(city, [])
             with cols[idx]:
                 ui.metric_card(
                     title=city,
@@ -458,9 +1307,10 @@ class Dashboard:
         selected_cities = selected_filters['cities']
 
         contactinfo = ContactInfo(selected_filters)
+        branches = self.branches_by_city()
 
         for city in selected_cities:
-            branches_in_city = self.df_selection[self.df_selection['City'] == city]['Branch'].unique()
+            branches_in_city = branches.get(city, [])
 
             contact_info = contactinfo.get_contact_info(city)
 
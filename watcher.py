@@ -0,0 +1,160 @@
+import collections
+import logging
+import os
+import threading
+import time
+import weakref
+
+from data_store import file_stat, find_increments
+
+
+logger = logging.getLogger(__name__)
+
+# Set SUPERMARKET_WATCH=0 to load the data on the rerun that notices a change
+# instead of in the background
+WATCH_ENV = "SUPERMARKET_WATCH"
+# Seconds between two scans of the data directory
+WATCH_INTERVAL_ENV = "SUPERMARKET_WATCH_INTERVAL"
+WATCH_INTERVAL = 2.0
+# Seconds a replaced version is kept at least, so sessions that read it just
+# before the swap can still mark it as in use
+RELEASE_DELAY = 30.0
+
+
+def watch_enabled():
+    return os.environ.get(WATCH_ENV, "1").strip().lower() not in ("0", "false", "off")
+
+
+def watch_interval():
+    value = os.environ.get(WATCH_INTERVAL_ENV)
+    return float(value) if value else WATCH_INTERVAL
+
+
+def source_signature(path):
+    """Returns the (path, mtime_ns, size) of the workbook and of the increment files next to it."""
+    paths = [path, *find_increments(os.path.dirname(path))]
+    return tuple((source, *file_stat(source).values()) for source in paths if os.path.exists(source))
+
+
+class DatasetWatcher:
+    """Class to keep the current dataset of a workbook, reloaded in the background when its files change.
+
+    A thread scans the workbook and its increment files every `interval`
+    seconds. When their signature changes, `load(signature)` builds the new
+    dataset while the current one keeps being served; the new one then
+    replaces it with a single assignment. Sessions keep the frame they read for
+    the rest of their run, so no session waits for a reload and none sees half
+    of one. Sessions mark the version they show as in use with `hold`.
+    `release(version)` is called for every replaced version once no session
+    holds it anymore, and no sooner than `release_delay` seconds after the swap.
+    """
+
+    def __init__(self, path, load, release=None, interval=None, release_delay=RELEASE_DELAY):
+        self.path = path
+        self.load = load
+        self.release = release
+        self.interval = watch_interval() if interval is None else interval
+        self.release_delay = release_delay
+        self.signature = None
+        self.df = None
+        self.swaps = 0
+        self._failed_signature = None
+        self._retired = []
+        self._users = collections.Counter()
+        self._users_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def version(self):
+        return self.df.attrs.get("dataset_version") if self.df is not None else None
+
+    def current(self, load_first=None):
+        """Returns the current dataset, loading the first one with `load_first(signature)`
+        (default `load`) in the calling thread and starting the watch."""
+        df = self.df
+        if df is not None:
+            return df
+        with self._load_lock:
+            if self.df is None:
+                signature = source_signature(self.path)
+                self.df = (load_first or self.load)(signature)
+                self.signature = signature
+                self.start()
+        return self.df
+
+    def hold(self, owner, version):
+        """Marks `version` as in use until `owner` is garbage collected, e.g. at the end of a script run."""
+        with self._users_lock:
+            self._users[version] += 1
+        weakref.finalize(owner, self._drop, version)
+
+    def _drop(self, version):
+        with self._users_lock:
+            self._users[version] -= 1
+            if self._users[version] <= 0:
+                del self._users[version]
+
+    def in_use(self, version):
+        with self._users_lock:
+            return version in self._users
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="dataset-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Watching %s failed", self.path)
+
+    def check(self):
+        """Reloads the dataset if its files changed since it was loaded, and releases the
+        replaced versions no session uses anymore. Returns whether a new version was swapped in."""
+        swapped = False
+        signature = source_signature(self.path)
+        if signature != self.signature and signature != self._failed_signature:
+            swapped = self.reload(signature)
+        self._release_retired()
+        return swapped
+
+    def reload(self, signature):
+        with self._load_lock:
+            start = time.perf_counter()
+            try:
+                df = self.load(signature)
+            except Exception:
+                # Keep serving the current version until the files change again
+                self._failed_signature = signature
+                logger.exception("Reloading %s failed, keeping version %s", self.path, self.version)
+                return False
+            previous_version = self.version
+            self.signature = signature
+            if df.attrs.get("dataset_version") == previous_version:
+                # Only touched: the snapshot was still fresh
+                return False
+            self.df = df
+            self.swaps += 1
+            if previous_version is not None:
+                self._retired.append((previous_version, time.monotonic()))
+        logger.info("Swapped in dataset version %s (was %s) after %.2fs",
+                    self.version, previous_version, time.perf_counter() - start)
+        return True
+
+    def _release_retired(self):
+        now = time.monotonic()
+        retired = []
+        for version, retired_at in self._retired:
+            if now - retired_at < self.release_delay or self.in_use(version):
+                retired.append((version, retired_at))
+            elif self.release is not None and version != self.version:
+                self.release(version)
+                logger.info("Released the caches of dataset version %s", version)
+        self._retired = retired